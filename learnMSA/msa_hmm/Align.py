@@ -231,7 +231,7 @@ def run_learnMSA(data : SequenceDataset,
     Path(os.path.dirname(out_filename)).mkdir(parents=True, exist_ok=True)
     t = time.time()
     
-    if align_insertions:
+    if align_insertions and output_format != "a3m": #a3m writes insertions unaligned
         aligned_insertions = make_aligned_insertions(am, insertion_aligner, aligner_threads, verbose=verbose)
         am.to_file(out_filename, am.best_model, aligned_insertions = aligned_insertions, format=output_format)
     else:
@@ -274,10 +274,12 @@ def get_state_expectations(data : SequenceDataset,
     num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
     num_devices = num_gpu + int(num_gpu==0) #account for the CPU-only case 
     batch_size = int(batch_size / num_devices)
-    #compute an optimized order for decoding that sorts sequences of equal length into the same batch
     indices = np.reshape(indices, (-1))
     num_indices = indices.shape[0]
-    sorted_indices = np.array([[i,j] for l,i,j in sorted(zip(data.seq_lens[indices], indices, range(num_indices)))])
+    #each distinct sequence is processed only once and weighted by its number of occurences
+    unique_indices, counts, inverse = data.get_unique_indices(indices)
+    #compute an optimized order for decoding that sorts sequences of equal length into the same batch
+    sorted_indices = np.array([[i,j] for l,i,j in sorted(zip(data.seq_lens[unique_indices], unique_indices, range(unique_indices.size)))])
     msa_hmm_layer.cell.recurrent_init()
     cell = msa_hmm_layer.cell
     old_crop_long_seqs = batch_generator.crop_long_seqs
@@ -287,27 +289,29 @@ def get_state_expectations(data : SequenceDataset,
                             batch_size,
                             shuffle=False,
                             bucket_by_seq_length=True,
-                            model_lengths=cell.length)
+                            model_lengths=cell.length,
+                            parallel_factor=msa_hmm_layer.parallel_factor)
     
     @tf.function(input_signature=[[tf.TensorSpec(x.shape, dtype=x.dtype) for x in encoder.inputs]])
     def batch_posterior_state_probs(inputs):
         encoded_seq = encoder(inputs) 
         posterior_probs = msa_hmm_layer.state_posterior_log_probs(encoded_seq)
         posterior_probs = tf.math.exp(posterior_probs)
-        #compute expected number of visits per hidden state and sum over batch dim
+        #compute expected number of visits per hidden state 
         posterior_probs = tf.reduce_sum(posterior_probs, -2)
-        if reduce:
-            posterior_probs = tf.reduce_sum(posterior_probs, 1) / num_indices
         return posterior_probs
     
     if reduce:
         posterior_probs = tf.zeros((cell.num_models, cell.max_num_states), cell.dtype) 
-        for (*inputs, _), _ in ds:
-            posterior_probs += batch_posterior_state_probs(inputs)
+        for (*inputs, batch_indices), _ in ds:
+            #batch indices are positions in sorted_indices, sum over batch dim weighted by multiplicity
+            batch_counts = tf.cast(counts[sorted_indices[batch_indices, 1]], cell.dtype)
+            posterior_probs += tf.einsum("kbq,b->kq", batch_posterior_state_probs(inputs), batch_counts) / num_indices
     else:
-        posterior_probs = np.zeros((cell.num_models, num_indices, cell.max_num_states), cell.dtype) 
+        posterior_probs = np.zeros((cell.num_models, unique_indices.size, cell.max_num_states), cell.dtype) 
         for (*inputs, batch_indices), _ in ds:
-            posterior_probs[:,batch_indices] = batch_posterior_state_probs(inputs)
+            posterior_probs[:,sorted_indices[batch_indices, 1]] = batch_posterior_state_probs(inputs)
+        posterior_probs = posterior_probs[:,inverse]
     batch_generator.crop_long_seqs = old_crop_long_seqs       
     return posterior_probs
     
@@ -333,11 +337,11 @@ def get_discard_or_expand_positions(am,
                                                 am.batch_size,
                                                 am.msa_hmm_layer.cell,
                                                 list(range(am.num_models)),
-                                                am.encoder_model) #shape (num_model, num_seq, L)
+                                                am.encoder_model)
         #count
         expected_state = tf.zeros((am.num_models, am.msa_hmm_layer.cell.max_num_states), am.msa_hmm_layer.cell.dtype)
         for i in range(0, am.indices.shape[0], am.batch_size):
-            state_seqs_max_lik_batch = state_seqs_max_lik[:,i:i+am.batch_size]
+            state_seqs_max_lik_batch = state_seqs_max_lik.to_dense(np.arange(i, min(i+am.batch_size, am.indices.shape[0])))
             state_seqs_max_lik_batch = tf.one_hot(state_seqs_max_lik_batch, am.msa_hmm_layer.cell.max_num_states) 
             at_least_once = tf.cast(tf.reduce_sum(state_seqs_max_lik_batch, axis=-2) > 0, tf.float32)
             expected_state += tf.reduce_sum(at_least_once, axis=-2)
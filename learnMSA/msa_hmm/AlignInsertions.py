@@ -1,46 +1,93 @@
 import numpy as np
 from learnMSA.msa_hmm.SequenceDataset import SequenceDataset, AlignedDataset
-import learnMSA.msa_hmm.AlignmentModel as alignment_model
 import subprocess
 from shutil import which
 import sys
+import os
+import hashlib
+import importlib.util
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import Bio.SeqIO
 
 
-def find_long_insertions_and_get_sequences(data : SequenceDataset, lens, starts, t = 20, k=2, max_insertions_len=500, max_insertions_len_below_seq_ok = 100):
+#slices with a smaller cost (number of fragments times their total length) are aligned together in one worker call
+MIN_SLICE_BATCH_COST = 1e6
+#the slice cache keeps the most recently aligned slices up to this total number of aligned residues and gaps
+MAX_SLICE_CACHE_SIZE = 5e7
+
+
+class SliceMsaCache():
+    """ Msas of aligned slices by content hash. If the cached msas have more than max_size 
+        aligned residues and gaps in total, the least recently used ones are evicted.
+    """
+    def __init__(self, max_size=MAX_SLICE_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.msas = OrderedDict()
+
+    def __contains__(self, h):
+        return h in self.msas
+
+    def __len__(self):
+        return len(self.msas)
+
+    def get(self, h):
+        self.msas.move_to_end(h)
+        return self.msas[h]
+
+    def put(self, h, msa):
+        #msas larger than the cache are not kept and do not evict anything
+        if _get_msa_size(msa) > self.max_size:
+            return
+        if h in self.msas:
+            self.size -= _get_msa_size(self.msas.pop(h))
+        self.msas[h] = msa
+        self.size += _get_msa_size(msa)
+        while self.size > self.max_size and len(self.msas) > 0:
+            _, evicted = self.msas.popitem(last=False)
+            self.size -= _get_msa_size(evicted)
+
+    def clear(self):
+        self.msas.clear()
+        self.size = 0
+
+
+#msas of already aligned slices by content hash, reruns in the same process skip the aligner
+_slice_msa_cache = SliceMsaCache()
+
+
+def find_long_insertions_and_get_sequences(data : SequenceDataset, lens, starts, t = 20, k=2, max_insertions_len=500, max_insertions_len_below_seq_ok = 100, indices=None):
     """
     Finds insertions that have at least length t. If there are at least k of these sequences, returns id + fragment pairs.
+    Fragments are cut from the original residues (upper case), i.e. the aligner sees B, Z and J, and only the 
+    non-standard symbols of the alphabet (X, U, O) count towards the frequency that omits a fragment.
     Args: 
         data: Dataset of all sequences.
-        slices: Distionary keeping track of the slices.
         lens, starts: Arrays of length n where n is the number of sequences in the dataset. Indicate how long insertions are and where they start respectively.
-        name: Identifier for the location of the slice (e.g. left_flank or match_5).
+        indices: Dataset indices of the n sequences. Defaults to 0,...,n-1.
     """
     at_least_t = lens >= t
-    lengths = lens[at_least_t]
+    lengths = lens[at_least_t].astype(np.int64)
     if lengths.size > 1:
-        which = np.squeeze(np.argwhere(at_least_t))
-        start = starts[at_least_t]
-        id_fragment_pairs = []
-        to_delete = [] #keeps track of fragments that are too long
-        for j in range(lengths.size):
-            aa_seq = str(data.get_record(which[j]).seq).upper()
-            segment = aa_seq[start[j] : start[j] + lengths[j]]
-            #sometimes segments look strange (like ones consisting only of X)
-            #this can cause problems in the downstream aligner, omit these segments
-            non_standard_freq = 0
-            for aa in data.alphabet[20:]:
-                non_standard_freq += segment.count(aa)
-            non_standard_freq /= len(segment)
-            mostly_non_standard_aa = non_standard_freq > 0.5
-            if (mostly_non_standard_aa or 
-                (lengths[j] > max_insertions_len and 
-                    which.size > max_insertions_len_below_seq_ok)):
-                to_delete.append(j)
-            else:
-                sid = data.seq_ids[which[j]]+"\n"
-                id_fragment_pairs.append((sid, segment))
-        which = np.delete(which, to_delete)
+        which = np.flatnonzero(at_least_t)
+        start = starts[at_least_t].astype(np.int64)
+        seq_indices = which if indices is None else np.asarray(indices)[which]
+        fragments = "".join([data.get_standardized_seq(i)[s : s+l] for i,s,l in zip(seq_indices, start, lengths)])
+        fragment_offsets = np.zeros(lengths.size+1, dtype=np.int64)
+        np.cumsum(lengths, out=fragment_offsets[1:])
+        #sometimes segments look strange (like ones consisting only of X)
+        #this can cause problems in the downstream aligner, omit these segments
+        is_non_standard = np.zeros(256, dtype=bool)
+        is_non_standard[np.frombuffer(data.alphabet[20:].encode("ascii"), dtype=np.uint8)] = True
+        non_standard = is_non_standard[np.frombuffer(fragments.encode("ascii", errors="replace"), dtype=np.uint8)]
+        non_standard_freq = np.add.reduceat(non_standard.astype(np.int64), fragment_offsets[:-1]) / lengths
+        mostly_non_standard_aa = non_standard_freq > 0.5
+        to_delete = mostly_non_standard_aa | ((lengths > max_insertions_len) & (which.size > max_insertions_len_below_seq_ok))
+        id_fragment_pairs = [(data.seq_ids[i]+"\n", fragments[fragment_offsets[j]:fragment_offsets[j+1]]) 
+                                for j,i in enumerate(seq_indices) if not to_delete[j]]
+        which = which[~to_delete]
         if which.size > k:
             return (which, id_fragment_pairs)
     return None
@@ -57,19 +104,18 @@ def make_aligned_insertions(am, method="famsa", threads=0, verbose=True):
     if not am.best_model in am.metadata:
         am._build_alignment([am.best_model])
     data = am.metadata[am.best_model]
-    num_seq = data.left_flank_len.shape[0]
 
     insertions_long = []
     for r in range(data.num_repeats):
         insertions_long.append([])
         for i in range(data.insertion_lens.shape[2]):
-            ins_long = find_long_insertions_and_get_sequences(am.data, data.insertion_lens[r, :, i], data.insertion_start[r, :, i])
+            ins_long = find_long_insertions_and_get_sequences(am.data, data.insertion_lens[r, :, i], data.insertion_start[r, :, i], indices=am.indices)
             insertions_long[-1].append(ins_long)
-    left_flank_long = find_long_insertions_and_get_sequences(am.data, data.left_flank_len, data.left_flank_start)
-    right_flank_long = find_long_insertions_and_get_sequences(am.data, data.right_flank_len, data.right_flank_start)
+    left_flank_long = find_long_insertions_and_get_sequences(am.data, data.left_flank_len, data.left_flank_start, indices=am.indices)
+    right_flank_long = find_long_insertions_and_get_sequences(am.data, data.right_flank_len, data.right_flank_start, indices=am.indices)
     unannotated_long = []
     for r in range(data.num_repeats-1):
-        unannotated_long.append(find_long_insertions_and_get_sequences(am.data, data.unannotated_segments_len[r], data.unannotated_segments_start[r]))
+        unannotated_long.append(find_long_insertions_and_get_sequences(am.data, data.unannotated_segments_len[r], data.unannotated_segments_start[r], indices=am.indices))
         
     slices = {}
     if left_flank_long is not None:
@@ -94,6 +140,8 @@ def make_aligned_insertions(am, method="famsa", threads=0, verbose=True):
     right_flank_long = (right_flank_long[0],  AlignedDataset(aligned_sequences = alignments["right_flank"])) if right_flank_long is not None else None
     unannotated_long = [(x[0], AlignedDataset(aligned_sequences = alignments[f"unannotated_{r}"])) if x is not None else None for r,x in enumerate(unannotated_long)]
     
+    #imported here, worker processes that align slices should not load tensorflow
+    import learnMSA.msa_hmm.AlignmentModel as alignment_model
     aligned_insertions = alignment_model.AlignedInsertions(insertions_long, left_flank_long, right_flank_long, unannotated_long)
     return aligned_insertions
 
@@ -108,12 +156,92 @@ def make_slice_msas(slices, method="famsa", threads=0):
 
 
 def align_with_famsa(slices, threads):
+    """ Aligns the slices with famsa. Recently aligned slices are taken from a bounded cache. 
+        Large slices are aligned one after another with all threads, smaller ones are distributed in batches over a process pool.
+    Args:
+        slices: Dictionary of lists of (id, fragment) pairs.
+        threads: Number of threads to use. If 0, uses all available threads.
+    Returns:
+        A dictionary with a list of (id, aligned fragment) pairs per slice.
+    """
     #keep conditional import, famsa could be optional in the future
+    #check here, the worker processes would fail with a less clear error
+    if importlib.util.find_spec("pyfamsa") is None:
+        raise ImportError("Aligning insertions with famsa requires the pyfamsa package. Install it with: pip install pyfamsa")
+    threads = threads if threads > 0 else os.cpu_count()
+    keys = {key : _hash_slice("famsa", seqs) for key, seqs in slices.items()}
+    unique_slices = {keys[key] : seqs for key, seqs in slices.items()}
+    msas = {h : _slice_msa_cache.get(h) for h in unique_slices if h in _slice_msa_cache}
+    missing = [h for h in unique_slices if h not in msas]
+    costs = {h : _get_slice_cost(unique_slices[h]) for h in missing}
+    large, batches = schedule_slices(costs, threads)
+    if threads > 1 and len(batches) > 1:
+        # use spawn, forking a process that has already initialized tensorflow is unsafe
+        with ProcessPoolExecutor(min(threads, len(batches)), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_align_slices_famsa, [unique_slices[h] for h in batch], 1) for batch in batches]
+            #large slices are aligned with all threads in the meantime
+            for h in large:
+                msas[h] = _align_slices_famsa([unique_slices[h]], threads)[0]
+            for batch, future in zip(batches, futures):
+                msas.update(zip(batch, future.result()))
+    else:
+        for h in large + [h for batch in batches for h in batch]:
+            msas[h] = _align_slices_famsa([unique_slices[h]], threads)[0]
+    for h in missing:
+        _slice_msa_cache.put(h, msas[h])
+    return {key : msas[keys[key]] for key in slices}
+
+
+def schedule_slices(costs, threads):
+    """ Splits slices into large slices that are aligned one by one with all threads and batches of smaller slices
+        for single threaded worker calls. Batches have roughly equal costs but at least MIN_SLICE_BATCH_COST.
+    Args:
+        costs: Dictionary of slice costs.
+        threads: Number of workers.
+    Returns:
+        A list of large slices and a list of batches, i.e. lists of slices. Both in decreasing order of cost.
+    """
+    order = sorted(costs, key=lambda key: -costs[key])
+    total = sum(costs.values())
+    #a slice is large, if it would dominate the runtime of a single worker
+    large = [key for key in order if threads > 1 and costs[key] > total / threads]
+    small = [key for key in order if not key in large]
+    target = max(MIN_SLICE_BATCH_COST, sum(costs[key] for key in small) / (4*threads))
+    batches = []
+    batch_cost = target
+    for key in small:
+        if batch_cost >= target:
+            batches.append([])
+            batch_cost = 0
+        batches[-1].append(key)
+        batch_cost += costs[key]
+    return large, batches
+
+
+def _get_slice_cost(seqs):
+    return len(seqs) * sum(len(seq) for _,seq in seqs)
+
+
+def _get_msa_size(msa):
+    return sum(len(seq) for _,seq in msa)
+
+
+def _hash_slice(method, seqs):
+    h = hashlib.blake2b(method.encode(), digest_size=16)
+    for sid, seq in seqs:
+        h.update(sid.encode())
+        h.update(b"\0")
+        h.update(seq.encode())
+        h.update(b"\0")
+    return h.digest()
+
+
+def _align_slices_famsa(slices, threads):
     from pyfamsa import Aligner as FamsaAligner, Sequence as FamsaSequence
     aligner = FamsaAligner(threads = threads)
-    alignments = {}
-    for key, seqs in slices.items():
+    alignments = []
+    for seqs in slices:
         enc_seqs =  [FamsaSequence(sid.encode(), seq.encode()) for sid,seq in seqs]
         msa = aligner.align(enc_seqs)
-        alignments[key] = [(sequence.id.decode(), sequence.sequence.decode()) for sequence in msa]
-    return alignments
\ No newline at end of file
+        alignments.append([(sequence.id.decode(), sequence.sequence.decode()) for sequence in msa])
+    return alignments
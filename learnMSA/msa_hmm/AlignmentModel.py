@@ -7,14 +7,27 @@ from learnMSA.msa_hmm.SequenceDataset import SequenceDataset, AlignedDataset
 import learnMSA.msa_hmm.Configuration as config
 import learnMSA.msa_hmm.Training as train
 import learnMSA.msa_hmm.Viterbi as viterbi
+from learnMSA.msa_hmm.StateSequences import StateSequences, ModelStateSequences, get_dense_runs
 import learnMSA.msa_hmm.Priors as priors
 import learnMSA.msa_hmm.Transitioner as trans
 import learnMSA.msa_hmm.Emitter as emit
 import json
 import shutil
+import os
+import tempfile
+import itertools
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import string
+from Bio.AlignIO.PhylipIO import sanitize_name
 from packaging import version
 from pathlib import Path
 
+
+#Viterbi is not rerun for faulty sequences if more sequences are aligned
+MAX_SEQ_FIXED_VITERBI = 32000
         
 # utility class used in AlignmentModel storing useful information on a specific alignment
 class AlignmentMetaData():
@@ -47,6 +60,84 @@ class AlignmentMetaData():
                               np.sum(self.insertion_lens_total) + 
                               np.sum(self.unannotated_segment_lens_total) +
                               self.right_flank_len_total)
+
+
+class _MetaDataBuilder():
+    """ Collects the implicit alignments of batches of sequences that were decoded independently.
+        Batches can have different numbers of repeats. A sequence is padded with finished, empty repeats and 
+        empty unannotated segments at its right flank, exactly as if all sequences were decoded together.
+    Args:
+        num_seq: The number of sequences.
+        model_length: Number of match states.
+    """
+    def __init__(self, num_seq, model_length):
+        self.left_flank_len = np.zeros(num_seq, dtype=np.int16)
+        self.left_flank_start = np.zeros(num_seq, dtype=np.int16)
+        self.right_flank_len = np.zeros(num_seq, dtype=np.int16)
+        self.right_flank_start = np.zeros(num_seq, dtype=np.int16)
+        self.consensus = np.zeros((0, num_seq, model_length), dtype=np.int16)
+        self.insertion_lens = np.zeros((0, num_seq, model_length-1), dtype=np.int16)
+        self.insertion_start = np.zeros((0, num_seq, model_length-1), dtype=np.int16)
+        self.finished = np.zeros((0, num_seq), dtype=bool)
+        self.unannotated_segments_len = np.zeros((0, num_seq), dtype=np.int16)
+        self.unannotated_segments_start = np.zeros((0, num_seq), dtype=np.int16)
+
+
+    def add(self, rows, core_blocks, left_flank, right_flank, unannotated_segments):
+        """ Stores the decoded batch (as returned by AlignmentModel.decode) of the sequences in rows.
+        """
+        self._grow(len(core_blocks))
+        self.left_flank_len[rows], self.left_flank_start[rows] = left_flank
+        self.right_flank_len[rows], self.right_flank_start[rows] = right_flank
+        self.consensus[:, rows] = -1
+        self.insertion_lens[:, rows] = 0
+        self.insertion_start[:, rows] = -1
+        self.finished[:, rows] = True
+        self.unannotated_segments_len[:, rows] = 0
+        self.unannotated_segments_start[:, rows] = self.right_flank_start[rows]
+        for r, (C, IL, IS, f) in enumerate(core_blocks):
+            self.consensus[r, rows] = C
+            self.insertion_lens[r, rows] = IL
+            self.insertion_start[r, rows] = IS
+            self.finished[r, rows] = f
+        for r, (l, s) in enumerate(unannotated_segments):
+            self.unannotated_segments_len[r, rows] = l
+            self.unannotated_segments_start[r, rows] = s
+
+
+    def build(self, rows=None):
+        """ Returns AlignmentMetaData of the given rows (all by default, rows may repeat).
+        """
+        rows = np.arange(self.left_flank_len.size) if rows is None else rows
+        #repeats that only sequences overwritten later (e.g. by the rerun of faulty sequences) reached are dropped,
+        #a sequence has one repeat more than unannotated segments
+        num_repeats = 1 + np.amax(np.sum(~self.finished[:, rows], axis=0), initial=0)
+        core_blocks = [(C[rows], IL[rows], IS[rows], f[rows]) for C, IL, IS, f in 
+                        zip(self.consensus[:num_repeats], self.insertion_lens[:num_repeats], 
+                            self.insertion_start[:num_repeats], self.finished[:num_repeats])]
+        core_blocks[-1] = core_blocks[-1][:3] + (np.ones(rows.size, dtype=bool),)
+        num_segments = num_repeats-1
+        unannotated_segments = [(l[rows], s[rows]) for l, s in zip(self.unannotated_segments_len[:num_segments], 
+                                                                   self.unannotated_segments_start[:num_segments])]
+        return AlignmentMetaData(core_blocks, 
+                                 (self.left_flank_len[rows], self.left_flank_start[rows]), 
+                                 (self.right_flank_len[rows], self.right_flank_start[rows]), 
+                                 unannotated_segments)
+
+
+    def _grow(self, num_repeats):
+        # appends empty repeats to all sequences
+        new = num_repeats - self.consensus.shape[0]
+        if new <= 0:
+            return
+        n, c = self.consensus.shape[1:]
+        self.consensus = np.concatenate([self.consensus, -np.ones((new, n, c), dtype=np.int16)])
+        self.insertion_lens = np.concatenate([self.insertion_lens, np.zeros((new, n, c-1), dtype=np.int16)])
+        self.insertion_start = np.concatenate([self.insertion_start, -np.ones((new, n, c-1), dtype=np.int16)])
+        self.finished = np.concatenate([self.finished, np.ones((new, n), dtype=bool)])
+        self.unannotated_segments_len = np.concatenate([self.unannotated_segments_len, np.zeros((new, n), dtype=np.int16)])
+        self.unannotated_segments_start = np.concatenate([self.unannotated_segments_start, 
+                                                          np.stack([self.right_flank_start]*new)])
         
         
 class AlignedInsertions():
@@ -155,6 +246,8 @@ class AlignmentModel():
         model: A learnMSA model which internally might represent multiple pHMM models.
         gap_symbol: Character used to denote missing match positions.
         gap_symbol_insertions: Character used to denote insertions in other sequences.
+        streaming_decode: If true, Viterbi batches are decoded while they are computed and only the implicit alignment
+                        is kept. Otherwise, the state sequences of all sequences are stored before decoding.
     """
     def __init__(self, 
                  data : SequenceDataset, 
@@ -163,7 +256,8 @@ class AlignmentModel():
                  batch_size, 
                  model,
                  gap_symbol="-",
-                 gap_symbol_insertions="."):
+                 gap_symbol_insertions=".",
+                 streaming_decode=True):
         self.data = data
         self.batch_generator = batch_generator
         self.indices = indices
@@ -177,14 +271,22 @@ class AlignmentModel():
             if layer.name.startswith("msa_hmm_layer"):
                 encoder_out = model.layers[i].output
                 self.msa_hmm_layer = layer
-                self.encoder_model = tf.keras.Model(inputs=self.model.inputs, outputs=[encoder_out])
+                #encoders can output index sequences with lookup tables (see AncProbsLayer)
+                encoder_out = list(encoder_out) if isinstance(encoder_out, (tuple, list)) else [encoder_out]
+                self.encoder_model = tf.keras.Model(inputs=self.model.inputs, outputs=encoder_out)
         assert self.encoder_model is not None, "Can not find a MsaHmmLayer in the specified model."
         self.gap_symbol = gap_symbol
         self.gap_symbol_insertions = gap_symbol_insertions
+        self.streaming_decode = streaming_decode
         self.output_alphabet = np.array((list(data.get_alphabet_no_gap()) + 
                                         [gap_symbol] + 
                                         list(data.get_alphabet_no_gap().lower()) + 
                                         [gap_symbol_insertions, "$"]))
+        #lookup table from alignment codes to ASCII bytes, requires single character ASCII symbols
+        self.output_ascii = _get_ascii_table(self.output_alphabet)
+        #A2M and A3M prescribe the gap symbols
+        self.a2m_ascii = _get_ascii_table(list(data.get_alphabet_no_gap()) + ["-"] + 
+                                          list(data.get_alphabet_no_gap().lower()) + [".", "$"])
         self.metadata = {}
         self.num_models = self.msa_hmm_layer.cell.num_models
         self.length = self.msa_hmm_layer.cell.length
@@ -203,36 +305,79 @@ class AlignmentModel():
             cell_copy = self.msa_hmm_layer.cell.duplicate(models)
             
         cell_copy.build((self.num_models, None, None, self.msa_hmm_layer.cell.dim))
+        if self.streaming_decode:
+            self._build_alignment_streaming(models, cell_copy)
+            return
         state_seqs_max_lik = viterbi.get_state_seqs_max_lik(self.data,
                                                             self.batch_generator,
                                                             self.indices,
                                                             self.batch_size,
                                                             cell_copy,
                                                             models,
-                                                            self.encoder_model)
+                                                            self.encoder_model,
+                                                            run_length_encoded=True)
         state_seqs_max_lik = self._clean_up_viterbi_seqs(state_seqs_max_lik, models, cell_copy)
         for i,l,max_lik_seqs in zip(models, cell_copy.length, state_seqs_max_lik):
             decoded_data = AlignmentModel.decode(l,max_lik_seqs)
             self.metadata[i] = AlignmentMetaData(*decoded_data)
 
     def _clean_up_viterbi_seqs(self, state_seqs_max_lik, models, cell_copy):
-        #state_seqs_max_lik has shape (num_model, num_seq, L)
+        #state_seqs_max_lik are StateSequences of num_model models and num_seq sequences
         faulty_sequences = find_faulty_sequences(state_seqs_max_lik, cell_copy.length[0], self.data.seq_lens[self.indices])
         self.fixed_viterbi_seqs = faulty_sequences
         if faulty_sequences.size > 0:
             #repeat Viterbi with a masking that prevents certain transitions that can cause problems
             fixed_state_seqs = viterbi.get_state_seqs_max_lik(self.data,
                                                                 self.batch_generator,
-                                                                faulty_sequences,
+                                                                self.indices[faulty_sequences],
                                                                 self.batch_size,
                                                                 cell_copy,
                                                                 models,
                                                                 self.encoder_model,
-                                                                non_homogeneous_mask_func)
-            if state_seqs_max_lik.shape[-1] < fixed_state_seqs.shape[-1]:
-                state_seqs_max_like = np.pad(state_seqs_max_lik, ((0,0),(0,0),(0,fixed_state_seqs.shape[-1]-state_seqs_max_lik.shape[-1])), constant_values=2*cell_copy.length[0]+2)
-            state_seqs_max_lik[0,faulty_sequences,:fixed_state_seqs.shape[-1]] = fixed_state_seqs[0]
+                                                                non_homogeneous_mask_func,
+                                                                run_length_encoded=True)
+            state_seqs_max_lik.replace(faulty_sequences, fixed_state_seqs)
         return state_seqs_max_lik
+
+    def _build_alignment_streaming(self, models, cell_copy):
+        """ Computes the implicit alignment without storing all state sequences. 
+            Pass 1 decodes each Viterbi batch to insertion starts and lengths per sequence while the next batch is computed 
+            in a background thread. Faulty sequences are collected on the way and rerun with non_homogeneous_mask_func 
+            afterwards. The column totals are reduced when the metadata is finalized.
+        """
+        #decode each distinct sequence only once
+        unique_indices, _, inverse = self.data.get_unique_indices(self.indices)
+        builders = [_MetaDataBuilder(unique_indices.size, l) for l in cell_copy.length]
+        fix_faulty = self.indices.size <= MAX_SEQ_FIXED_VITERBI
+        faulty_sequences = []
+        def _decode_batches(rows, mask_func=None):
+            batches = viterbi.iter_state_seqs_max_lik(self.data, 
+                                                      self.batch_generator, 
+                                                      unique_indices[rows], 
+                                                      self.batch_size, 
+                                                      cell_copy, 
+                                                      models, 
+                                                      self.encoder_model, 
+                                                      mask_func)
+            for batch_rows, state_seqs_batch in _prefetch(batches):
+                batch_rows = rows[batch_rows]
+                for builder, l, max_lik_seqs in zip(builders, cell_copy.length, state_seqs_batch):
+                    builder.add(batch_rows, *AlignmentModel.decode(l, max_lik_seqs))
+                yield batch_rows, state_seqs_batch
+        for batch_rows, state_seqs_batch in _decode_batches(np.arange(unique_indices.size)):
+            if fix_faulty:
+                batch_lens = self.data.seq_lens[unique_indices[batch_rows]]
+                state_seqs_batch = StateSequences.from_dense(state_seqs_batch[:1], cell_copy.length[:1], batch_lens+1)
+                faulty = find_faulty_sequences(state_seqs_batch, cell_copy.length[0], batch_lens, limit=np.inf)
+                faulty_sequences.append(batch_rows[faulty])
+        faulty_sequences = np.unique(np.concatenate(faulty_sequences)) if len(faulty_sequences) > 0 else np.array([], dtype=np.int64)
+        if faulty_sequences.size > 0:
+            #repeat Viterbi with a masking that prevents certain transitions that can cause problems
+            for _ in _decode_batches(faulty_sequences, non_homogeneous_mask_func):
+                pass
+        self.fixed_viterbi_seqs = np.flatnonzero(np.isin(inverse, faulty_sequences))
+        for i, builder in zip(models, builders):
+            self.metadata[i] = builder.build(inverse)
         
     def to_string(self, model_index, batch_size=100000, add_block_sep=True, aligned_insertions : AlignedInsertions = AlignedInsertions()):
         """ Uses one model to decode an alignment and returns the sequences with gaps in a list.
@@ -245,19 +390,13 @@ class AlignmentModel():
             aligned_insertions: Can be used to override insertion metadata if insertions are aligned after the main procedure.
         """
         alignment_strings_all = []
-        n = self.indices.size
-        i = 0
-        while i < n:
-            batch_indices = np.arange(i, min(n, i+batch_size))
-            batch_alignment = self.get_batch_alignment(model_index, batch_indices, add_block_sep, aligned_insertions)
-            alignment_strings = self.batch_to_string(batch_alignment)
+        for alignment_strings in self._iter_batch_strings(model_index, batch_size, add_block_sep, aligned_insertions):
             alignment_strings_all.extend(alignment_strings)
-            i += batch_size
         return alignment_strings_all
     
     def to_file(self, filepath, model_index, batch_size=100000, add_block_sep=False, 
-                aligned_insertions : AlignedInsertions = AlignedInsertions(), format="fasta"):
-        """ Uses one model to decode an alignment and stores it in fasta file format. Currently no other output format is supported.
+                aligned_insertions : AlignedInsertions = AlignedInsertions(), format="fasta", line_width=None, threads=None):
+        """ Uses one model to decode an alignment and stores it in a file.
             The file is written batch wise. The memory required for this operation must be large enough to hold decode and store a single batch
             of aligned sequences but not the whole alignment.
         Args:
@@ -266,27 +405,88 @@ class AlignmentModel():
                         lower this if memory is sufficient to store the table-form alignment but GPU memory used for decoding a batch is limited.
             add_block_sep: If true, columns containing a special character are added to the alignment indicating domain boundaries.
             aligned_insertions: Can be used to override insertion metadata if insertions are aligned after the main procedure.
-            format: Output format. Important for large data: learnMSA is only able to stream fasta files. 
+            format: Output format. learnMSA streams fasta, a2m, a3m, stockholm, clustal, phylip, phylip-relaxed and phylip-sequential files. 
+                    A2M is fasta with "-" for deletions and "." for gaps in insertion columns. A3M omits the insertion gaps, 
+                    i.e. insertions are written inline and aligned_insertions has no effect.
+                    Interleaved formats (clustal, phylip, phylip-relaxed) are rearranged in a temporary file next to the output.
                     Other formats require a conversion, i.e. the whole alignment is stored in memory.
+            line_width: If set, sequences in fasta, a2m and a3m files are wrapped after this number of characters.
+            threads: Number of threads that render batches while previous batches are written. Defaults to at most 4.
         """
-        if format == "fasta": #streaming batches to file
+        if format in ["fasta", "a2m", "a3m"] or format in _streaming_writers:
+            #decode and prepare shared data in this thread, batches are rendered in parallel afterwards
+            if not model_index in self.metadata:
+                self._build_alignment([model_index])
+            self.data.get_encoded_buffer()
+        if format == "a3m": #only residues and deletions are rendered
+            render_batch = lambda batch_indices: self.get_batch_alignment_a3m(model_index, batch_indices)
+            format_batch = lambda batch_indices, batch_a3m: _format_fasta_ragged(
+                                                                self._get_fasta_headers(batch_indices),
+                                                                self.a2m_ascii[batch_a3m[0]], batch_a3m[1], line_width)
+            with open(filepath, "wb") as output_file:
+                for chunk in self._iter_batches(model_index, batch_size, False, aligned_insertions, format_batch, threads, render_batch):
+                    output_file.write(chunk)
+        elif format == "a2m":
+            format_batch = lambda batch_indices, batch_alignment: _format_fasta(
+                                                                    self._get_fasta_headers(batch_indices), 
+                                                                    self.a2m_ascii[batch_alignment], line_width)
+            with open(filepath, "wb") as output_file:
+                for chunk in self._iter_batches(model_index, batch_size, False, aligned_insertions, format_batch, threads):
+                    output_file.write(chunk)
+        elif format == "fasta": #streaming batches to file
+            if self.output_ascii is None:
+                format_batch = lambda batch_indices, batch_alignment: _format_fasta_strings(
+                                                                        self._get_fasta_headers(batch_indices), 
+                                                                        self.batch_to_string(batch_alignment), line_width)
+            else:
+                format_batch = lambda batch_indices, batch_alignment: _format_fasta(
+                                                                        self._get_fasta_headers(batch_indices), 
+                                                                        self.output_ascii[batch_alignment], line_width)
+            with open(filepath, "wb") as output_file:
+                for chunk in self._iter_batches(model_index, batch_size, add_block_sep, aligned_insertions, format_batch, threads):
+                    output_file.write(chunk)
+        elif format in _streaming_writers:
+            seq_ids = [self.data.seq_ids[i] for i in self.indices]
+            batches = self._iter_batch_strings(model_index, batch_size, add_block_sep, aligned_insertions, threads)
             with open(filepath, "w") as output_file:
-                n = self.indices.size
-                i = 0
-                while i < n:
-                    batch_indices = np.arange(i, min(n, i+batch_size))
-                    batch_alignment = self.get_batch_alignment(model_index, batch_indices, add_block_sep, aligned_insertions)
-                    alignment_strings = self.batch_to_string(batch_alignment)
-                    for s, seq_ind in zip(alignment_strings, batch_indices):
-                        seq_id = self.data.seq_ids[self.indices[seq_ind]]
-                        output_file.write(">"+seq_id+"\n")
-                        output_file.write(s+"\n")
-                    i += batch_size
+                _streaming_writers[format](output_file, seq_ids, batches, 
+                                           spill_dir=os.path.dirname(os.path.abspath(filepath)))
         else:
             msa = self.to_string(model_index, batch_size, add_block_sep, aligned_insertions)
             msa = [(self.data.seq_ids[self.indices[i]], msa[i]) for i in range(len(msa))]
             data = AlignedDataset(aligned_sequences=msa)
             data.write(filepath, format)
+
+    def _iter_batch_strings(self, model_index, batch_size, add_block_sep, aligned_insertions, threads=1):
+        """ Decodes the alignment batch wise and yields lists of aligned sequences as strings in the order of self.indices.
+        """
+        format_batch = lambda batch_indices, batch_alignment: self.batch_to_string(batch_alignment)
+        return self._iter_batches(model_index, batch_size, add_block_sep, aligned_insertions, format_batch, threads)
+
+    def _iter_batches(self, model_index, batch_size, add_block_sep, aligned_insertions, format_batch, threads=1, render_batch=None):
+        """ Renders the alignment batch wise and yields format_batch(batch_indices, batch_alignment) in the order of self.indices.
+            With more than one thread, the following batches are rendered and formatted on a thread pool.
+            render_batch(batch_indices) can replace the default rendering with get_batch_alignment.
+        """
+        def _render(batch_indices):
+            if render_batch is None:
+                batch_alignment = self.get_batch_alignment(model_index, batch_indices, add_block_sep, aligned_insertions)
+            else:
+                batch_alignment = render_batch(batch_indices)
+            return format_batch(batch_indices, batch_alignment)
+        n = self.indices.size
+        batches = (np.arange(i, min(n, i+batch_size)) for i in range(0, n, batch_size))
+        threads = min(4, os.cpu_count() or 1) if threads is None else threads
+        if threads <= 1:
+            for batch_indices in batches:
+                yield _render(batch_indices)
+        else:
+            if not model_index in self.metadata:
+                self._build_alignment([model_index])
+            yield from _ordered_map(_render, batches, threads)
+
+    def _get_fasta_headers(self, batch_indices):
+        return [(">"+self.data.seq_ids[i]+"\n").encode() for i in self.indices[batch_indices]]
     
     def get_batch_alignment(self, model_index, batch_indices, add_block_sep, aligned_insertions : AlignedInsertions = AlignedInsertions()):
         """ Returns a dense matrix representing a subset of sequences
@@ -299,68 +499,98 @@ class AlignmentModel():
             add_block_sep: If true, columns containing a special character are added to the alignment indicating domain boundaries.
             aligned_insertions: Can be used to override insertion metadata if insertions are aligned after the main procedure.
         """
+        template, rows, columns, residues = self._get_batch_scatter(model_index, batch_indices, add_block_sep, aligned_insertions)
+        return _render_block(template, batch_indices.size, rows, columns, residues)
+
+    def get_batch_alignment_a3m(self, model_index, batch_indices):
+        """ Returns a subset of sequences as specified by batch_indices in A3M layout, i.e. match columns 
+            with deletions and insertions inline without gap padding. Only the residues and the deletions of 
+            the batch are materialized, not the gapped insertion columns.
+        Args:
+            model_index: Specifies the model for decoding. Use a suitable criterion like loglik to decide for a model.
+            batch_indices: Sequence indices / indices of alignment rows.
+        Returns:
+            The concatenated rows as a flat vector of alignment codes and the length of each row.
+        """
+        template, rows, columns, residues = self._get_batch_scatter(model_index, batch_indices, False)
+        s = len(self.data.alphabet)
+        codes = residues + s * (template[columns] == 2*s-1)
+        #match columns of a row that hold no residue are deletions
+        match_columns = np.flatnonzero(template == s-1)
+        match_index = np.full(template.size, -1)
+        match_index[match_columns] = np.arange(match_columns.size)
+        is_match = match_index[columns] >= 0
+        occupied = np.zeros((batch_indices.size, match_columns.size), dtype=bool)
+        occupied[rows[is_match], match_index[columns[is_match]]] = True
+        deletion_rows, deletions = np.nonzero(~occupied)
+        rows = np.concatenate([rows, deletion_rows])
+        columns = np.concatenate([columns, match_columns[deletions]])
+        codes = np.concatenate([codes, np.full(deletions.size, s-1, dtype=codes.dtype)])
+        #residues of a row keep their order in the alignment
+        order = np.argsort(rows * template.size + columns, kind="stable")
+        return codes[order], np.bincount(rows, minlength=batch_indices.size)
+
+    def _get_batch_scatter(self, model_index, batch_indices, add_block_sep, aligned_insertions : AlignedInsertions = AlignedInsertions()):
+        """ Returns the gap template row of the alignment and the rows, columns and codes of the residues 
+            of a batch, see get_batch_alignment.
+        """
         if not model_index in self.metadata:
             self._build_alignment([model_index])
         data = self.metadata[model_index]
-        b = batch_indices.size
-        sequences = np.zeros((b, self.data.max_len), dtype=np.uint16) + (len(self.data.alphabet)-1)
-        for i,j in enumerate(batch_indices):
-            l = self.data.seq_lens[self.indices[j]]
-            sequences[i, :l] = self.data.get_encoded_seq(self.indices[j])
-        blocks = []  
-        if add_block_sep:
-            sep = np.zeros((b,1), dtype=np.uint16) + 2*len(self.data.alphabet)
-        left_flank_block = self.get_insertion_block(sequences, 
-                                               data.left_flank_len[batch_indices],
-                                               max(data.left_flank_len_total, aligned_insertions.ext_left_flank),
-                                               data.left_flank_start[batch_indices],
-                                               adjust_to_right=True,
-                                               custom_columns=aligned_insertions.get_custom_columns_left_flank(batch_indices))
-        blocks.append(left_flank_block)
+        #each block is a gap template row with the residues to scatter into it
+        blocks = []
+        sep = (np.array([2*len(self.data.alphabet)], dtype=np.uint8),) + (np.zeros(0, dtype=np.int64),)*3
+        blocks.append(self._scatter_insertion_block(data.left_flank_len[batch_indices],
+                                                    max(data.left_flank_len_total, aligned_insertions.ext_left_flank),
+                                                    data.left_flank_start[batch_indices],
+                                                    adjust_to_right=True,
+                                                    custom_columns=aligned_insertions.get_custom_columns_left_flank(batch_indices)))
         if add_block_sep:
             blocks.append(sep)
         for i in range(data.num_repeats):
             consensus = data.consensus[i]
             #remove columns consisting only of gaps
             is_non_empty = np.any(consensus != -1, axis=0)
-            ins_len = data.insertion_lens[i]
-            ins_start = data.insertion_start[i]
-            alignment_block = self.get_alignment_block(sequences, 
-                                                  consensus[batch_indices], 
-                                                  ins_len[batch_indices], 
-                                                  np.maximum(data.insertion_lens_total, aligned_insertions.ext_insertions)[i],
-                                                  ins_start[batch_indices],
-                                                  is_non_empty=is_non_empty,
-                                                  custom_columns=aligned_insertions.get_custom_columns_insertion(batch_indices, i))
-            blocks.append(alignment_block)
+            blocks.append(self._scatter_alignment_block(consensus[batch_indices], 
+                                                        data.insertion_lens[i][batch_indices], 
+                                                        np.maximum(data.insertion_lens_total, aligned_insertions.ext_insertions)[i],
+                                                        data.insertion_start[i][batch_indices],
+                                                        is_non_empty=is_non_empty,
+                                                        custom_columns=aligned_insertions.get_custom_columns_insertion(batch_indices, i)))
             if add_block_sep:
                 blocks.append(sep)
             if i < data.num_repeats-1:
-                unannotated_segment_l = data.unannotated_segments_len[i]
-                unannotated_segment_s = data.unannotated_segments_start[i]
-                unannotated_block = self.get_insertion_block(sequences, 
-                                                        unannotated_segment_l[batch_indices],
-                                                        np.maximum(data.unannotated_segment_lens_total, aligned_insertions.ext_unannotated)[i],
-                                                        unannotated_segment_s[batch_indices],
-                                                        custom_columns=aligned_insertions.get_custom_columns_unannotated_segment(batch_indices, i))
-                blocks.append(unannotated_block)
+                blocks.append(self._scatter_insertion_block(data.unannotated_segments_len[i][batch_indices],
+                                                            np.maximum(data.unannotated_segment_lens_total, aligned_insertions.ext_unannotated)[i],
+                                                            data.unannotated_segments_start[i][batch_indices],
+                                                            custom_columns=aligned_insertions.get_custom_columns_unannotated_segment(batch_indices, i)))
                 if add_block_sep:
                     blocks.append(sep)
-        right_flank_block = self.get_insertion_block(sequences, 
-                                               data.right_flank_len[batch_indices],
-                                               max(data.right_flank_len_total, aligned_insertions.ext_right_flank),
-                                               data.right_flank_start[batch_indices],
-                                               custom_columns=aligned_insertions.get_custom_columns_right_flank(batch_indices))
-        blocks.append(right_flank_block)
-        batch_alignment = np.concatenate(blocks, axis=1)
-        return batch_alignment
+        blocks.append(self._scatter_insertion_block(data.right_flank_len[batch_indices],
+                                                    max(data.right_flank_len_total, aligned_insertions.ext_right_flank),
+                                                    data.right_flank_start[batch_indices],
+                                                    custom_columns=aligned_insertions.get_custom_columns_right_flank(batch_indices)))
+        #residues are read from the flat encoded buffer, no padded sequence matrix is required
+        buffer, offsets = self.data.get_encoded_buffer()
+        seq_offsets = offsets[self.indices[batch_indices]]
+        block_widths = [template.size for template,*_ in blocks]
+        block_starts = np.cumsum(block_widths) - block_widths
+        template = np.concatenate([template for template,*_ in blocks])
+        rows = np.concatenate([rows for _,rows,_,_ in blocks])
+        positions = np.concatenate([positions for _,_,positions,_ in blocks])
+        columns = np.concatenate([columns+start for (_,_,_,columns),start in zip(blocks, block_starts)])
+        return template, rows, columns, buffer[seq_offsets[rows] + positions]
     
     def batch_to_string(self, batch_alignment):
         """ Converts a dense matrix into string format.
         """
-        alignment_arr = self.output_alphabet[batch_alignment]
-        alignment_strings = [''.join(s) for s in alignment_arr]
-        return alignment_strings
+        if self.output_ascii is None:
+            alignment_arr = self.output_alphabet[batch_alignment]
+            return [''.join(s) for s in alignment_arr]
+        #map to ASCII codes and slice the decoded buffer
+        width = batch_alignment.shape[1]
+        alignment_str = self.output_ascii[batch_alignment].tobytes().decode("ascii")
+        return [alignment_str[i*width:(i+1)*width] for i in range(batch_alignment.shape[0])]
     
     def compute_loglik(self, max_seq=200000):
         """ Computes the logarithmic likelihood for each underlying model.
@@ -376,15 +606,22 @@ class AlignmentModel():
             ll_subset = ll_subset[:max_seq]
             ll_subset = np.sort(ll_subset)
         else:
-            #use the sorted indices for optimal length distributions in batches
-            ll_subset = np.array([i for l,i in sorted(zip(self.data.seq_lens, range(self.data.num_seq)))])
-        ds = train.make_dataset(ll_subset, 
+            ll_subset = np.arange(self.data.num_seq)
+        #each distinct sequence is scored only once and weighted by its number of occurences
+        unique_subset, counts, _ = self.data.get_unique_indices(ll_subset)
+        #use the sorted indices for optimal length distributions in batches
+        order = np.argsort(self.data.seq_lens[unique_subset], kind="stable")
+        ds = train.make_dataset(unique_subset[order], 
                                 self.batch_generator,
                                 self.batch_size, 
                                 shuffle=False)
+        counts = counts[order]
         loglik = np.zeros((self.msa_hmm_layer.cell.num_models))
+        i = 0
         for x, _ in ds:
-            loglik += np.sum(self.model(x)[0], axis=0)
+            batch_loglik = self.model(x)[0].numpy()
+            loglik += np.sum(batch_loglik * counts[i:i+batch_loglik.shape[0], np.newaxis], axis=0)
+            i += batch_loglik.shape[0]
         loglik /= ll_subset.size
         return loglik
     
@@ -593,7 +830,8 @@ class AlignmentModel():
             from most likely state sequences.
         Args: 
             model_length: Number of match states (length of the consensus sequence).
-            state_seqs_max_lik: A tensor with the most likeli state sequences. Shape: (num_seq, L)
+            state_seqs_max_lik: A tensor with the most likeli state sequences of shape (num_seq, L) or ModelStateSequences.
+                                The decoding takes time proportional to the number of runs and match states.
         Returns:
             core_blocks: Representation of the consensus. 
             left_flank:
@@ -602,17 +840,52 @@ class AlignmentModel():
         """
         n = state_seqs_max_lik.shape[0]
         c = model_length #alias for code readability
-        indices = np.zeros(n, np.int16) # active positions in the sequence
-        left_flank = cls.decode_flank(state_seqs_max_lik, 0, indices) 
-        core_blocks = []
-        unannotated_segments = []
-        while True:    
-            C, IL, IS, finished = cls.decode_core(model_length, state_seqs_max_lik, indices)
-            core_blocks.append((C, IL, IS, finished))
-            if np.all(finished):
-                break
-            unannotated_segments.append( cls.decode_flank(state_seqs_max_lik, 2*c, indices) )
-        right_flank = cls.decode_flank(state_seqs_max_lik, 2*c+1, indices) 
+        #the path of each sequence is LF* (core C+)* core R* T+ where a core block is a sequence of match and insert states,
+        #all quantities are derived from runs of states (see StateSequences) rather than position by position
+        if isinstance(state_seqs_max_lik, ModelStateSequences):
+            states, starts, rows, lens = state_seqs_max_lik.get_runs(return_lengths=True)
+        else:
+            states, starts, rows, lens = get_dense_runs(state_seqs_max_lik, model_length)
+        states = states.astype(np.int64)
+        is_match = (states > 0) & (states < c+1)
+        is_insert = (states >= c+1) & (states < 2*c)
+        is_unannotated = (states == 2*c)
+        is_at_end = (states == 2*c+1) | (states == 2*c+2)
+        #index of the core block of each run, i.e. the number of preceding unannotated runs in the same sequence
+        num_unannotated = np.bincount(rows[is_unannotated], minlength=n)
+        block = np.cumsum(is_unannotated) - is_unannotated - (np.cumsum(num_unannotated) - num_unannotated)[rows]
+        num_blocks = np.amax(num_unannotated)+1 if n > 0 else 1
+        #right flanks start at the first run of the right flank or terminal state, the decoding stops there
+        right_flank_start = np.bincount(rows, weights=lens, minlength=n).astype(np.int16)
+        end_rows, first_end = np.unique(rows[is_at_end], return_index=True)
+        right_flank_start[end_rows] = starts[is_at_end][first_end]
+        right_flank_len = np.zeros(n, dtype=np.int16)
+        is_right_flank = states == 2*c+1
+        right_flank_len[rows[is_right_flank]] = lens[is_right_flank]
+        left_flank_len = np.zeros(n, dtype=np.int16)
+        is_left_flank = (states == 0) & (starts == 0)
+        left_flank_len[rows[is_left_flank]] = lens[is_left_flank]
+        #consensus columns, each run of consecutive match states is expanded to its positions
+        consensus = -np.ones((num_blocks, n, c), dtype=np.int16)
+        match_runs = np.flatnonzero(is_match)
+        match_lens = lens[match_runs]
+        match_pos = np.repeat(match_runs, match_lens)
+        offsets = np.arange(match_pos.size) - np.repeat(np.cumsum(match_lens) - match_lens, match_lens)
+        consensus[block[match_pos], rows[match_pos], states[match_pos]-1+offsets] = starts[match_pos]+offsets
+        insertion_lens = np.zeros((num_blocks, n, c-1), dtype=np.int16)
+        insertion_start = -np.ones((num_blocks, n, c-1), dtype=np.int16)
+        insertion_lens[block[is_insert], rows[is_insert], states[is_insert]-c-1] = lens[is_insert]
+        insertion_start[block[is_insert], rows[is_insert], states[is_insert]-c-1] = starts[is_insert]
+        finished = np.arange(num_blocks)[:,np.newaxis] >= num_unannotated[np.newaxis]
+        #sequences with fewer repeats have empty unannotated segments at the start of their right flank
+        unannotated_len = np.zeros((num_blocks-1, n), dtype=np.int16)
+        unannotated_start = np.stack([right_flank_start]*(num_blocks-1)) if num_blocks > 1 else np.zeros((0, n), dtype=np.int16)
+        unannotated_len[block[is_unannotated], rows[is_unannotated]] = lens[is_unannotated]
+        unannotated_start[block[is_unannotated], rows[is_unannotated]] = starts[is_unannotated]
+        core_blocks = list(zip(consensus, insertion_lens, insertion_start, finished))
+        left_flank = (left_flank_len, np.zeros(n, dtype=np.int16))
+        right_flank = (right_flank_len, right_flank_start)
+        unannotated_segments = list(zip(unannotated_len, unannotated_start))
         return core_blocks, left_flank, right_flank, unannotated_segments
 
 
@@ -620,72 +893,87 @@ class AlignmentModel():
     def get_insertion_block(cls, sequences, lens, maxlen, starts, adjust_to_right=False, custom_columns=None):
         """ Constructs one insertion block from an implicitly represented alignment.
         Args: 
+            sequences: Encoded sequences. Shape (n, L)
+            lens: Insertion lengths. Shape (n)
+            maxlen: Width of the block.
+            starts: Insertion starts. Shape (n)
+            adjust_to_right: If true, insertions are aligned to the right end of the block.
+            custom_columns: Optional columns of the inserted residues. Shape (n, k)
         Returns:
+            The block with lower case residues. Shape (n, maxlen)
         """
-        n = sequences.shape[0]
-        A = np.arange(n)
-        s = len(SequenceDataset.alphabet)
-        block = np.zeros((n, maxlen), dtype=np.uint8) + s - 1
-        count_down_lens = np.copy(lens)
-        active = count_down_lens > 0
-        i = 0
-        columns = np.stack([np.arange(maxlen)]*n) 
-        if custom_columns is not None:
-            columns[:, :custom_columns.shape[1]] = custom_columns
-        while np.any(active):
-            aa = sequences[A[active], starts[active] + i]
-            block[active, columns[active,i]] = aa
-            count_down_lens -= 1
-            active = count_down_lens > 0
-            i += 1
-        if adjust_to_right and custom_columns is None:
-            block_right_aligned = np.zeros_like(block) + s - 1
-            for i in range(maxlen):
-                
-                block_right_aligned[A, (maxlen-lens+i)%maxlen] = block[:, i]
-            block = block_right_aligned
-        block += s #lower case
-        return block
+        template, rows, positions, columns = cls._scatter_insertion_block(lens, maxlen, starts, adjust_to_right, custom_columns)
+        return _render_block(template, sequences.shape[0], rows, columns, sequences[rows, positions])
 
 
     @classmethod
     def get_alignment_block(cls, sequences, consensus, ins_len, ins_len_total, ins_start, is_non_empty=None, custom_columns=None):
         """ Constructs one core model hit block from an implicitly represented alignment.
         Args: 
+            sequences: Encoded sequences. Shape (n, L)
+            consensus: Positions of the residues aligned to the match states or -1. Shape (n, model_length)
+            ins_len: Insertion lengths. Shape (n, model_length-1)
+            ins_len_total: Width of each insertion. Shape (model_length-1)
+            ins_start: Insertion starts. Shape (n, model_length-1)
+            is_non_empty: Optional boolean vector. Match columns that are false are removed. Shape (model_length)
+            custom_columns: Optional list with None or the columns of the inserted residues per insertion. 
         Returns:
+            The block with upper case residues in match columns and lower case residues in insertion columns.
         """
-        A = np.arange(sequences.shape[0])
-        length = consensus.shape[1] + np.sum(ins_len_total)
-        block = np.zeros((sequences.shape[0], length), dtype=np.uint8) + len(SequenceDataset.alphabet) - 1
-        i = 0
-        columns_to_remove = [] #track empty columns to be removed later
-        for c in range(consensus.shape[1]-1):
-            column = consensus[:,c]
-            ins_l = ins_len[:,c]
-            ins_l_total = ins_len_total[c]
-            ins_s = ins_start[:,c]
-            #one column
-            no_gap = column != -1
-            block[no_gap,i] = sequences[A[no_gap],column[no_gap]]
-            #is this column empty in ALL batches? if yes, mark for removal
-            if is_non_empty is not None and not is_non_empty[c]:
-                columns_to_remove.append(i)
-            i += 1
-            #insertion
-            block[:,i:i+ins_l_total] = cls.get_insertion_block(sequences,
-                                                           ins_l,
-                                                           ins_l_total, 
-                                                           ins_s, 
-                                                           custom_columns = custom_columns[c] if custom_columns is not None else None)
-            i += ins_l_total
-        #final column
-        no_gap = consensus[:,-1] != -1
-        block[no_gap,i] = sequences[A[no_gap],consensus[:,-1][no_gap]]
-        if is_non_empty is not None and not is_non_empty[-1]:
-            columns_to_remove.append(i)
-        #remove columns that are empty in ALL batches
-        block = np.delete(block, columns_to_remove, axis=1)
-        return block
+        template, rows, positions, columns = cls._scatter_alignment_block(consensus, ins_len, ins_len_total, ins_start, is_non_empty, custom_columns)
+        return _render_block(template, sequences.shape[0], rows, columns, sequences[rows, positions])
+
+
+    @classmethod
+    def _scatter_insertion_block(cls, lens, maxlen, starts, adjust_to_right=False, custom_columns=None):
+        """ Computes the output column of each residue of an insertion block.
+        Returns:
+            template: Row of gap symbols of the block.
+            rows, positions, columns: Row, position in the sequence and column in the block of each residue.
+        """
+        s = len(SequenceDataset.alphabet)
+        template = np.zeros(maxlen, dtype=np.uint8) + 2*s - 1
+        rows, positions, columns = _expand_segments(lens, starts, custom_columns)
+        if adjust_to_right and custom_columns is None:
+            columns += (maxlen - lens.astype(np.int64))[rows]
+        return template, rows, positions, columns
+
+
+    @classmethod
+    def _scatter_alignment_block(cls, consensus, ins_len, ins_len_total, ins_start, is_non_empty=None, custom_columns=None):
+        """ Computes the output column of each residue of a core block from the consensus indices and 
+            the cumulative insertion widths.
+        Returns:
+            template: Row of gap symbols of the block.
+            rows, positions, columns: Row, position in the sequence and column in the block of each residue.
+        """
+        s = len(SequenceDataset.alphabet)
+        n, c = consensus.shape
+        keep = np.ones(c, dtype=bool) if is_non_empty is None else np.asarray(is_non_empty, dtype=bool)
+        #match columns and insertions alternate, empty match columns have width 0
+        widths = np.zeros(2*c-1, dtype=np.int64)
+        widths[0::2] = keep
+        widths[1::2] = ins_len_total
+        block_columns = np.cumsum(widths) - widths
+        match_columns, insertion_columns = block_columns[0::2], block_columns[1::2]
+        template = np.zeros(np.sum(widths), dtype=np.uint8) + 2*s - 1
+        template[match_columns[keep]] = s - 1
+        match_rows, match_states = np.nonzero((consensus != -1) & keep)
+        rows, positions, columns = [match_rows], [consensus[match_rows, match_states]], [match_columns[match_states]]
+        if c > 1:
+            if custom_columns is None:
+                #all insertions at once, segments are ordered by rows and then by insertion states
+                segments, ins_positions, ins_columns = _expand_segments(ins_len.flatten(), ins_start.flatten())
+                rows.append(segments // (c-1))
+                positions.append(ins_positions)
+                columns.append(insertion_columns[segments % (c-1)] + ins_columns)
+            else:
+                for i in range(c-1):
+                    ins_rows, ins_positions, ins_columns = _expand_segments(ins_len[:,i], ins_start[:,i], custom_columns[i])
+                    rows.append(ins_rows)
+                    positions.append(ins_positions)
+                    columns.append(insertion_columns[i] + ins_columns)
+        return template, np.concatenate(rows), np.concatenate(positions).astype(np.int64), np.concatenate(columns)
 
     
 @tf.function
@@ -726,23 +1014,306 @@ def one_hot_set(indices, d, dtype):
     return tf.reduce_sum(tf.one_hot(indices, d, dtype=dtype), axis=0)
 
 
-def find_faulty_sequences(state_seqs_max_lik, model_length, seq_lens, limit=32000):
-    if state_seqs_max_lik.shape[1] > limit:
+def find_faulty_sequences(state_seqs_max_lik, model_length, seq_lens, limit=MAX_SEQ_FIXED_VITERBI):
+    """ Returns an array of sequences indices for that Viterbi should be rerun with restrictions, i.e.
+        sequences of the first model that enter the unannotated segment from a match state although the remaining 
+        match states suffice to align the remaining residues without a repeat.
+    Args:
+        state_seqs_max_lik: StateSequences or a dense array of shape (num_model, num_seq, L).
+        model_length: The length of the first model.
+        seq_lens: The sequence lengths.
+        limit: No sequences are returned if there are more than limit sequences.
+    """
+    if not isinstance(state_seqs_max_lik, StateSequences):
+        state_seqs_max_lik = StateSequences.from_dense(state_seqs_max_lik, [model_length]*len(state_seqs_max_lik))
+    if state_seqs_max_lik.num_seq > limit:
         return np.array([], dtype=np.int32)
+    #operate on runs, a run of unannotated states starts where the previous run of the same sequence ends
+    C = 2 * model_length
+    run_states, run_starts, run_rows = state_seqs_max_lik.get_runs(0)
+    run_states = run_states.astype(np.int64)
+    is_match_run = (run_states > 0) & (run_states < model_length+1)
+    C_state_starts = (run_states[1:] == C) & (run_rows[1:] == run_rows[:-1])
+    previous_state = run_states[:-1] + is_match_run[:-1] * (run_starts[1:] - run_starts[:-1] - 1)
+    previous_is_match = is_match_run[:-1]
+    #there are enough match states to align without repeat
+    remaining_matches = model_length - previous_state
+    remaining_residues = seq_lens[run_rows[1:]] - run_starts[1:]
+    enough_matches = remaining_matches >= remaining_residues
+    return np.unique(run_rows[1:][C_state_starts & previous_is_match & enough_matches])
+
+
+def _expand_segments(lens, starts, custom_columns=None):
+    """ Expands segments of consecutive residues to the residues they contain.
+    Args:
+        lens: Segment lengths. Shape (n)
+        starts: Segment starts. Shape (n)
+        custom_columns: Optional columns of the first k residues of each segment. Shape (n, k)
+    Returns:
+        The segment, the position in the sequence and the column relative to the segment of each residue.
+    """
+    lens = np.asarray(lens, dtype=np.int64)
+    segments = np.repeat(np.arange(lens.size), lens)
+    columns = np.arange(segments.size) - np.repeat(np.cumsum(lens) - lens, lens)
+    positions = np.asarray(starts, dtype=np.int64)[segments] + columns
+    if custom_columns is not None and custom_columns.shape[1] > 0:
+        k = custom_columns.shape[1]
+        columns = np.where(columns < k, custom_columns[segments, np.minimum(columns, k-1)], columns)
+    return segments, positions, columns
+
+
+def _get_ascii_table(symbols):
+    # lookup table from alignment codes to ASCII bytes or None if not all symbols are single ASCII characters
+    if all(len(x) == 1 and x.isascii() for x in symbols):
+        return np.frombuffer("".join(symbols).encode("ascii"), dtype=np.uint8)
+    return None
+
+
+def _render_block(template, n, rows, columns, residues):
+    """ Writes residues into n copies of a template row of gap symbols with a single scatter. 
+        Residues in insertion columns are written in lower case.
+    """
+    s = len(SequenceDataset.alphabet)
+    block = np.tile(template, (n, 1))
+    block[rows, columns] = residues + s * (template[columns] == 2*s-1)
+    return block
+
+
+def _format_fasta(headers, alignment_ascii, line_width=None):
+    """ Formats a batch of aligned sequences in fasta format.
+    Args:
+        headers: Header lines as bytes (including ">" and the line break).
+        alignment_ascii: ASCII codes of the aligned sequences. Shape (b, alignment_len)
+        line_width: If set, sequences are wrapped after this number of characters.
+    Returns:
+        The formatted batch as bytes.
+    """
+    b, alignment_len = alignment_ascii.shape
+    width = line_width if line_width else max(alignment_len, 1)
+    num_lines = max(1, -(-alignment_len // width))
+    #residue j is shifted by the line breaks before it, all remaining positions are line breaks
+    columns = np.arange(alignment_len)
+    rows = np.zeros((b, alignment_len + num_lines), dtype=np.uint8) + ord("\n")
+    rows[:, columns + columns // width] = alignment_ascii
+    row_len = rows.shape[1]
+    buffer = memoryview(rows.tobytes())
+    return b"".join(itertools.chain.from_iterable(zip(headers, (buffer[i*row_len:(i+1)*row_len] for i in range(b)))))
+
+
+def _format_fasta_ragged(headers, alignment_ascii, row_lens, line_width=None):
+    """ Formats a batch of sequences of different lengths in fasta format.
+    Args:
+        headers: Header lines as bytes (including ">" and the line break).
+        alignment_ascii: ASCII codes of the concatenated rows.
+        row_lens: The length of each row.
+        line_width: If set, sequences are wrapped after this number of characters.
+    Returns:
+        The formatted batch as bytes.
+    """
+    row_lens = np.asarray(row_lens, dtype=np.int64)
+    if line_width:
+        num_lines = np.maximum(1, -(-row_lens // line_width))
     else:
-        # Returns an array of sequences indices for that Viterbi should be rerun with restrictions
-        C = 2 * model_length
-        C_state = state_seqs_max_lik == C
-        prev_C_state = np.roll(C_state, 1, axis=2)
-        prev_C_state[:,:,0] = False
-        C_state_starts = C_state & ~prev_C_state
-        previous_state = np.roll(state_seqs_max_lik, 1, axis=2).astype(np.int32)
-        previous_state[:,:,0] = -1
-        previous_is_match = (previous_state > 0) & (previous_state < model_length+1)
-        #there are enough match states to align without repeat
-        remaining_matches = model_length - previous_state
-        remaining_residues = seq_lens[np.newaxis,:,np.newaxis] - np.arange(state_seqs_max_lik.shape[-1])[np.newaxis,np.newaxis,:]
-        enough_matches = remaining_matches >= remaining_residues
-        faulty_sequences = np.any(C_state_starts & previous_is_match & enough_matches, axis=-1)
-        faulty_sequences = np.argwhere(faulty_sequences[0])[:,0]
-        return faulty_sequences
\ No newline at end of file
+        num_lines = np.ones_like(row_lens)
+    row_starts = np.cumsum(row_lens) - row_lens
+    out_lens = row_lens + num_lines
+    out_starts = np.cumsum(out_lens) - out_lens
+    #residue j of a row is shifted by the line breaks before it, all remaining positions are line breaks
+    row_of = np.repeat(np.arange(row_lens.size), row_lens)
+    j = np.arange(row_of.size) - row_starts[row_of]
+    if line_width:
+        j += j // line_width
+    out = np.zeros(np.sum(out_lens), dtype=np.uint8) + ord("\n")
+    out[out_starts[row_of] + j] = alignment_ascii
+    buffer = memoryview(out.tobytes())
+    return b"".join(itertools.chain.from_iterable(zip(headers, (buffer[a:a+n] for a,n in zip(out_starts, out_lens)))))
+
+
+def _format_fasta_strings(headers, alignment_strings, line_width=None):
+    # fallback of _format_fasta for symbols that are not single ASCII characters
+    chunks = []
+    for header, s in zip(headers, alignment_strings):
+        chunks.append(header)
+        width = line_width if line_width else max(len(s), 1)
+        lines = [s[i:i+width] for i in range(0, len(s), width)] or [""]
+        chunks.append(("\n".join(lines)+"\n").encode())
+    return b"".join(chunks)
+
+
+def _ordered_map(func, items, threads):
+    """ Applies func to the items on a thread pool and yields the results in order. 
+        At most 2*threads items are processed ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2*threads:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def _prefetch(iterable, buffer_size=2):
+    """ Consumes an iterable in a background thread and yields its items. The producer runs ahead of the consumer
+        by at most buffer_size items, so both can overlap while memory stays bounded.
+    """
+    items = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    end = object()
+    def _put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def _produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not _put((item, None)):
+                    return
+            _put((end, None))
+        except BaseException as e:
+            _put((end, e))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+
+# Streaming writers for alignment formats. Each one produces the same output as Biopython's writer for the format
+# (when called with the records learnMSA would pass), but only needs a single batch of aligned sequences in memory.
+# batches is an iterable of lists of aligned sequences as strings, seq_ids contains the IDs of all rows in the same order.
+
+def _write_stockholm(output_file, seq_ids, batches, spill_dir=None):
+    output_file.write("# STOCKHOLM 1.0\n")
+    output_file.write("#=GF SQ %i\n" % len(seq_ids))
+    for seq_id, s in zip(seq_ids, itertools.chain.from_iterable(batches)):
+        seq_name = seq_id.replace(" ", "_")
+        output_file.write(f"{seq_name} {s}\n")
+        if seq_id:
+            output_file.write(f"#=GS {seq_name} AC {seq_id}\n")
+    output_file.write("//\n")
+
+
+def _write_clustal(output_file, seq_ids, batches, spill_dir=None):
+    names = [seq_id[0:30].replace(" ", "_").ljust(36) for seq_id in seq_ids]
+    with tempfile.TemporaryFile(dir=spill_dir) as spill_file:
+        alignment_len, layout = _spill_column_blocks(spill_file, batches, _BLOCK_WIDTH)
+        output_file.write("CLUSTAL X (1.81) multiple sequence alignment\n\n\n")
+        for block in range(0, alignment_len, _BLOCK_WIDTH):
+            for name, s in zip(names, _read_column_block(spill_file, layout, alignment_len, block, _BLOCK_WIDTH)):
+                output_file.write(name + s + "\n")
+            output_file.write("\n")
+        output_file.write("\n")
+
+
+def _write_phylip(output_file, seq_ids, batches, spill_dir=None, id_width=10):
+    names = _get_phylip_names(seq_ids, id_width)
+    with tempfile.TemporaryFile(dir=spill_dir) as spill_file:
+        alignment_len, layout = _spill_column_blocks(spill_file, _check_phylip_batches(batches), _BLOCK_WIDTH)
+        output_file.write(" %i %s\n" % (len(seq_ids), alignment_len))
+        for block in range(0, alignment_len, _BLOCK_WIDTH):
+            if block > 0:
+                output_file.write("\n")
+            for name, s in zip(names, _read_column_block(spill_file, layout, alignment_len, block, _BLOCK_WIDTH)):
+                output_file.write(name[:id_width].ljust(id_width) if block == 0 else " " * id_width)
+                # sub-blocks of 10 residues, mirrors Biopython's output including its handling of the last sub-block
+                for i in range(0, _BLOCK_WIDTH, 10):
+                    output_file.write(" " + s[i:i+10])
+                    if block + i + 10 > alignment_len:
+                        break
+                output_file.write("\n")
+
+
+def _write_phylip_relaxed(output_file, seq_ids, batches, spill_dir=None):
+    for seq_id in seq_ids:
+        name = seq_id.strip()
+        if any(c in name for c in string.whitespace):
+            raise ValueError(f"Whitespace not allowed in identifier: {name}")
+    id_width = max(len(seq_id.strip()) for seq_id in seq_ids) + 1
+    _write_phylip(output_file, seq_ids, batches, spill_dir, id_width)
+
+
+def _write_phylip_sequential(output_file, seq_ids, batches, spill_dir=None, id_width=10):
+    names = _get_phylip_names(seq_ids, id_width)
+    batches = _check_phylip_batches(batches)
+    first_batch = next(batches, None)
+    if first_batch is None or len(first_batch) == 0 or len(first_batch[0]) == 0:
+        raise ValueError("Non-empty sequences are required")
+    output_file.write(" %i %s\n" % (len(seq_ids), len(first_batch[0])))
+    for name, s in zip(names, itertools.chain.from_iterable(itertools.chain([first_batch], batches))):
+        output_file.write(name[:id_width].ljust(id_width))
+        output_file.write(s)
+        output_file.write("\n")
+
+
+def _get_phylip_names(seq_ids, id_width):
+    names = [sanitize_name(seq_id, id_width) for seq_id in seq_ids]
+    unique_names = set()
+    for name, seq_id in zip(names, seq_ids):
+        if name in unique_names:
+            raise ValueError("Repeated name %r (originally %r), possibly due to truncation" % (name, seq_id))
+        unique_names.add(name)
+    return names
+
+
+def _check_phylip_batches(batches):
+    for alignment_strings in batches:
+        for s in alignment_strings:
+            if "." in s:
+                raise ValueError("PHYLIP format no longer allows dots in sequence")
+        yield alignment_strings
+
+
+def _spill_column_blocks(spill_file, batches, block_width):
+    """ Writes batches of aligned sequences to a binary file such that the rows of each batch are stored 
+        block-wise with block_width columns per block.
+    Returns:
+        The alignment length and a list with the file offset and the number of rows of each batch.
+    """
+    alignment_len = 0
+    layout = []
+    for alignment_strings in batches:
+        alignment_len = len(alignment_strings[0])
+        layout.append((spill_file.tell(), len(alignment_strings)))
+        for start in range(0, alignment_len, block_width):
+            spill_file.write("".join(s[start:start+block_width] for s in alignment_strings).encode())
+    if alignment_len == 0:
+        raise ValueError("Non-empty sequences are required")
+    return alignment_len, layout
+
+
+def _read_column_block(spill_file, layout, alignment_len, start, block_width):
+    """ Yields the columns start to start+block_width of all rows from a file written by _spill_column_blocks.
+    """
+    width = min(block_width, alignment_len - start)
+    for offset, num_rows in layout:
+        spill_file.seek(offset + num_rows * start)
+        rows = spill_file.read(num_rows * width).decode()
+        for i in range(num_rows):
+            yield rows[i*width:(i+1)*width]
+
+
+_BLOCK_WIDTH = 50
+_streaming_writers = {"stockholm" : _write_stockholm,
+                      "clustal" : _write_clustal,
+                      "phylip" : _write_phylip,
+                      "phylip-relaxed" : _write_phylip_relaxed,
+                      "phylip-sequential" : _write_phylip_sequential}
@@ -31,7 +31,53 @@ def make_rate_matrix(exchangeabilities, equilibrium, epsilon=1e-16):
     Q /= tf.maximum(mue, epsilon)
     return Q
     
-def make_anc_probs(sequences, exchangeabilities, equilibrium, tau, equilibrium_sample=False, transposed=False):
+def make_reversible_transition_matrices(Q, equilibrium, tau):
+    """Computes P = e^(tau*Q) for time-reversible rate matrices. Since D^(1/2) Q D^(-1/2) is symmetric 
+        for D = diag(equilibrium), each rate matrix is eigendecomposed once and P(tau) = V diag(e^(tau*lambda)) V^T
+        only requires a diagonal scaling per evolutionary time.
+    Args:
+        Q: Rate matrices in detailed balance with the equilibrium. Shape: (num_model, k, s, s)
+        equilibrium: Positive equilibrium distributions. Shape: (num_model, k, s)
+        tau: Evolutionary times. Shape: (num_model, b, k) or (num_model, b, 1)
+    Returns:
+        Transition matrices. Output shape: (num_model, b, k, s, s)
+    """
+    sqrt_p = tf.sqrt(equilibrium)
+    S = Q * tf.expand_dims(sqrt_p, -1) / tf.expand_dims(sqrt_p, -2)
+    S = 0.5 * (S + tf.linalg.matrix_transpose(S)) #remove rounding errors
+    tau = tau * tf.ones_like(sqrt_p[:,tf.newaxis,:,0])
+    P = _expm_symmetric(S, tau)
+    sqrt_p = tf.expand_dims(sqrt_p, 1)
+    return P / tf.expand_dims(sqrt_p, -1) * tf.expand_dims(sqrt_p, -2)
+
+
+@tf.custom_gradient
+def _expm_symmetric(S, tau):
+    """Computes e^(tau*S) for symmetric matrices S of shape (num_model, k, s, s) and times tau of shape (num_model, b, k).
+        The gradient is computed in the eigenbasis with divided differences, which is also stable for (nearly) equal eigenvalues.
+    """
+    eigenvalues, V = tf.linalg.eigh(S)
+    eigenvalues = tf.expand_dims(eigenvalues, 1)
+    E = tf.exp(tf.expand_dims(tau, -1) * eigenvalues)
+    P = tf.einsum("mkil,mbkl,mkjl->mbkij", V, E, V)
+    def grad(dP):
+        G = tf.einsum("mkil,mbkij,mkjn->mbkln", V, dP, V)
+        d_tau = tf.reduce_sum(eigenvalues * E * tf.linalg.diag_part(G), -1)
+        #divided differences (E_i - E_j) / (lambda_i - lambda_j) = max(E_i, E_j) * tau * (1 - e^(-x)) / x
+        #with x = tau * |lambda_i - lambda_j|, the limit for x -> 0 is tau * E_i
+        tau_ = tau[..., tf.newaxis, tf.newaxis]
+        x = tau_ * tf.abs(tf.expand_dims(eigenvalues, -1) - tf.expand_dims(eigenvalues, -2))
+        small = x < 1e-3
+        safe_x = tf.where(small, tf.ones_like(x), x)
+        h = tf.where(small, 1. - x/2. + tf.square(x)/6., -tf.math.expm1(-safe_x) / safe_x)
+        F = tf.maximum(tf.expand_dims(E, -1), tf.expand_dims(E, -2)) * tau_ * h
+        dS = tf.einsum("mkil,mbkln,mkjn->mkij", V, F * G, V)
+        dS = 0.5 * (dS + tf.linalg.matrix_transpose(dS))
+        return dS, d_tau
+    return P, grad
+
+    
+def make_anc_probs(sequences, exchangeabilities, equilibrium, tau, equilibrium_sample=False, transposed=False, reversible=False):
     """Computes ancestral probabilities simultaneously for all sites and rate matrices.
     Args:
         sequences: Sequences either as integers (faster embedding lookup) or in vector format. Shape: (num_model, b, L) or (num_model, b, L, s)
@@ -40,6 +86,8 @@ def make_anc_probs(sequences, exchangeabilities, equilibrium, tau, equilibrium_s
         tau: Evolutionary times for all sequences (1 time unit = 1 expected mutation per site). Shape: (num_model, b) or (num_model,b,k)
         equi_init: If true, a 2-staged process is assumed where an amino acid is first sampled from the equilibirium distribution
                     and the ancestral probabilities are computed afterwards.
+        reversible: If true, the exchangeabilities must be symmetric and the equilibrium positive. The transition matrices
+                    are then computed with an eigendecomposition per rate matrix instead of a matrix exponential per sequence.
     Returns:
         A tensor with the expected amino acids frequencies after time tau. Output shape: (num_model, b, L, k, s)
     """
@@ -50,8 +98,11 @@ def make_anc_probs(sequences, exchangeabilities, equilibrium, tau, equilibrium_s
     equilibrium = tf.reshape(equilibrium, (-1, 20))
     Q = make_rate_matrix(exchangeabilities, equilibrium)
     Q = tf.reshape(Q, shape)
-    tauQ = tau * tf.expand_dims(Q, 1)
-    P = tf.linalg.expm(tauQ) # P[m,b,k,i,j] = P(X(tau_b) = j | X(0) = i; Q_k, model m))
+    if reversible:
+        P = make_reversible_transition_matrices(Q, tf.reshape(equilibrium, shape[:-1]), tau[...,0,0])
+    else:
+        tauQ = tau * tf.expand_dims(Q, 1)
+        P = tf.linalg.expm(tauQ) # P[m,b,k,i,j] = P(X(tau_b) = j | X(0) = i; Q_k, model m))
     num_model,b,k,s,s = tf.unstack(tf.shape(P), 5)
     if equilibrium_sample:
         equilibrium = tf.reshape(equilibrium, (num_model,1,k,s,1))
@@ -74,6 +125,18 @@ def make_anc_probs(sequences, exchangeabilities, equilibrium, tau, equilibrium_s
             ancprobs = tf.einsum("mbLz,mbkzs->mbLks", sequences, P)
     return ancprobs
     
+def lookup_anc_probs(sequences, tables):
+    """Expands sequences and per-sequence lookup tables as returned by AncProbsLayer with return_lookup_tables=True 
+        to ancestral probabilities per residue.
+    Args:
+        sequences: Sequences in index format. Shape: (num_model, b, L)
+        tables: Ancestral probabilities for each input symbol. Shape: (num_model, b, s, d)
+    Returns:
+        Ancestral probabilities. Output shape: (num_model, b, L, d)
+    """
+    return tf.gather(tables, tf.cast(sequences, tf.int32), batch_dims=2)
+
+    
 class AncProbsLayer(tf.keras.layers.Layer): 
     """A learnable layer for ancestral probabilities.
 
@@ -98,6 +161,12 @@ class AncProbsLayer(tf.keras.layers.Layer):
         clusters: An optional vector that assigns each sequence to a cluster. If provided, the evolutionary time
                     is learned per cluster.
         use_lstm: Experimental setting that estimates the evolutionary distance of a sequence with an lstm.
+        use_eigendecomposition: Computes the transition matrices of the time-reversible rate matrices by 
+                    an eigendecomposition instead of one matrix exponential per sequence.
+        return_lookup_tables: If true, index inputs are not expanded to ancestral probabilities per residue. Instead,
+                    the layer returns the inputs together with a table per sequence that contains the ancestral probabilities
+                    of each input symbol. Emitters can combine the tables with their emission matrices before a lookup 
+                    (see ProfileHMMEmitter). 
         name: Layer name.
     """
 
@@ -118,6 +187,8 @@ class AncProbsLayer(tf.keras.layers.Layer):
                  transposed=False,
                  clusters=None,
                  use_lstm=False,
+                 use_eigendecomposition=True,
+                 return_lookup_tables=False,
                  **kwargs):
         super(AncProbsLayer, self).__init__(**kwargs)
         self.num_models = num_models
@@ -137,6 +208,11 @@ class AncProbsLayer(tf.keras.layers.Layer):
         self.clusters = clusters
         self.num_clusters = np.max(clusters) + 1 if clusters is not None else self.num_rates
         self.use_lstm = use_lstm
+        self.use_eigendecomposition = use_eigendecomposition
+        self.return_lookup_tables = return_lookup_tables
+        #set by from_config for models saved with a tau_kernel of shape (num_models, num_clusters)
+        self.legacy_tau_layout = False
+        assert not (use_lstm and return_lookup_tables), "Lookup tables are not supported with sequence dependent evolutionary times."
     
     def build(self, input_shape=None):
         if self.built:
@@ -149,9 +225,12 @@ class AncProbsLayer(tf.keras.layers.Layer):
                                             #kernel_initializer="zeros",
                                             bias_initializer=self.rate_init)
         else:
-            self.tau_kernel = self.add_weight(shape=[self.num_models, self.num_clusters], 
+            #one row per sequence (or cluster), batches gather rows such that the gradient is row-sparse
+            #rate_init is given in the layout (num_models, num_clusters)
+            rate_init = tf.keras.initializers.get(self.rate_init)
+            self.tau_kernel = self.add_weight(shape=[self.num_clusters, self.num_models], 
                                     name="tau_kernel", 
-                                    initializer=self.rate_init,
+                                    initializer=lambda shape, dtype=None: tf.transpose(rate_init(shape[::-1], dtype=dtype)),
                                     trainable=self.trainable_distances)
         if self.shared_matrix:
             self.exchangeability_kernel = self.add_weight(shape=[self.num_models, 1, 20, 20],
@@ -215,12 +294,25 @@ class AncProbsLayer(tf.keras.layers.Layer):
             lstm_output = tf.reshape(lstm_output, (num_model, b, self.lstm_dim))
             return self.dense(lstm_output)[...,0]
         else:
-            tau = self.tau_kernel
-            if self.clusters is not None:
-                tau = tf.gather(tau, self.clusters, axis=-1)
-            if subset is not None:
-                tau = tf.gather_nd(tau, subset, batch_dims=1)
-            return tf.math.softplus(tau)
+            return tf.math.softplus(self._gather_tau_kernel(subset))
+
+    def _gather_tau_kernel(self, subset=None):
+        """ Gathers the kernel values of the evolutionary times of all sequences or a subset.
+        Args:
+            subset: Sequence indices per model. Shape: (num_models, b, 1)
+        Returns:
+            Kernel values of shape (num_models, b) or (num_models, num_seq) if subset is None.
+        """
+        if subset is None:
+            rows = self.clusters if self.clusters is not None else tf.range(self.num_clusters)
+            return tf.transpose(tf.gather(self.tau_kernel, rows))
+        rows = subset[..., 0]
+        if self.clusters is not None:
+            rows = tf.gather(self.clusters, rows)
+        #whole rows are gathered, since only tf.gather yields row-sparse IndexedSlices gradients for the kernel 
+        #(the gradient of tf.gather_nd on (row, model) pairs is dense), the entry of model m is the diagonal afterwards
+        tau = tf.gather(self.tau_kernel, rows) #(num_models, b, num_models)
+        return tf.transpose(tf.linalg.diag_part(tf.transpose(tau, [1, 0, 2])))
     
     def make_per_matrix_rate(self):
         return tf.math.softplus(self.per_matrix_rates_kernel)
@@ -234,9 +326,19 @@ class AncProbsLayer(tf.keras.layers.Layer):
             replace_rate_with_equilibrium: If true, replaces non-standard amino acids with the equilibrium distribution.
         Returns:
             Ancestral probabilities. Shape: (num_model, b, L, num_matrices*s)
+            If return_lookup_tables is true and the inputs are indices, the inputs and the ancestral probabilities of all
+            symbols per sequence are returned instead. Shape: (num_model, b, L) and (num_model, b, s, num_matrices*s)
         """
         rate_indices = tf.identity(rate_indices) #take care of numpy inputs
         rate_indices.set_shape([self.num_models,None]) #resolves tf 2.12 issues
+        if self.return_lookup_tables and len(inputs.shape) == 3:
+            #the ancestral probabilities depend only on the symbol and the sequence, compute them once per symbol
+            symbols = tf.zeros_like(rate_indices, dtype=tf.int32)[..., tf.newaxis] + tf.range(len(SequenceDataset.alphabet))
+            tables = self._make_anc_probs(tf.cast(symbols, inputs.dtype), rate_indices, replace_rare_with_equilibrium)
+            return inputs, tables
+        return self._make_anc_probs(inputs, rate_indices, replace_rare_with_equilibrium)
+
+    def _make_anc_probs(self, inputs, rate_indices, replace_rare_with_equilibrium):
         input_indices = len(inputs.shape) == 3 
         def _make_mask(bools):
             mask = tf.cast(bools, self.dtype)
@@ -249,7 +351,15 @@ class AncProbsLayer(tf.keras.layers.Layer):
             only_std_aa_inputs = inputs * tf.cast(bool_mask, inputs.dtype)
         else:
             only_std_aa_inputs = inputs
-        tau_subset = self.make_tau(inputs, tf.expand_dims(rate_indices, -1))
+        if self.use_lstm:
+            tau_subset = self.make_tau(inputs)
+        else:
+            tau_kernel_subset = self._gather_tau_kernel(tf.expand_dims(rate_indices, -1))
+            tau_subset = tf.math.softplus(tau_kernel_subset)
+            #lazy regularization of the rows in the batch, scaled to estimate the penalty of all rows
+            b = tf.cast(tf.shape(rate_indices)[1], self.dtype)
+            reg_tau = tf.reduce_sum(tf.square(tau_kernel_subset + 3.)) * self.num_clusters / b
+            self.add_loss(self.matrix_rate_l2 * reg_tau)
         if self.per_matrix_rate:
             per_matrix_rates = self.make_per_matrix_rate()
             per_matrix_rates = tf.expand_dims(per_matrix_rates, 1)
@@ -259,15 +369,14 @@ class AncProbsLayer(tf.keras.layers.Layer):
             self.add_loss(self.matrix_rate_l2 * reg)
         else:
             mut_rates = tau_subset
-        reg_tau = tf.reduce_sum(tf.square(self.tau_kernel + 3.))
-        self.add_loss(self.matrix_rate_l2 * reg_tau)
         equilibrium = self.make_p()
         anc_probs = make_anc_probs(only_std_aa_inputs, 
                                    self.make_R(), 
                                    equilibrium, 
                                    mut_rates,
                                    self.equilibrium_sample,
-                                   self.transposed)
+                                   self.transposed,
+                                   reversible=self.use_eigendecomposition)
         if input_indices:
             anc_probs *= mask
             anc_probs = tf.pad(anc_probs, [[0,0], [0,0], [0,0], [0,0], [0,len(SequenceDataset.alphabet)-20]])
@@ -295,7 +404,7 @@ class AncProbsLayer(tf.keras.layers.Layer):
              "num_matrices" : self.num_matrices,
              "equilibrium_init" : initializers.ConstantInitializer(self.equilibrium_kernel.numpy()),
              "exchangeability_init" : initializers.ConstantInitializer(self.exchangeability_kernel.numpy()),
-             "rate_init" : initializers.ConstantInitializer(self.tau_kernel.numpy()),
+             "rate_init" : initializers.ConstantInitializer(self.tau_kernel.numpy().T) if not self.use_lstm else self.rate_init,
              "trainable_rate_matrices" : self.trainable_rate_matrices,
             "trainable_distances" : self.trainable_distances,
              "per_matrix_rate" : self.per_matrix_rate,
@@ -305,6 +414,36 @@ class AncProbsLayer(tf.keras.layers.Layer):
              "equilibrium_sample" : self.equilibrium_sample,
              "transposed" : self.transposed,
                 "clusters" : self.clusters,
-             "use_lstm" : self.use_lstm
+             "use_lstm" : self.use_lstm,
+             "use_eigendecomposition" : self.use_eigendecomposition,
+             "return_lookup_tables" : self.return_lookup_tables,
+             "tau_kernel_layout" : "clusters_first"
         })
         return config
+
+    @classmethod
+    def from_config(cls, config):
+        config = dict(config)
+        #configs of models saved before tau_kernel had one row per cluster lack the layout
+        legacy_tau_layout = config.pop("tau_kernel_layout", None) is None
+        layer = super(AncProbsLayer, cls).from_config(config)
+        layer.legacy_tau_layout = legacy_tau_layout
+        return layer
+
+    def load_own_variables(self, store):
+        #models saved before tau_kernel had one row per cluster store it with shape (num_models, num_clusters)
+        if not self.use_lstm:
+            #without lstm sublayers, the weights are stored in the order of self.weights
+            key = str([id(v) for v in self.weights].index(id(self.tau_kernel)))
+            if key in store.keys():
+                stored = np.asarray(store[key])
+                expected = tuple(self.tau_kernel.shape)
+                if self.legacy_tau_layout or (stored.shape != expected and stored.shape == expected[::-1]):
+                    if stored.shape != expected[::-1]:
+                        raise ValueError(f"Can not load the evolutionary times of a model saved with the old layout (num_models, num_clusters). "
+                                         f"Expected shape {expected[::-1]} but found {stored.shape}.")
+                    store = {k : (stored.T if k == key else store[k]) for k in store.keys()}
+                elif stored.shape != expected:
+                    raise ValueError(f"The stored evolutionary times have shape {stored.shape}, but the layer expects {expected} "
+                                     "(num_clusters, num_models).")
+        super(AncProbsLayer, self).load_own_variables(store)
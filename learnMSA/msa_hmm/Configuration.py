@@ -1,11 +1,14 @@
 import math
 import numpy as np
 import tensorflow as tf
-from functools import partial
+from functools import partial, lru_cache
 import learnMSA.msa_hmm.Emitter as emit
 import learnMSA.msa_hmm.Transitioner as trans
 import learnMSA.msa_hmm.Initializers as initializers
 import learnMSA.msa_hmm.Priors as priors
+from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
+from learnMSA.msa_hmm.MemoryCostModel import get_default_cost_model
+from learnMSA.msa_hmm.Utility import get_num_states
 import learnMSA.protein_language_models.Common as plm_common
 from learnMSA.protein_language_models.MvnEmitter import MvnEmitter, AminoAcidPlusMvnEmissionInitializer, make_joint_prior
 import subprocess as sp
@@ -14,58 +17,79 @@ import os
 def as_str(config, items_per_line=1, prefix="", sep=""):
     return "\n"+prefix+"{" + sep.join(("\n"+prefix)*(i%items_per_line==0) + key + " : " + str(val) for i,(key,val) in enumerate(config.items())) + "\n"+prefix+"}"
 
-#simple adpative batch size depending on sequence- length and model length
+#adaptive batch size based on a measured model of the peak memory of a training step (see MemoryCostModel)
+#machines that were not calibrated yet use a hand-tuned table
 #longer models and sequences require much more memory
 #we limit the batch size based on the longest model to train
 #the adpative batch size scales automatically with the number of GPUs
-def get_adaptive_batch_size(model_lengths, max_seq_len, small_gpu):
+#parallel_factor > 1 (chunk-wise recursions) requires much more memory per sequence
+def get_adaptive_batch_size(model_lengths, max_seq_len, input_dim=len(SequenceDataset.alphabet), parallel_factor=1):
+    num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
+    num_devices = num_gpu + int(num_gpu==0) #account for the CPU-only case 
+    cost_model = get_default_cost_model()
+    if cost_model is None:
+        batch_size = _get_table_batch_size(model_lengths, max_seq_len, is_small_gpu())
+        return max(1, batch_size//parallel_factor) * num_devices
+    max_num_states = max(get_num_states(model_lengths))
+    return cost_model.get_max_batch_size(len(model_lengths), max_seq_len, max_num_states, 
+                                         parallel_factor=parallel_factor, input_dim=input_dim) * num_devices
+
+#the memory cost model does not capture the emissions of the language model embeddings, the hand-tuned table is used
+def get_adaptive_batch_size_with_language_model(model_lengths, max_seq_len, embedding_dim, parallel_factor=1):
     num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
     num_devices = num_gpu + int(num_gpu==0) #account for the CPU-only case 
     model_length = max(model_lengths)
     if max_seq_len < 200 and model_length < 180:
-        batch_size = 512*num_devices
+        batch_size = 20 + 180*32//embedding_dim
     elif max_seq_len < 520 and model_length < 230:
-        batch_size = 256*num_devices
+        batch_size = 10 + 90*32//embedding_dim
     elif max_seq_len < 700 and model_length < 420:
-        batch_size = 128*num_devices
+        batch_size = 5 + 45*32//embedding_dim
     elif max_seq_len < 850 and model_length < 550:
-        batch_size = 64*num_devices
+        batch_size = 3 + 22*32//embedding_dim
     elif max_seq_len < 1200 and model_length < 700:
-        batch_size = 32*num_devices
+        batch_size = 1 + 9*32//embedding_dim
     elif max_seq_len < 2000 and model_length < 1000:
-        batch_size = 8*num_devices
+        batch_size = 1 + 4*32//embedding_dim
     elif max_seq_len < 4000 and model_length < 1500:
-        batch_size = 4*num_devices
+        batch_size = 1 + 32//embedding_dim
     else:
-        batch_size = 2*num_devices
-    if small_gpu:
+        batch_size = 1
+    if is_small_gpu():
         batch_size = batch_size//2
-    return batch_size
-    
-def get_adaptive_batch_size_with_language_model(model_lengths, max_seq_len, embedding_dim, small_gpu):
-    num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
-    num_devices = num_gpu + int(num_gpu==0) #account for the CPU-only case 
+    return max(1, batch_size//parallel_factor) * num_devices
+
+def _get_table_batch_size(model_lengths, max_seq_len, small_gpu):
     model_length = max(model_lengths)
     if max_seq_len < 200 and model_length < 180:
-        batch_size = (20 + 180*32//embedding_dim)*num_devices
+        batch_size = 512
     elif max_seq_len < 520 and model_length < 230:
-        batch_size = (10 + 90*32//embedding_dim)*num_devices
+        batch_size = 256
     elif max_seq_len < 700 and model_length < 420:
-        batch_size = (5 + 45*32//embedding_dim)*num_devices
+        batch_size = 128
     elif max_seq_len < 850 and model_length < 550:
-        batch_size = (3 + 22*32//embedding_dim)*num_devices
+        batch_size = 64
     elif max_seq_len < 1200 and model_length < 700:
-        batch_size = (1 + 9*32//embedding_dim)*num_devices
+        batch_size = 32
     elif max_seq_len < 2000 and model_length < 1000:
-        batch_size = (1 + 4*32//embedding_dim)*num_devices
+        batch_size = 8
     elif max_seq_len < 4000 and model_length < 1500:
-        batch_size = (1 + 32//embedding_dim)*num_devices
+        batch_size = 4
     else:
-        batch_size = 1*num_devices
+        batch_size = 2
     if small_gpu:
         batch_size = batch_size//2
     return batch_size
 
+#automatically scale the table batch sizes to a memory friendly version, if the GPU has less than 32GB
+@lru_cache(maxsize=None)
+def is_small_gpu():
+    if len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) > 0:     
+        #if there is at least one GPU, check its memory                                                          
+        gpu_mem = get_gpu_memory()
+        return gpu_mem[0] < 32000 if len(gpu_mem) > 0 else False
+    return False
+
 #the configuration can be changed by experienced users
 #proper command line support for these parameters will be added in the future
 def make_default(default_num_models=5, 
@@ -125,16 +149,10 @@ def make_default(default_num_models=5,
                                                                         for _ in range(default_num_models)],
                                                     [initializers.make_default_flank_init() 
                                                                         for _ in range(default_num_models)])
-    #automaticall scale to a memory friendly version, if the GPU has less than 32GB     
-    small_gpu = False
-    if len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) > 0:     
-        #if there is at least one GPU, check its memory                                                          
-        gpu_mem = get_gpu_memory()
-        small_gpu = gpu_mem[0] < 32000 if len(gpu_mem) > 0 else False
     if use_language_model:                                                                    
-        batch_callback = partial(get_adaptive_batch_size_with_language_model, embedding_dim=scoring_model_config.dim, small_gpu=small_gpu)  
+        batch_callback = partial(get_adaptive_batch_size_with_language_model, embedding_dim=scoring_model_config.dim)  
     else:
-        batch_callback = partial(get_adaptive_batch_size, small_gpu=small_gpu)                                                                  
+        batch_callback = get_adaptive_batch_size                                                              
     default = {
         "num_models" : default_num_models,
         "transitioner" : transitioner,
@@ -148,6 +166,7 @@ def make_default(default_num_models=5,
         "learning_rate" : 0.05 if use_language_model else 0.1,
         "epochs" : [10, 4, 20] if use_language_model else [10, 2, 10],
         "crop_long_seqs" : math.inf,
+        "length_buckets" : 0, #if > 1, training batches are drawn from this many length buckets with a residue budget
         "use_prior" : True,
         "dirichlet_mix_comp_count" : 1,
         "use_anc_probs" : True,
@@ -161,6 +180,9 @@ def make_default(default_num_models=5,
         "shared_rate_matrix" : False,
         "equilibrium_sample" : False,
         "transposed" : False,
+        "fused_emissions" : False, #if True, emissions are looked up from per-sequence tables instead of ancestral probabilities per residue (pays off mainly for num_rate_matrices > 1)
+        "analytic_gradient" : True, #the log-likelihood is differentiated with a backward recursion instead of autodiff through the forward recursion
+        "trainer" : "adam", #"em" trains the emission and transition kernels with stepwise online EM and only the encoder with Adam
         "encoder_initializer" : initializers.make_default_anc_probs_init(default_num_models),
         "model_criterion" : "AIC", #AIC is slightly better than loglik on average over multiple benchmarks
         "encoder_weight_extractor" : None,
@@ -113,7 +113,22 @@ class DirichletMixtureLayer(tf.keras.layers.Layer):
     
     def expectation(self):
         return tf.reduce_sum(self.component_distributions() * tf.expand_dims(self.make_mix(), -1), 0)
-        
+
+    def posterior_mean(self, counts):
+        """ Computes the posterior mean distributions given observed counts, i.e. the means of the component
+            posteriors (counts + alpha) weighted by the posterior probabilities of the components.
+        Args:
+            counts: Observed (expected) counts. Shape: (b, s)
+        Returns:
+            Posterior mean distributions. Shape: (b, s)
+        """
+        alpha = self.make_alpha()
+        posterior_alpha = tf.expand_dims(counts, 1) + alpha
+        log_weights = tf.math.lbeta(posterior_alpha) - tf.math.lbeta(alpha) + tf.math.log(self.make_mix())
+        weights = tf.nn.softmax(log_weights, axis=-1)
+        means = posterior_alpha / tf.reduce_sum(posterior_alpha, axis=-1, keepdims=True)
+        return tf.reduce_sum(tf.expand_dims(weights, -1) * means, 1)
+
     def call(self, p, training=False):
         alpha = self.make_alpha()
         mix = self.make_mix()
@@ -4,7 +4,7 @@ import os
 import learnMSA.msa_hmm.Initializers as initializers
 import learnMSA.msa_hmm.Priors as priors
 from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
-from learnMSA.msa_hmm.Utility import get_num_states, deserialize
+from learnMSA.msa_hmm.Utility import get_num_states, deserialize, softmax
 # from learnMSA.protein_language_models.BilinearSymmetric import make_scoring_model
 # import learnMSA.protein_language_models.Common as Common
 from packaging import version
@@ -36,6 +36,9 @@ class ProfileHMMEmitter(tf.keras.layers.Layer):
         self.insertion_init = [insertion_init] if not hasattr(insertion_init, '__iter__') else insertion_init
         self.prior = priors.AminoAcidPrior(dtype=self.dtype) if prior is None else prior
         self.frozen_insertions = frozen_insertions
+        #count mode: the gradients of the log-likelihood w.r.t. the kernels are the expected emission counts
+        #and the prior is not differentiated (see ExpectationMaximization.StepwiseEM)
+        self.count_gradients = False
 
 
     def set_lengths(self, lengths):
@@ -97,7 +100,7 @@ class ProfileHMMEmitter(tf.keras.layers.Layer):
         i1 = tf.expand_dims(ins, 0)
         i2 = tf.stack([tf.identity(ins)]*(length+1))
         emissions = tf.concat([i1, em, i2] , axis=0)
-        emissions = tf.nn.softmax(emissions)
+        emissions = softmax(emissions, count_gradients=self.count_gradients)
         emissions = tf.concat([emissions, tf.zeros_like(emissions[:,:1])], axis=-1) 
         end_state_emission = tf.one_hot([s], s+1, dtype=em.dtype) 
         emissions = tf.concat([emissions, end_state_emission], axis=0)
@@ -125,11 +128,17 @@ class ProfileHMMEmitter(tf.keras.layers.Layer):
     def call(self, inputs, end_hints=None, training=False):
         """ 
         Args: 
-                inputs: A tensor of shape (k, ... , s) 
+                inputs: A tensor of shape (k, ... , s) or a pair of index sequences of shape (k, b, L) and lookup tables
+                        of shape (k, b, z, s) with the input distribution of each of the z symbols (see AncProbsLayer).
                 end_hints: A tensor of shape (num_models, batch_size, 2, num_states) that contains the correct state for the left and right ends of each chunk.
         Returns:
                 A tensor with emission probabilities of shape (k, ... , q) where "..." is identical to inputs.
         """
+        if isinstance(inputs, (tuple, list)):
+            #emission probabilities per symbol and sequence, no input distributions per residue are required
+            sequences, tables = inputs
+            emission_tables = tf.einsum("kbzs,ksq->kbzq", tables, self.B_transposed[..., :tf.shape(tables)[-1], :])
+            return tf.gather(emission_tables, tf.cast(sequences, tf.int32), batch_dims=2)
         input_shape = tf.shape(inputs)
         inputs = tf.reshape(inputs, (tf.shape(inputs)[0], -1, input_shape[-1]))
         B = self.B_transposed[..., :input_shape[-1], :]
@@ -152,7 +161,9 @@ class ProfileHMMEmitter(tf.keras.layers.Layer):
     
 
     def get_prior_log_density(self):
-        return self.prior(self.B, lengths=self.lengths)
+        prior = self.prior(self.B, lengths=self.lengths)
+        #in count mode, the prior is part of the M-step
+        return tf.stop_gradient(prior) if self.count_gradients else prior
     
 
     def duplicate(self, model_indices=None, share_kernels=False):
@@ -0,0 +1,279 @@
+import tensorflow as tf
+import numpy as np
+from learnMSA.msa_hmm.Emitter import ProfileHMMEmitter
+from learnMSA.msa_hmm.Transitioner import ProfileHMMTransitioner
+from learnMSA.msa_hmm.Priors import AminoAcidPrior, ProfileHMMTransitionPrior
+from learnMSA.msa_hmm.Training import LazyAdam
+
+
+#lower bound for probabilities set by the M-step, kernels are log probabilities
+MIN_PROB = 1e-16
+
+
+class StepwiseEM(LazyAdam):
+    """ Trains the emission and transition kernels of profile HMMs with stepwise online EM (mini-batch Baum-Welch)
+        and all other variables (e.g. the evolutionary times and rate matrices of the encoder) with (lazy) Adam.
+        The emitters and transitioners are switched to count mode, i.e. the gradient of the loss w.r.t. their kernels
+        is the negative expected count of each emission or transition in the batch (scaled by 1 / (num_models * batch weight)).
+        The forward-backward pass that computes the gradients is therefore the E-step. Per training step, the sufficient
+        statistics are updated by s = (1-eta) s + eta s_batch with step size eta = (t+1)^-step_size_decay where s_batch
+        are the batch counts scaled to the size of the dataset.
+        The kernels are then set to the (approximate) MAP estimates given s and the priors: The posterior mean
+        of the Dirichlet mixtures for emissions and match, insert and delete transitions and the closed-form maximizers
+        for the Plan7 transitions. The entry/exit prior is linearized at the current parameters. Trainable insertion 
+        kernels have no prior and are set to the maximum likelihood estimates.
+        Emitters and transitioners of other types or with other priors are trained by Adam.
+    Args:
+        msa_hmm_layer: The MsaHmmLayer to train. If None, the optimizer is equivalent to LazyAdam.
+        learning_rate: Learning rate of Adam for all variables not trained by EM.
+        step_size_decay: Exponent of the decay of the stepwise EM step size. Should be in (0.5, 1].
+    """
+    def __init__(self, msa_hmm_layer=None, learning_rate=0.1, step_size_decay=0.7, **kwargs):
+        super(StepwiseEM, self).__init__(learning_rate, **kwargs)
+        self.step_size_decay = step_size_decay
+        self.em_emitters, self.em_transitioners = [], []
+        if msa_hmm_layer is not None and msa_hmm_layer.use_prior:
+            cells = [msa_hmm_layer.cell, msa_hmm_layer.reverse_cell]
+            self.em_emitters = [em for em in msa_hmm_layer.cell.emitter if supports_em(em)]
+            if supports_em(msa_hmm_layer.cell.transitioner):
+                self.em_transitioners = [msa_hmm_layer.cell.transitioner]
+            #count mode is required in all cells sharing the kernels
+            for cell in cells:
+                for em in cell.emitter:
+                    em.count_gradients = supports_em(em)
+                cell.transitioner.count_gradients = len(self.em_transitioners) > 0
+            num_seqs = msa_hmm_layer.weight_sum if msa_hmm_layer.sequence_weights is not None else msa_hmm_layer.num_seqs
+            self.num_seqs = float(num_seqs)
+            #batch counts per model are normalized by the batch weight and averaged over models
+            self.count_scale = float(msa_hmm_layer.cell.num_models * num_seqs)
+        em_variables = [em.emission_kernel for em in self.em_emitters]
+        #count mode also applies to the insertion kernels, i.e. they can not be trained by Adam
+        em_variables += [[k for k in em.insertion_kernel if k.trainable] for em in self.em_emitters]
+        em_variables += [list(t.transition_kernel[i].values()) + [t.flank_init_kernel[i]]
+                            for t in self.em_transitioners for i in range(t.num_models)]
+        #sufficient statistics per variable, tied variables occur once
+        self.em_variable_ids, self.statistics = [], []
+        for v in sum(em_variables, []):
+            if id(v) not in self.em_variable_ids:
+                self.em_variable_ids.append(id(v))
+                self.statistics.append(tf.Variable(tf.zeros(v.shape, dtype=v.dtype), trainable=False))
+        self.em_iterations = tf.Variable(0, dtype=tf.int64, trainable=False)
+        #loss scale of the current batch set by LearnMSAModel.compute_loss, undone when computing counts
+        self.batch_weight = tf.Variable(1., trainable=False)
+
+
+    def apply_gradients(self, grads_and_vars, *args, **kwargs):
+        grads_and_vars = list(grads_and_vars)
+        em_grads = [(g,v) for g,v in grads_and_vars if id(v) in self.em_variable_ids and g is not None]
+        other = [(g,v) for g,v in grads_and_vars if id(v) not in self.em_variable_ids]
+        if len(em_grads) > 0:
+            self.em_step(em_grads)
+        if len(other) > 0:
+            return super(StepwiseEM, self).apply_gradients(other, *args, **kwargs)
+        return self.iterations
+
+
+    def get_statistics(self, variable):
+        """ Returns the expected counts accumulated for a variable trained by EM. """
+        return self.statistics[self.em_variable_ids.index(id(variable))]
+
+
+    def em_step(self, em_grads):
+        """ Updates the sufficient statistics with the counts of a batch and sets the kernels to the MAP estimates.
+        Args:
+            em_grads: A list of (gradient, variable) pairs of variables trained by EM.
+        """
+        eta = tf.pow(tf.cast(self.em_iterations + 1, tf.float32), -self.step_size_decay)
+        for g,v in em_grads:
+            counts = -tf.convert_to_tensor(g) * self.count_scale / tf.cast(self.batch_weight, g.dtype)
+            stats = self.get_statistics(v)
+            stats.assign((1-eta) * stats + eta * tf.cast(counts, stats.dtype))
+        for emitter in self.em_emitters:
+            for i, kernel in enumerate(emitter.emission_kernel):
+                counts = self.get_statistics(kernel)
+                kernel.assign(_make_emission_kernel(counts, kernel, emitter.prior.emission_dirichlet_mix))
+            for kernel in emitter.insertion_kernel:
+                if kernel.trainable:
+                    kernel.assign(_make_insertion_kernel(self.get_statistics(kernel), kernel))
+        for transitioner in self.em_transitioners:
+            probs = transitioner.make_probs()
+            for i in range(transitioner.num_models):
+                kernel = transitioner.transition_kernel[i]
+                counts = {part : self.get_statistics(k) for part,k in kernel.items()}
+                flank_init_counts = self.get_statistics(transitioner.flank_init_kernel[i])
+                new_kernel, new_flank_init_kernel = _make_transition_kernel(counts, flank_init_counts, probs[i],
+                                                                            kernel, transitioner.prior, self.num_seqs)
+                for part, new in new_kernel.items():
+                    kernel[part].assign(new)
+                transitioner.flank_init_kernel[i].assign(new_flank_init_kernel)
+        self.em_iterations.assign_add(1)
+
+
+    def get_config(self):
+        config = super(StepwiseEM, self).get_config()
+        config.update({"step_size_decay" : self.step_size_decay})
+        return config
+
+
+
+def supports_em(component):
+    """ Returns true if the closed-form M-step is implemented for an emitter or transitioner, i.e.
+        for the default profile HMM emitter and transitioner with their default priors and without frozen kernels.
+    """
+    if type(component) is ProfileHMMEmitter:
+        return isinstance(component.prior, AminoAcidPrior)
+    if type(component) is ProfileHMMTransitioner:
+        trainable = all(k.trainable for kernel in component.transition_kernel for k in kernel.values())
+        return trainable and isinstance(component.prior, ProfileHMMTransitionPrior)
+    return False
+
+
+def _make_emission_kernel(counts, kernel, dirichlet):
+    """ Posterior mean of the amino acid distributions of the match states. The probability mass of
+        non-standard symbols is kept.
+    Args:
+        counts: Expected emission counts per match state. Shape: (length, s)
+        kernel: Current kernel. Shape: (length, s)
+        dirichlet: A Dirichlet mixture over the 20 standard amino acids.
+    Returns:
+        New kernel. Shape: (length, s)
+    """
+    current = tf.nn.softmax(kernel)
+    other = current[:, 20:]
+    amino_acids = dirichlet.posterior_mean(counts[:, :20])
+    probs = tf.concat([amino_acids * (1 - tf.reduce_sum(other, -1, keepdims=True)), other], -1)
+    return tf.math.log(tf.maximum(probs, MIN_PROB))
+
+
+def _make_insertion_kernel(counts, kernel):
+    """ Maximum likelihood estimate of the amino acid distribution shared by all insertion and flanking states. 
+        The probability mass of non-standard symbols is kept.
+    Args:
+        counts: Expected emission counts of all insertion and flanking states. Shape: (s)
+        kernel: Current kernel. Shape: (s)
+    Returns:
+        New kernel. Shape: (s)
+    """
+    current = tf.nn.softmax(kernel)
+    other = current[20:]
+    amino_acids = _normalize(counts[:20], current[:20] / tf.reduce_sum(current[:20]))
+    probs = tf.concat([amino_acids * (1 - tf.reduce_sum(other)), other], -1)
+    return tf.math.log(tf.maximum(probs, MIN_PROB))
+
+
+def _make_transition_kernel(counts, flank_init_counts, probs, kernel, prior, num_seqs):
+    """ Approximate MAP estimates of the transition probabilities of a profile HMM given expected counts.
+    Args:
+        counts: A dictionary that maps transition types to expected counts.
+        flank_init_counts: Expected number of sequences starting in the left flank. Shape: (1)
+        probs: A dictionary that maps transition types to the current probabilities.
+        kernel: A dictionary that maps transition types to the kernel variables.
+        prior: A ProfileHMMTransitionPrior.
+        num_seqs: The (weighted) number of sequences.
+    Returns:
+        A dictionary that maps transition types to new kernels (one per tied kernel) and the new flank init kernel.
+    """
+    pseudo = lambda alpha: tf.constant(alpha - 1, dtype=probs["begin_to_match"].dtype)
+    new_probs = {}
+    length = probs["begin_to_match"].shape[0]
+    #entry/exit prior linearized at the current parameters, i.e. Lagrangian penalties on begin and end probabilities
+    begin = probs["begin_to_match"] / tf.maximum(prior.epsilon, 1 - probs["match_to_delete"][0])
+    end = probs["match_to_end"]
+    pairs = np.triu(np.ones((length, length)))
+    pairs[0,-1] = 0
+    pairs = tf.constant(pairs, dtype=begin.dtype)
+    enex = tf.maximum(prior.epsilon, 1 - tf.expand_dims(begin, 1) * tf.expand_dims(end, 0))
+    begin_penalty = pseudo(prior.alpha_global) * tf.reduce_sum(pairs * tf.expand_dims(end, 0) / enex, 1)
+    end_penalty = pseudo(prior.alpha_global) * tf.reduce_sum(pairs * tf.expand_dims(begin, 1) / enex, 0)
+    begin_pseudo = pseudo(prior.alpha_global_compl) * tf.reduce_sum(pairs, 1)
+    end_pseudo = pseudo(prior.alpha_global_compl) * tf.reduce_sum(pairs, 0)
+    #begin state
+    begin_delete = _normalize(tf.stack([counts["match_to_delete"][0], tf.reduce_sum(counts["begin_to_match"])]),
+                              tf.stack([probs["match_to_delete"][0], 1-probs["match_to_delete"][0]]))[0]
+    begin = _penalized_categorical_map(counts["begin_to_match"] + begin_pseudo, begin_penalty, begin)
+    new_probs["begin_to_match"] = (1-begin_delete) * begin
+    #match states
+    match_counts = tf.stack([counts["match_to_match"], counts["match_to_insert"], counts["match_to_delete"][1:]], -1)
+    match = prior.match_dirichlet.posterior_mean(match_counts)
+    match_exit = _penalized_bernoulli_map(counts["match_to_end"][:-1] + end_pseudo[:-1],
+                                          tf.reduce_sum(match_counts, -1),
+                                          end_penalty[:-1], end[:-1])
+    new_probs["match_to_match"] = (1-match_exit) * match[:,0]
+    new_probs["match_to_insert"] = (1-match_exit) * match[:,1]
+    new_probs["match_to_delete"] = tf.concat([[begin_delete], (1-match_exit) * match[:,2]], 0)
+    new_probs["match_to_end"] = tf.concat([match_exit, tf.ones_like(end[-1:])], 0)
+    #insert states
+    insert = prior.insert_dirichlet.posterior_mean(tf.stack([counts["insert_to_match"], counts["insert_to_insert"]], -1))
+    new_probs["insert_to_match"] = insert[:,0]
+    new_probs["insert_to_insert"] = insert[:,1]
+    #delete states
+    delete = prior.delete_dirichlet.posterior_mean(tf.stack([counts["delete_to_match"][:-1], counts["delete_to_delete"]], -1))
+    new_probs["delete_to_match"] = tf.concat([delete[:,0], tf.ones_like(end[-1:])], 0)
+    new_probs["delete_to_delete"] = delete[:,1]
+    #flanking states, the pseudo counts of tied kernels (left and right flank) are added
+    flank_rows = {}
+    for loop, exit in [("left_flank_loop", "left_flank_exit"),
+                       ("right_flank_loop", "right_flank_exit"),
+                       ("unannotated_segment_loop", "unannotated_segment_exit")]:
+        row = flank_rows.setdefault(id(kernel[loop]), [loop, exit, 0])
+        row[2] += 1
+    for loop, exit, tied in flank_rows.values():
+        flank = _normalize(tf.concat([counts[loop] + tied * pseudo(prior.alpha_flank),
+                                      counts[exit] + tied * pseudo(prior.alpha_flank_compl)], 0),
+                           tf.concat([probs[loop], probs[exit]], 0))
+        new_probs[loop], new_probs[exit] = flank[:1], flank[1:]
+    #end state, the pseudo counts of log(p_unannotated + p_terminal) are split according to the current probabilities
+    p_u, p_r, p_t = probs["end_to_unannotated_segment"], probs["end_to_right_flank"], probs["end_to_terminal"]
+    split = pseudo(prior.alpha_flank_compl) / tf.maximum(prior.epsilon, p_u + p_t)
+    unannotated = _normalize(tf.concat([counts["end_to_unannotated_segment"] + pseudo(prior.alpha_single_compl) + split * p_u,
+                                        counts["end_to_right_flank"] + counts["end_to_terminal"]
+                                        + pseudo(prior.alpha_flank) + pseudo(prior.alpha_single) + split * p_t], 0),
+                             tf.concat([p_u, 1-p_u], 0))[:1]
+    right_flank = _normalize(tf.concat([counts["end_to_right_flank"] + pseudo(prior.alpha_flank),
+                                        counts["end_to_terminal"] + split * p_t], 0),
+                             tf.concat([p_r, p_t], 0))[:1]
+    new_probs["end_to_unannotated_segment"] = unannotated
+    new_probs["end_to_right_flank"] = (1-unannotated) * right_flank
+    new_probs["end_to_terminal"] = (1-unannotated) * (1-right_flank)
+    new_kernel = {part : tf.math.log(tf.maximum(p, MIN_PROB)) for part, p in new_probs.items()}
+    #initial flank probability
+    flank_init = _normalize(tf.concat([flank_init_counts + pseudo(prior.alpha_flank),
+                                       tf.maximum(num_seqs - flank_init_counts, 0.) + pseudo(prior.alpha_flank_compl)], 0),
+                            tf.constant([.5, .5], dtype=flank_init_counts.dtype))
+    flank_init = tf.maximum(flank_init, MIN_PROB)
+    new_flank_init_kernel = tf.math.log(flank_init[:1]) - tf.math.log(flank_init[1:])
+    return new_kernel, new_flank_init_kernel
+
+
+def _normalize(counts, fallback):
+    # normalizes counts along the last axis, rows without counts are replaced by the fallback
+    total = tf.reduce_sum(counts, -1, keepdims=True)
+    return tf.where(total > 0, counts / tf.where(total > 0, total, 1.), fallback)
+
+
+def _penalized_categorical_map(counts, penalty, fallback, iterations=50):
+    """ Maximizes sum_k counts_k log p_k - penalty_k p_k over the probability simplex.
+        The maximizer is p_k = counts_k / (mu + penalty_k) where the Lagrange multiplier mu is found by bisection.
+    """
+    positive = counts > 0
+    low = -tf.reduce_min(tf.where(positive, penalty, np.inf))
+    high = low + tf.reduce_sum(counts)
+    for _ in range(iterations):
+        mu = (low + high) / 2
+        total = tf.reduce_sum(tf.where(positive, counts / tf.where(positive, mu + penalty, 1.), 0.))
+        low, high = tf.where(total > 1, mu, low), tf.where(total > 1, high, mu)
+    probs = tf.where(positive, counts / tf.where(positive, high + penalty, 1.), 0.)
+    return _normalize(probs, fallback)
+
+
+def _penalized_bernoulli_map(positives, negatives, penalty, fallback):
+    """ Maximizes positives log p + negatives log (1-p) - penalty p over p in [0,1] (the smaller root
+        of the stationarity condition).
+    """
+    total = positives + negatives + penalty
+    root = tf.sqrt(tf.maximum(tf.square(total) - 4 * penalty * positives, 0.))
+    denom = total + root
+    return tf.where(denom > 0, 2 * positives / tf.where(denom > 0, denom, 1.), fallback)
+
+
+tf.keras.utils.get_custom_objects()["StepwiseEM"] = StepwiseEM
@@ -0,0 +1,257 @@
+import os
+import sys
+import gc
+import json
+import platform
+import subprocess
+import numpy as np
+import tensorflow as tf
+from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
+
+
+#probe steps (num_models, model_length, [(batch_size, seq_len), ...]) 
+_PROBE_STEPS = [(1, 32, [(16, 64), (32, 128), (64, 64)]),
+                (2, 96, [(16, 64), (32, 128), (16, 256)])]
+#the largest batch size per device, larger batches slow down the optimization more than they speed up training
+MAX_BATCH_SIZE = 512
+
+
+class MemoryCostModel():
+    """ A linear model of the peak memory in bytes of a training step:
+        peak = c_0 + c_1 * num_models * b * (L+1) * q * z + c_2 * num_models * b * (L+1) * d,
+        where b is the batch size, L the sequence length, q the maximum number of states, d the input dimension
+        and z = 1 if parallel_factor = 1 or z = q otherwise (chunk-wise recursions run from every state).
+        The coefficients are measured once per machine (see calibrate and load) and cached on disk.
+    Args:
+        coefficients: The coefficients c_0, c_1, c_2.
+        memory: Memory in bytes available per device. If None, it is detected automatically.
+        memory_fraction: Fraction of the available memory that training may use.
+    """
+    def __init__(self, coefficients, memory=None, memory_fraction=0.5):
+        self.coefficients = np.array(coefficients, dtype=np.float64)
+        self.memory = get_device_memory() if memory is None else memory
+        self.memory_fraction = memory_fraction
+
+
+    @staticmethod
+    def get_features(num_models, batch_size, seq_len, max_num_states, parallel_factor=1, input_dim=len(SequenceDataset.alphabet)):
+        z = 1 if parallel_factor == 1 else max_num_states
+        positions = num_models * batch_size * (seq_len+1)
+        return np.array([1., positions * max_num_states * z, positions * input_dim], dtype=np.float64)
+
+
+    def get_peak_bytes(self, num_models, batch_size, seq_len, max_num_states, parallel_factor=1, input_dim=len(SequenceDataset.alphabet)):
+        """ Predicts the peak memory in bytes of a training step with the given dimensions.
+        """
+        features = self.get_features(num_models, batch_size, seq_len, max_num_states, parallel_factor, input_dim)
+        return float(np.dot(self.coefficients, features))
+
+
+    def get_max_batch_size(self, num_models, seq_len, max_num_states, parallel_factor=1, input_dim=len(SequenceDataset.alphabet)):
+        """ Computes the largest batch size per device that fits into the memory budget.
+        Returns:
+            A batch size in [1, MAX_BATCH_SIZE].
+        """
+        budget = self.memory * self.memory_fraction - self.coefficients[0]
+        bytes_per_seq = self.get_peak_bytes(num_models, 1, seq_len, max_num_states, parallel_factor, input_dim) - self.coefficients[0]
+        if bytes_per_seq <= 0:
+            return MAX_BATCH_SIZE
+        return int(np.clip(budget // bytes_per_seq, 1, MAX_BATCH_SIZE))
+
+
+    @classmethod
+    def fit(cls, features, peak_bytes, **kwargs):
+        """ Fits nonnegative coefficients to measured peak memory by least squares.
+        Args:
+            features: A (n, 3) matrix of features as returned by get_features.
+            peak_bytes: A vector of n measurements.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        peak_bytes = np.asarray(peak_bytes, dtype=np.float64)
+        #scale columns for a well conditioned least squares problem
+        scale = np.maximum(np.amax(np.abs(features), axis=0), 1.)
+        active = np.ones(features.shape[1], dtype=bool)
+        coefficients = np.zeros(features.shape[1])
+        #drop terms with negative coefficients until all are nonnegative
+        while np.any(active):
+            x = np.linalg.lstsq(features[:, active] / scale[active], peak_bytes, rcond=None)[0]
+            if np.all(x >= 0):
+                coefficients[active] = x / scale[active]
+                break
+            active[np.flatnonzero(active)[np.argmin(x)]] = False
+        return cls(coefficients, **kwargs)
+
+
+    @classmethod
+    def calibrate(cls, verbose=False, **kwargs):
+        """ Measures the peak memory of a few small training steps of the default model in a separate process and fits the coefficients.
+            The probe should run before this process initializes a GPU, otherwise the device memory may already be occupied.
+            If the probe fails, a warning is printed and None is returned.
+        """
+        env = dict(os.environ, TF_CPU_ALLOCATOR_USE_BFC="true", TF_CPP_MIN_LOG_LEVEL="3")
+        command = [sys.executable, "-c", "import json; from learnMSA.msa_hmm.MemoryCostModel import _probe; print(json.dumps(_probe()))"]
+        error = ""
+        try:
+            result = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+            measurements = json.loads(result.stdout.strip().split("\n")[-1])
+        except subprocess.CalledProcessError as e:
+            measurements = []
+            error = (e.stderr.strip().split("\n") or [""])[-1]
+        except (ValueError, IndexError) as e:
+            measurements = []
+            error = str(e)
+        features, peak_bytes = [], []
+        for num_models, batch_size, seq_len, model_length, peak in measurements:
+            features.append(cls.get_features(num_models, batch_size, seq_len, 2*model_length+3))
+            peak_bytes.append(peak)
+            if verbose:
+                print(f"Memory probe: models={num_models} b={batch_size} L={seq_len} model length={model_length} peak={peak/2**20:.1f}MB")
+        if len(peak_bytes) < 3:
+            print(f"Warning: The memory probe failed ({error}). Using the default batch sizes.", file=sys.stderr)
+            return None
+        return cls.fit(features, peak_bytes, **kwargs)
+
+
+    @classmethod
+    def load(cls, cache_dir=None, calibrate=False, verbose=False, **kwargs):
+        """ Loads the coefficients for this machine from the cache. 
+        Args:
+            calibrate: If true, the coefficients are measured if they are not cached and 
+                        cached if the measurement succeeded.
+        Returns:
+            A MemoryCostModel or None if this machine is not calibrated.
+        """
+        cache_dir = get_cache_dir() if cache_dir is None else cache_dir
+        cache_file = os.path.join(cache_dir, "memory_cost_model.json")
+        key = _get_machine_key()
+        cache = {}
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        if key in cache:
+            return cls(cache[key], **kwargs)
+        if not calibrate:
+            return None
+        if verbose:
+            print("Calibrating the memory cost model for this machine (only done once).")
+        cost_model = cls.calibrate(verbose=verbose, **kwargs)
+        if cost_model is None:
+            return None #nothing is cached, the next calibration tries again
+        cache[key] = cost_model.coefficients.tolist()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, "w") as f:
+                json.dump(cache, f, indent=1)
+        except OSError:
+            pass #the model is still usable, it will be calibrated again next time
+        return cost_model
+
+
+_default_cost_model = None
+_default_cost_model_loaded = False
+
+def get_default_cost_model():
+    """ Returns the cost model of this machine. It is loaded from the cache on first use.
+        Returns None if the machine was never calibrated (see MemoryCostModel.load and calibrate_default_cost_model).
+    """
+    global _default_cost_model, _default_cost_model_loaded
+    if not _default_cost_model_loaded:
+        _default_cost_model = MemoryCostModel.load()
+        _default_cost_model_loaded = True
+    return _default_cost_model
+
+
+def calibrate_default_cost_model(verbose=False):
+    """ Loads the cost model of this machine and measures it first if it is not cached. 
+        Used by the console application, library calls never start the probe.
+        The probe should run before this process initializes a GPU.
+    """
+    global _default_cost_model, _default_cost_model_loaded
+    _default_cost_model = MemoryCostModel.load(calibrate=True, verbose=verbose)
+    _default_cost_model_loaded = True
+    return _default_cost_model
+
+
+def get_cache_dir():
+    """ The directory for machine-specific files. Can be changed with the environment variable LEARNMSA_CACHE_DIR.
+    """
+    if "LEARNMSA_CACHE_DIR" in os.environ:
+        return os.environ["LEARNMSA_CACHE_DIR"]
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "learnMSA")
+
+
+def get_device_memory():
+    """ Returns the memory in bytes of the first GPU or the available main memory if there is no GPU.
+    """
+    if len(tf.config.list_logical_devices("GPU")) > 0:
+        from learnMSA.msa_hmm.Configuration import get_gpu_memory
+        gpu_mem = get_gpu_memory()
+        if len(gpu_mem) > 0:
+            return gpu_mem[0] * 2**20
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 2**10
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _get_machine_key():
+    gpus = tf.config.list_physical_devices("GPU")
+    if len(gpus) > 0:
+        device = tf.config.experimental.get_device_details(gpus[0]).get("device_name", "GPU")
+    else:
+        device = platform.processor() or platform.machine()
+    return f"{platform.node()}|{device}|tf{tf.__version__}"
+
+
+def _measure_training_steps(model_generator, config, model_length, step_shapes):
+    """ Runs training steps on random sequences and returns their peak memory in bytes.
+    Args:
+        step_shapes: A list of (batch_size, seq_len) pairs.
+    """
+    tf.keras.backend.clear_session()
+    gc.collect()
+    num_models = config["num_models"]
+    model = model_generator(num_seq=max(b for b,_ in step_shapes),
+                            effective_num_seq=max(b for b,_ in step_shapes),
+                            model_lengths=[model_length]*num_models,
+                            config=config)
+    model.compile(optimizer=tf.keras.optimizers.Adam(config["learning_rate"]), jit_compile=False)
+    gpus = tf.config.list_logical_devices("GPU")
+    device = gpus[0].name if len(gpus) > 0 else "CPU:0"
+    alphabet_size = len(SequenceDataset.alphabet)-1
+    peak_bytes = []
+    for batch_size, seq_len in step_shapes:
+        sequences = np.random.randint(0, 20, size=(batch_size, num_models, seq_len+1)).astype(np.uint8)
+        sequences[..., -1] = alphabet_size
+        indices = np.tile(np.arange(batch_size)[:, np.newaxis], (1, num_models))
+        dummy_y = np.zeros((batch_size,), dtype=np.float32)
+        model.train_on_batch((sequences, indices), dummy_y) #traces the training step
+        tf.config.experimental.reset_memory_stats(device)
+        current = tf.config.experimental.get_memory_info(device)["current"]
+        model.train_on_batch((sequences, indices), dummy_y)
+        peak_bytes.append(tf.config.experimental.get_memory_info(device)["peak"] - current)
+    return peak_bytes
+
+
+def _probe():
+    """ Measures the peak memory of the probe steps with the default model. 
+        Runs in a separate process, since on CPU memory statistics require TensorFlow's BFC allocator.
+    """
+    #the probe must not occupy more device memory than it measures
+    for gpu in tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    from learnMSA.msa_hmm import Configuration, Training
+    measurements = []
+    for num_models, model_length, step_shapes in _PROBE_STEPS:
+        config = Configuration.make_default(num_models)
+        peak_bytes = _measure_training_steps(Training.default_model_generator, config, model_length, step_shapes)
+        for (batch_size, seq_len), peak in zip(step_shapes, peak_bytes):
+            measurements.append((num_models, batch_size, seq_len, model_length, peak))
+    return measurements
@@ -58,8 +58,12 @@ class HmmCell(tf.keras.layers.Layer):
         self.transitioner.recurrent_init()
         for em in self.emitter:
             em.recurrent_init()
-        self.log_A_dense = self.transitioner.make_log_A()
-        self.log_A_dense_t = tf.transpose(self.log_A_dense, [0,2,1])
+        if getattr(self.transitioner, "structured", False):
+            #avoid the O(q^2) matrix for long models, Viterbi creates it on demand
+            self.log_A_dense = self.log_A_dense_t = None
+        else:
+            self.log_A_dense = self.transitioner.make_log_A()
+            self.log_A_dense_t = tf.transpose(self.log_A_dense, [0,2,1])
         self.init_dist = self.make_initial_distribution()
         if not self.reverse and self.use_step_counter:
             self.step_counter.assign(-1)
@@ -15,6 +15,9 @@ class MsaHmmLayer(tf.keras.layers.Layer):
         sequence_weights: A tensor of shape (num_seqs,) that contains the weight of each sequence.
             parallel_factor: Increasing this number allows computing likelihoods and posteriors chunk-wise in parallel at the cost of memory usage.
                             The parallel factor has to be a divisor of the sequence length.
+        analytic_gradient: If true, the gradient of the log-likelihood is computed with a backward recursion instead of 
+                            differentiating through the forward recursion. This avoids storing the intermediates of all steps.
+                            Only used if parallel_factor is 1.
     """
     def __init__(self, 
                  cell, 
@@ -22,6 +25,7 @@ class MsaHmmLayer(tf.keras.layers.Layer):
                  use_prior=True,
                  sequence_weights=None,
                  parallel_factor=1,
+                 analytic_gradient=True,
                  **kwargs
                 ):
         super(MsaHmmLayer, self).__init__(**kwargs)
@@ -32,11 +36,15 @@ class MsaHmmLayer(tf.keras.layers.Layer):
         if sequence_weights is not None:
             self.weight_sum = np.sum(sequence_weights)
         self.parallel_factor = parallel_factor
+        self.analytic_gradient = analytic_gradient
         
         
     def build(self, input_shape):
         if self.built:
             return
+        if isinstance(input_shape[0], (tuple, list, tf.TensorShape)):
+            #sequences and lookup tables (see AncProbsLayer), the tables determine the input dimension
+            input_shape = input_shape[1]
         # build the cell
         self.cell.build((None, input_shape[-2], input_shape[-1]))
         # make a variant of the forward cell configured for backward
@@ -76,7 +84,7 @@ class MsaHmmLayer(tf.keras.layers.Layer):
         
         
     def forward_recursion(self, inputs, end_hints=None, 
-                            return_prior=False, training=False):
+                            return_prior=False, training=False, analytic_gradient=False):
         """ Computes the forward recursion for multiple models where each model
             receives a batch of sequences as input.
         Args:
@@ -84,6 +92,8 @@ class MsaHmmLayer(tf.keras.layers.Layer):
             end_hints: A tensor of shape (..., 2, num_states) that contains the correct state for the left and right ends of each chunk.
             return_prior: If true, the prior is computed and returned.
             training: If true, the cell is run in training mode.
+            analytic_gradient: If true, the log-likelihood is differentiated with a backward recursion. 
+                            The forward variables are not differentiable in this case.
         Returns:
             forward variables: Shape: (num_model, b, seq_len, q)
             log-likelihoods: Shape: (num_model, b)
@@ -91,7 +101,8 @@ class MsaHmmLayer(tf.keras.layers.Layer):
         #initialize transition- and emission-matricies
         return _forward_recursion_impl(inputs, self.cell, self.rnn, self.total_prob_rnn, 
                                        end_hints=end_hints, return_prior=return_prior,
-                                       training=training, parallel_factor=self.parallel_factor)
+                                       training=training, parallel_factor=self.parallel_factor,
+                                       reverse_cell=self.reverse_cell if analytic_gradient else None)
     
     
     def backward_recursion(self, inputs, end_hints=None, 
@@ -173,12 +184,18 @@ class MsaHmmLayer(tf.keras.layers.Layer):
             prior: Shape: (num_model)
             aux_loss: Shape: ()
         """
-        inputs = tf.cast(inputs, self.dtype)
+        if isinstance(inputs, (tuple, list)):
+            inputs = (inputs[0], tf.cast(inputs[1], self.dtype))
+        else:
+            inputs = tf.cast(inputs, self.dtype)
+        analytic_gradient = self.analytic_gradient and self.parallel_factor == 1 and not self.cell.use_step_counter
         if self.use_prior:
-            _, loglik, prior, aux_loss = self.forward_recursion(inputs, return_prior=True, training=training)
+            _, loglik, prior, aux_loss = self.forward_recursion(inputs, return_prior=True, training=training, 
+                                                                analytic_gradient=analytic_gradient)
             prior = self._scale_prior(prior)
         else:
-            _, loglik = self.forward_recursion(inputs, return_prior=False, training=training)
+            _, loglik = self.forward_recursion(inputs, return_prior=False, training=training, 
+                                               analytic_gradient=analytic_gradient)
         loglik_mean = self.apply_sequence_weights(loglik, indices, aggregate=True)
         loglik_mean = tf.squeeze(loglik_mean)
         if self.use_prior:
@@ -194,7 +211,8 @@ class MsaHmmLayer(tf.keras.layers.Layer):
              "num_seqs" : self.num_seqs,
              "use_prior" : self.use_prior, 
              "sequence_weights" : self.sequence_weights,
-             "parallel_factor" : self.parallel_factor
+             "parallel_factor" : self.parallel_factor,
+             "analytic_gradient" : self.analytic_gradient
         })
         return config
 
@@ -211,7 +229,7 @@ class MsaHmmLayer(tf.keras.layers.Layer):
 @tf.function
 def _forward_recursion_impl(inputs, cell, rnn, total_prob_rnn, 
                             end_hints=None, return_prior=False,
-                            training=False, parallel_factor=1):
+                            training=False, parallel_factor=1, reverse_cell=None):
     """ Computes the forward recursion for multiple models where each model
         receives a batch of sequences as input.
     Args:
@@ -223,16 +241,24 @@ def _forward_recursion_impl(inputs, cell, rnn, total_prob_rnn,
         return_prior: If true, the prior is computed and returned.
         training: If true, the cell is run in training mode.
         parallel_factor: Increasing this number allows computing likelihoods and posteriors chunk-wise in parallel at the cost of memory usage.
+        reverse_cell: If provided (requires parallel_factor == 1), the gradient of the log-likelihoods is computed 
+                    with a backward recursion using this cell (see _forward_with_analytic_gradient).
     Returns:
         forward variables: Shape: (num_model, b, seq_len, q)
         log-likelihoods: Shape: (num_model, b)
     """
     cell.recurrent_init()
     #initialize transition- and emission-matricies
-    _, b, seq_len, s = tf.unstack(tf.shape(inputs))
     num_model = cell.num_models
     q = cell.max_num_states
     emission_probs = cell.emission_probs(inputs, end_hints=end_hints, training=training)
+    if reverse_cell is not None:
+        assert parallel_factor == 1, "The analytic gradient requires parallel_factor == 1."
+        forward_result, loglik = _forward_with_analytic_gradient(emission_probs, cell, reverse_cell, rnn, training)
+        if return_prior:
+            return forward_result, loglik, cell.get_prior_log_density(), cell.get_aux_loss()
+        return forward_result, loglik
+    _, b, seq_len, _ = tf.unstack(tf.shape(emission_probs))
     #reshape to 3D inputs for RNN (cell will reshape back in each step)
     #if parallel_factor > 1, reshape to equally sized chunks
     chunk_size = seq_len // parallel_factor
@@ -262,6 +288,123 @@ def _forward_recursion_impl(inputs, cell, rnn, total_prob_rnn,
         return forward_result, loglik
 
 
+def _forward_with_analytic_gradient(emission_probs, cell, reverse_cell, rnn, training=False):
+    """ Runs the forward recursion (parallel_factor == 1) with a custom gradient of the log-likelihoods. 
+        Instead of storing the intermediates of every step for autodiff, the backward pass runs a backward recursion 
+        over the scaled forward variables (see _analytic_backward_recursion) that yields the gradients w.r.t. the 
+        emission probabilities (i.e. expected emission counts that are passed on to the emitters and encoders) 
+        and the expected transition counts from which the gradients of the transition parameters are derived.
+        The forward variables are returned without gradient.
+    Args:
+        emission_probs: Shape: (num_model, b, seq_len, q)
+        cell: HMM cell used for forward recursion.
+        reverse_cell: HMM cell configured for the backward recursion that shares the parameters of cell.
+        rnn: A RNN layer that runs the forward recursion.
+    Returns:
+        forward variables: Shape: (num_model, b, seq_len, q)
+        log-likelihoods: Shape: (num_model, b)
+    """
+    num_model = cell.num_models
+    q = cell.max_num_states
+    
+    @tf.custom_gradient
+    def forward_recursion(emission_probs):
+        #the transition kernels are read here such that tf passes them to grad
+        cell.transitioner.recurrent_init()
+        _, b, seq_len, _ = tf.unstack(tf.shape(emission_probs))
+        flat_emission_probs = tf.reshape(emission_probs, (num_model*b, seq_len, q))
+        initial_state = cell.get_initial_state(batch_size=b)
+        forward_1, step_1_state = cell(flat_emission_probs[:,0], initial_state, training=training, init=True)
+        forward, _, loglik = rnn(flat_emission_probs[:,1:], initial_state=step_1_state, training=training)
+        forward = tf.concat([forward_1[:,tf.newaxis], forward], axis=1) 
+        forward = tf.reshape(forward, (num_model, b, seq_len, -1))
+        log_scaled_forward = forward[...,:-1]
+        forward_result = log_scaled_forward + forward[..., -1:]
+        loglik = tf.reshape(loglik, (num_model, b))
+        
+        def grad(d_forward, d_loglik, variables=None):
+            reverse_cell.transitioner.recurrent_init()
+            with tf.GradientTape() as tape:
+                tape.watch(variables)
+                cell.transitioner.recurrent_init()
+                init = tf.reshape(cell.get_initial_state(batch_size=b)[0], (num_model, b, q))
+                with tape.stop_recording():
+                    d_emission_probs, d_init, d_transitions = _analytic_backward_recursion(log_scaled_forward, emission_probs, 
+                                                                                           init, d_loglik, cell, reverse_cell)
+                #the expected counts are constants, the gradient of this sum w.r.t. the parameters is the gradient of the log-likelihood
+                surrogate = tf.reduce_sum(d_init * init)
+                if getattr(cell.transitioner, "structured", False):
+                    scaled_forward = tf.math.exp(log_scaled_forward[:,:,:-1])
+                    R = cell.transitioner(tf.reshape(scaled_forward, (num_model, -1, q)))
+                    surrogate += tf.reduce_sum(tf.reshape(d_transitions, (num_model, -1, q)) * R)
+                else:
+                    surrogate += tf.reduce_sum(d_transitions * cell.transitioner.A)
+            variable_grads = tape.gradient(surrogate, variables, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            return d_emission_probs, variable_grads
+        
+        return (forward_result, loglik), grad
+    
+    forward_result, loglik = forward_recursion(emission_probs)
+    return tf.stop_gradient(forward_result), loglik
+
+
+def _analytic_backward_recursion(log_scaled_forward, emission_probs, init, d_loglik, cell, reverse_cell):
+    """ Computes the gradient of the weighted log-likelihoods by a backward recursion over the scaled forward variables 
+        of HmmCell.call. The recursion carries the gradient w.r.t. the scaled forward variables of the current position,
+        which are (up to scaling) the backward variables. 
+    Args:
+        log_scaled_forward: Logarithmic scaled forward variables. Shape: (num_model, b, seq_len, q)
+        emission_probs: Shape: (num_model, b, seq_len, q)
+        init: Initial distribution. Shape: (num_model, b, q)
+        d_loglik: Weights of the log-likelihoods. Shape: (num_model, b)
+        cell: HMM cell used for forward recursion.
+        reverse_cell: HMM cell configured for the backward recursion that shares the parameters of cell.
+    Returns:
+        The gradient w.r.t. the emission probabilities. Shape: (num_model, b, seq_len, q)
+        The gradient w.r.t. the initial distribution. Shape: (num_model, b, q)
+        The expected transition counts. Shape: (num_model, q, q) for a dense transition matrix or
+            the gradients w.r.t. the transitioned forward variables of the positions 1 to seq_len-1 if the 
+            transitioner is structured. Shape: (num_model, b, seq_len-1, q)
+    """
+    structured = getattr(cell.transitioner, "structured", False)
+    seq_len = tf.shape(emission_probs)[2]
+    w = d_loglik[..., tf.newaxis]
+    
+    def backward_step(g, scaled_forward, E, R):
+        #reverse of one step of HmmCell.call, returns the gradients w.r.t. R and E
+        E_clipped = tf.maximum(E, cell.epsilon)
+        R_clipped = tf.maximum(R, cell.epsilon)
+        S = tf.reduce_sum(E_clipped * R_clipped, axis=-1, keepdims=True)
+        d_u = (w + g - tf.reduce_sum(g * scaled_forward, axis=-1, keepdims=True)) / S
+        d_R = d_u * E_clipped * tf.cast(R >= cell.epsilon, R.dtype)
+        d_E = d_u * R_clipped * tf.cast(E >= cell.epsilon, E.dtype)
+        return d_R, d_E
+    
+    def body(i, g, d_transitions, d_E_array):
+        prev_scaled_forward = tf.math.exp(log_scaled_forward[:,:,i-1])
+        R = cell.transitioner(prev_scaled_forward)
+        d_R, d_E = backward_step(g, tf.math.exp(log_scaled_forward[:,:,i]), emission_probs[:,:,i], R)
+        if structured:
+            d_transitions = d_transitions.write(i-1, d_R)
+        else:
+            d_transitions += tf.matmul(prev_scaled_forward, d_R, transpose_a=True)
+        return i-1, reverse_cell.transitioner(d_R), d_transitions, d_E_array.write(i, d_E)
+    
+    if structured:
+        d_transitions = tf.TensorArray(emission_probs.dtype, size=seq_len-1)
+    else:
+        d_transitions = tf.zeros((cell.num_models, cell.max_num_states, cell.max_num_states), dtype=emission_probs.dtype)
+    d_E_array = tf.TensorArray(emission_probs.dtype, size=seq_len)
+    _, g, d_transitions, d_E_array = tf.while_loop(lambda i, *_: i > 0, body, 
+                                                   (seq_len-1, tf.zeros_like(init), d_transitions, d_E_array))
+    d_init, d_E = backward_step(g, tf.math.exp(log_scaled_forward[:,:,0]), emission_probs[:,:,0], init)
+    d_E_array = d_E_array.write(0, d_E)
+    d_emission_probs = tf.transpose(d_E_array.stack(), [1,2,0,3])
+    if structured:
+        d_transitions = tf.transpose(d_transitions.stack(), [1,2,0,3])
+    return d_emission_probs, d_init, d_transitions
+
+
 def _get_total_forward_from_chunks(forward, cell, total_prob_rnn, b, seq_len, parallel_factor=1):
     #utility method that computes the actual forward probabilities from the chunked forward variables
     #returns the forward probabilities and the log-likelihood
@@ -310,10 +453,10 @@ def _backward_recursion_impl(inputs, cell, reverse_cell,
     """
     cell.recurrent_init()
     reverse_cell.recurrent_init()
-    _, b, seq_len, s = tf.unstack(tf.shape(inputs))
     num_model = cell.num_models
     q = cell.max_num_states
     emission_probs = reverse_cell.emission_probs(inputs, end_hints=end_hints, training=training)
+    _, b, seq_len, _ = tf.unstack(tf.shape(emission_probs))
     #reshape to 3D inputs for RNN (cell will reshape back in each step)
     #if parallel_factor > 1, reshape to equally sized chunks
     chunk_size = seq_len // parallel_factor
@@ -398,10 +541,10 @@ def _state_posterior_log_probs_impl(inputs, cell, reverse_cell,
     """
     cell.recurrent_init()
     reverse_cell.recurrent_init()
-    _, b, seq_len, s = tf.unstack(tf.shape(inputs))
     num_model = cell.num_models
     q = cell.max_num_states
     emission_probs = cell.emission_probs(inputs, end_hints=end_hints, training=training)
+    _, b, seq_len, _ = tf.unstack(tf.shape(emission_probs))
     #reshape to equally sizes chunks according to parallel factor
     chunk_size = seq_len // parallel_factor
     emission_probs = tf.reshape(emission_probs, (num_model*b*parallel_factor, chunk_size, q))
@@ -3,7 +3,15 @@ import copy
 import math
 from Bio import SeqIO, SeqRecord, Seq
 import re
-from functools import partial
+import os
+import json
+import shutil
+import tempfile
+import weakref
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, lru_cache
 
 
 class SequenceDataset:
@@ -16,26 +24,38 @@ class SequenceDataset:
     
 
 
-    def __init__(self, filename=None, fmt="fasta", sequences=None, indexed=False, threads=None):
+    def __init__(self, filename=None, fmt="fasta", sequences=None, indexed=False, threads=None, collapse_duplicates=True):
         """
         Args:
             filename: Path to a sequence file in any supported format.
             fmt: Format of the file. Can be any format supported by Biopython's SeqIO.
             sequences: A list of id/sequence pairs as strings. If given, filename and fmt arguments are ignored.
-            indexed: If True, Biopython's index method is used to avoid loading the whole file into memory at once. Otherwise 
-                    regular parsing is used. Setting this to True will allow constant memory training at the cost of per-step performance.
-            threads: Number of threads to use for metadata computation.
+            indexed: If True, the sequences are not loaded into memory at once. Instead, they are accessed via a memory-mapped store on disk. 
+                    filename can either be a store directory created with make_sequence_store or a sequence file that is converted 
+                    to a temporary store that is deleted when the dataset is closed. Setting this to True allows training 
+                    with datasets larger than the memory.
+            threads: Number of processes used to parse large fasta files chunk-wise and to compute metadata like sequence 
+                    lengths. None or 1 means no parallelism.
+            collapse_duplicates: If True, training and decoding process each group of exact duplicate sequences only once 
+                    (see get_unique_indices).
         """
         if sequences is None and filename is None:
             raise ValueError("Either filename or sequences must be given.")
+        self._seq_buffer = None
+        self.seq_lens = None
+        self._first_invalid_seq = None
+        self._duplicate_reps = None
+        self._encoded_buffer = None
+        self.threads = threads
+        self.collapse_duplicates = collapse_duplicates
         if sequences is None:
             self.filename = filename
             self.fmt = fmt
             self.indexed = indexed
             try:
                 if indexed:
-                    self.record_dict = SeqIO.index(filename, fmt)
-                else:
+                    self._open_store(filename, fmt)
+                elif not (fmt == "fasta" and self._read_fasta(filename)):
                     self.record_dict = SeqIO.to_dict(SeqIO.parse(filename, fmt))
                 self.parsing_ok = True
             except ValueError as err:
@@ -49,13 +69,90 @@ class SequenceDataset:
             self.filename = ""
             self.fmt = ""
             self.indexed = False
-            self.record_dict = {s[0] : SeqRecord.SeqRecord(s[1], id=s[0]) for s in sequences}
-        self.seq_ids = list(self.record_dict)
-        self.num_seq = len(self.seq_ids)
-        self.seq_lens = np.array([sum([1 for x in str(self.get_record(i).seq) if x.isalpha()]) for i in range(self.num_seq)])
+            self._set_sequences(dict(sequences))
+        if self._seq_buffer is None:
+            self.seq_ids = list(self.record_dict)
+            self.num_seq = len(self.seq_ids)
+            self.seq_lens = np.array([sum([1 for x in str(self.get_record(i).seq) if x.isalpha()]) for i in range(self.num_seq)])
+        else:
+            self.num_seq = len(self.seq_ids)
+            if self.seq_lens is None:
+                self.seq_lens = _segment_sum(_ALPHA_LUT[self._seq_buffer], self._seq_offsets)
         self.max_len = np.amax(self.seq_lens) if self.seq_lens.size > 0 else 0
 
 
+    def _read_fasta(self, filename):
+        """ Reads a fasta file directly from its raw bytes. Returns False without side effects if 
+            the file contains anything the byte-level parser does not handle exactly like Biopython 
+            (non-ASCII bytes, a missing leading ">", bare carriage returns). In that case the 
+            caller falls back to SeqIO.
+        """
+        chunks = _read_fasta_chunks(filename, type(self).alphabet, self.threads)
+        if chunks is None:
+            return False
+        seq_ids, titles, seq_buffer, seq_offsets, seq_lens, first_invalid = _merge_chunks(chunks)
+        duplicates = _find_duplicate(seq_ids)
+        if duplicates is not None:
+            #same error as SeqIO.to_dict
+            raise ValueError(f"Duplicate key '{duplicates}'")
+        self.seq_ids = seq_ids
+        self._titles = titles
+        self._seq_buffer = seq_buffer
+        self._seq_offsets = seq_offsets
+        self.seq_lens = seq_lens
+        self._first_invalid_seq = first_invalid
+        return True
+
+
+    def _set_sequences(self, seq_dict):
+        """ Stores sequences given as id/sequence pairs. 
+        """
+        seq_strs = [str(seq) for seq in seq_dict.values()]
+        try:
+            raw = "".join(seq_strs).encode("ascii")
+        except UnicodeEncodeError:
+            self.record_dict = {sid : SeqRecord.SeqRecord(Seq.Seq(seq), id=sid) for sid, seq in zip(seq_dict, seq_strs)}
+            return
+        self.seq_ids = list(seq_dict)
+        self._titles = None
+        self._seq_buffer = np.frombuffer(raw, dtype=np.uint8)
+        self._seq_offsets = np.zeros(len(seq_strs)+1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seq_strs], out=self._seq_offsets[1:])
+
+
+    def _open_store(self, filename, fmt):
+        """ Opens a sequence store with memory-mapping. Builds a temporary store first if filename is not a store directory.
+        """
+        if os.path.isdir(filename):
+            store_dir = filename
+        else:
+            store_dir = tempfile.mkdtemp(prefix="learnMSA_store_")
+            # the temporary store is removed on close() or when the dataset is garbage collected
+            self._remove_store = weakref.finalize(self, shutil.rmtree, store_dir, True)
+            try:
+                make_sequence_store(filename, store_dir, fmt, threads=self.threads)
+            except Exception:
+                self._remove_store()
+                raise
+        with open(os.path.join(store_dir, _STORE_META)) as file:
+            meta = json.load(file)
+        if meta["version"] != _STORE_VERSION:
+            raise ValueError(f"{store_dir} was created with an incompatible version of learnMSA. Please rebuild it.")
+        with open(os.path.join(store_dir, _STORE_IDS), encoding="utf-8") as file:
+            self.seq_ids = file.read().split("\n")[:meta["num_seq"]]
+        with open(os.path.join(store_dir, _STORE_TITLES), encoding="utf-8") as file:
+            self._titles = file.read().split("\n")[:meta["num_seq"]]
+        self._seq_offsets = np.load(os.path.join(store_dir, _STORE_OFFSETS))
+        self.seq_lens = np.load(os.path.join(store_dir, _STORE_LENS))
+        if meta["alphabet"] == type(self).alphabet:
+            self._first_invalid_seq = meta["first_invalid_seq"]
+        if self._seq_offsets[-1] > 0:
+            # read-only memory mapping, safe to access from multiple threads 
+            self._seq_buffer = np.memmap(os.path.join(store_dir, _STORE_RESIDUES), dtype=np.uint8, mode="r")
+        else:
+            self._seq_buffer = np.zeros(0, dtype=np.uint8)
+
+
     def __enter__(self):
         return self
 
@@ -65,12 +162,68 @@ class SequenceDataset:
 
 
     def close(self):
-        if self.indexed:
-            self.record_dict.close()
+        if hasattr(self, "_remove_store"):
+            self._seq_buffer = None
+            self._remove_store()
 
 
     def get_record(self, i):
-        return self.record_dict[self.seq_ids[i]]
+        if self._seq_buffer is None:
+            return self.record_dict[self.seq_ids[i]]
+        sid = self.seq_ids[i]
+        seq = Seq.Seq(self._get_raw_seq(i).tobytes())
+        if self._titles is None:
+            return SeqRecord.SeqRecord(seq, id=sid)
+        return SeqRecord.SeqRecord(seq, id=sid, name=sid, description=self._titles[i])
+
+
+    def _get_raw_seq(self, i):
+        """ Returns the unmodified residues of the i-th sequence as a uint8 array 
+            or None if the sequence is not plain ASCII. 
+        """
+        if self._seq_buffer is None:
+            try:
+                return np.frombuffer(str(self.get_record(i).seq).encode("ascii"), dtype=np.uint8)
+            except UnicodeEncodeError:
+                return None
+        if i < 0:
+            i += self.num_seq
+        return self._seq_buffer[self._seq_offsets[i] : self._seq_offsets[i+1]]
+
+
+    def get_unique_indices(self, indices):
+        """ Collapses exact duplicates (sequences with identical residues) among the sequences specified by indices.
+            Each group of duplicates is represented by its first occurrence in the whole dataset, independent of indices.
+            If collapse_duplicates is False, the indices are returned unchanged.
+        Args:
+            indices: Sequence indices.
+        Returns:
+            unique_indices: Sorted indices of the representatives of the distinct sequences.
+            counts: How often each distinct sequence occurs in indices.
+            inverse: For each element of indices, the position of its representative in unique_indices.
+        """
+        indices = np.asarray(indices)
+        if not self.collapse_duplicates:
+            return indices, np.ones(indices.size, dtype=np.int64), np.arange(indices.size)
+        if self._duplicate_reps is None:
+            self._duplicate_reps = self._find_duplicate_reps()
+        unique_indices, inverse, counts = np.unique(self._duplicate_reps[indices], return_inverse=True, return_counts=True)
+        return unique_indices, counts, inverse.reshape(-1)
+
+
+    def _find_duplicate_reps(self):
+        """ Builds a content-hash index of the sequences. 
+        Returns:
+            An array with the index of the first sequence with identical content for each sequence.
+        """
+        reps = np.arange(self.num_seq)
+        first_occurrence = {}
+        for i in range(self.num_seq):
+            raw = self._get_raw_seq(i)
+            content = str(self.get_record(i).seq).encode() if raw is None else raw.data
+            key = hashlib.blake2b(content, digest_size=16).digest()
+            reps[i] = first_occurrence.setdefault(key, i)
+        return reps
 
 
     def get_alphabet_no_gap(self):
@@ -82,7 +235,11 @@ class SequenceDataset:
                             gap_symbols="-.", 
                             ignore_symbols="", 
                             replace_with_x = ""): 
-        seq_str = str(self.get_record(i).upper().seq)
+        raw = self._get_raw_seq(i)
+        if raw is None:
+            seq_str = str(self.get_record(i).upper().seq)
+        else:
+            seq_str = raw.tobytes().decode().upper()
         # replace non-standard aminoacids with X
         for aa in replace_with_x:
             seq_str = seq_str.replace(aa, 'X')
@@ -109,12 +266,18 @@ class SequenceDataset:
                         validate_alphabet=True, 
                         dtype=np.int16,
                         return_crop_boundaries=False):
-        seq_str = self.get_standardized_seq(i, remove_gaps, gap_symbols, ignore_symbols, replace_with_x)
-        # make sure the sequences do not contain any other symbols
-        if validate_alphabet:
-            if bool(re.compile(rf"[^{type(self).alphabet}]").search(seq_str)):
-                raise ValueError(f"Found unknown character(s) in sequence {self.seq_ids[i]}. Allowed alphabet: {type(self).alphabet}.")
-        seq = np.array([type(self).alphabet.index(aa) for aa in seq_str], dtype=dtype)
+        raw = self._get_raw_seq(i)
+        if raw is None:
+            seq = self._encode_seq_str(i, remove_gaps, gap_symbols, ignore_symbols, replace_with_x, validate_alphabet, dtype)
+        else:
+            lut = _get_encoding_lut(type(self).alphabet, remove_gaps, gap_symbols, ignore_symbols, replace_with_x)
+            seq = lut[raw]
+            if seq.size > 0 and seq.min() < 0:
+                if (seq == _INVALID).any():
+                    # produces the exact same error as the string based encoding
+                    self._encode_seq_str(i, remove_gaps, gap_symbols, ignore_symbols, replace_with_x, validate_alphabet, dtype)
+                seq = seq[seq != _REMOVED]
+            seq = seq.astype(dtype, copy=False)
         if seq.shape[0] > crop_to_length:
             #crop randomly
             start = np.random.randint(0, seq.shape[0] - crop_to_length + 1)
@@ -129,6 +292,64 @@ class SequenceDataset:
             return seq
      
         
+    def get_encoded_buffer(self, block_size=1<<24):
+        """ Encodes all sequences with the default arguments of get_encoded_seq into a single flat buffer. 
+            The result is computed once and cached. For indexed datasets, the buffer is kept in a temporary file on disk.
+        Returns:
+            A uint8 array with all encoded residues and int64 offsets such that sequence i 
+            is buffer[offsets[i]:offsets[i+1]].
+        """
+        if self._encoded_buffer is None:
+            if self._seq_buffer is None:
+                seqs = [self.get_encoded_seq(i, dtype=np.uint8) for i in range(self.num_seq)]
+                offsets = np.zeros(self.num_seq+1, dtype=np.int64)
+                np.cumsum([seq.size for seq in seqs], out=offsets[1:])
+                buffer = np.concatenate(seqs) if seqs else np.zeros(0, dtype=np.uint8)
+            else:
+                lut = _get_encoding_lut(type(self).alphabet, True, "-.", "", "BZJ")
+                # first pass: validate and count the encoded residues per sequence
+                counts = np.zeros(self.num_seq, dtype=np.int64)
+                for first, last in self._iter_seq_blocks(block_size):
+                    encoded = lut[self._seq_buffer[self._seq_offsets[first]:self._seq_offsets[last]]]
+                    invalid = np.flatnonzero(encoded == _INVALID)
+                    if invalid.size > 0:
+                        # produces the exact same error as get_encoded_seq
+                        self.get_encoded_seq(int(np.searchsorted(self._seq_offsets, self._seq_offsets[first] + invalid[0], side="right") - 1))
+                    counts[first:last] = _segment_sum(encoded != _REMOVED, self._seq_offsets[first:last+1] - self._seq_offsets[first])
+                offsets = np.zeros(self.num_seq+1, dtype=np.int64)
+                np.cumsum(counts, out=offsets[1:])
+                if self.indexed:
+                    buffer = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=(max(1, offsets[-1]),))
+                else:
+                    buffer = np.zeros(offsets[-1], dtype=np.uint8)
+                # second pass: fill the buffer
+                for first, last in self._iter_seq_blocks(block_size):
+                    encoded = lut[self._seq_buffer[self._seq_offsets[first]:self._seq_offsets[last]]]
+                    buffer[offsets[first]:offsets[last]] = encoded[encoded != _REMOVED]
+            self._encoded_buffer = (buffer, offsets)
+        return self._encoded_buffer
+
+
+    def _iter_seq_blocks(self, block_size):
+        """ Yields ranges (first, last) of consecutive sequences with roughly block_size residues in the raw buffer.
+        """
+        first = 0
+        while first < self.num_seq:
+            last = int(np.searchsorted(self._seq_offsets, self._seq_offsets[first] + block_size, side="right")) - 1
+            last = min(max(last, first+1), self.num_seq)
+            yield first, last
+            first = last
+
+
+    def _encode_seq_str(self, i, remove_gaps, gap_symbols, ignore_symbols, replace_with_x, validate_alphabet, dtype):
+        seq_str = self.get_standardized_seq(i, remove_gaps, gap_symbols, ignore_symbols, replace_with_x)
+        # make sure the sequences do not contain any other symbols
+        if validate_alphabet:
+            if bool(re.compile(rf"[^{type(self).alphabet}]").search(seq_str)):
+                raise ValueError(f"Found unknown character(s) in sequence {self.seq_ids[i]}. Allowed alphabet: {type(self).alphabet}.")
+        return np.array([type(self).alphabet.index(aa) for aa in seq_str], dtype=dtype)
+     
+        
     def validate_dataset(self, single_seq_ok=False, empty_seq_id_ok=False, dublicate_seq_id_ok=False):
         if not self.parsing_ok:
             raise self.err
@@ -144,12 +365,33 @@ class SequenceDataset:
             raise ValueError(f"{self.filename} contains empty sequences.") 
 
         if not empty_seq_id_ok:
-            for sid in self.seq_ids:
-                if sid == '':
-                    raise ValueError(f"File {self.filename} contains an empty sequence ID, which is not allowed.") 
+            if '' in self.seq_ids:
+                raise ValueError(f"File {self.filename} contains an empty sequence ID, which is not allowed.") 
         if len(self.seq_ids) > len(set(self.seq_ids)) and not dublicate_seq_id_ok:
             raise ValueError(f"File {self.filename} contains duplicated sequence IDs. learnMSA requires unique sequence IDs.") 
 
+        first_invalid = self._get_first_invalid_seq()
+        if first_invalid != -1:
+            raise ValueError(f"Found unknown character(s) in sequence {self.seq_ids[first_invalid]}. Allowed alphabet: {type(self).alphabet}.")
+
+
+    def _get_first_invalid_seq(self):
+        """ Returns the index of the first sequence that can not be encoded with the default arguments of 
+            get_encoded_seq or -1 if all sequences are valid. 
+        """
+        if self._first_invalid_seq is None:
+            if self._seq_buffer is None:
+                self._first_invalid_seq = -1
+                for i in range(self.num_seq):
+                    try:
+                        self.get_encoded_seq(i)
+                    except ValueError:
+                        self._first_invalid_seq = i
+                        break
+            else:
+                self._first_invalid_seq = _find_first_invalid_seq(self._seq_buffer, self._seq_offsets, type(self).alphabet)
+        return self._first_invalid_seq
+
 
 
 class AlignedDataset(SequenceDataset):
@@ -161,23 +403,75 @@ class AlignedDataset(SequenceDataset):
         super().__init__(filename, fmt, aligned_sequences, indexed, threads)
         self.single_seq_ok = single_seq_ok
         self.validate_dataset()
-        self.msa_matrix = np.zeros((self.num_seq, len(self.get_record(0))), dtype=np.int16)
-        for i in range(self.num_seq):
-            self.msa_matrix[i,:] = self.get_encoded_seq(i, remove_gaps=False, dtype=np.int16)
-        # compute a mapping from sequence positions to MSA-column index
-        cumsum = np.cumsum(self.msa_matrix != type(self).alphabet.index('-'), axis=1)  #A-B--C -> 112223
-        diff = np.diff(np.insert(cumsum, 0, 0.0, axis=1), axis=1) #112223 -> 0112223 -> [[(i+1) - i]] -> 101001
-        diff_where = [np.argwhere(diff[i,:]).flatten() for i in range(diff.shape[0])]
-        self.column_map = np.concatenate(diff_where).flatten()
-        self.starting_pos = np.cumsum(self.seq_lens)
-        self.starting_pos[1:] = self.starting_pos[:-1]
-        self.starting_pos[0] = 0
-        self.alignment_len = self.msa_matrix.shape[1]
+        self.alignment_len = len(self.get_record(0))
+        self._msa_matrix = None
+        # compute a mapping from sequence positions to MSA-column index, e.g. A-B--C -> 0,2,5
+        gap = type(self).alphabet.index('-')
+        self.column_map = np.concatenate([np.flatnonzero(block != gap) % self.alignment_len 
+                                            for _, block in self._iter_msa_blocks()])
+        self.starting_pos = np.zeros(self.num_seq, dtype=self.seq_lens.dtype)
+        np.cumsum(self.seq_lens[:-1], out=self.starting_pos[1:])
+
+
+    @property
+    def msa_matrix(self):
+        """ The encoded MSA as a (num_seq, alignment_len) int16 matrix. It is computed on first access. 
+            For indexed datasets, the matrix is kept in a temporary file on disk.
+        """
+        if self._msa_matrix is None:
+            shape = (self.num_seq, self.alignment_len)
+            if self.indexed:
+                msa_matrix = np.memmap(tempfile.TemporaryFile(), dtype=np.int16, mode="w+", shape=shape)
+            else:
+                msa_matrix = np.zeros(shape, dtype=np.int16)
+            for start, block in self._iter_msa_blocks():
+                msa_matrix[start:start+block.shape[0]] = block
+            self._msa_matrix = msa_matrix
+        return self._msa_matrix
+
+
+    def _iter_msa_blocks(self, block_size=1<<24):
+        """ Encodes the MSA in blocks of consecutive rows with roughly block_size residues each.
+        Yields:
+            Tuples (index of the first row, encoded rows as int16 matrix).
+        """
+        raw_msa = self._get_raw_msa()
+        rows_per_block = max(1, block_size // max(1, self.alignment_len))
+        lut = _get_encoding_lut(type(self).alphabet, False, "-.", "", "BZJ")
+        for start in range(0, self.num_seq, rows_per_block):
+            if raw_msa is None:
+                block = np.stack([self.get_encoded_seq(i, remove_gaps=False, dtype=np.int16) 
+                                    for i in range(start, min(start+rows_per_block, self.num_seq))])
+            else:
+                block = lut[raw_msa[start:start+rows_per_block]]
+                invalid_rows = np.flatnonzero(np.any(block == _INVALID, axis=1))
+                if invalid_rows.size > 0:
+                    # produces the exact same error as the string based encoding
+                    self._encode_seq_str(start + invalid_rows[0], False, "-.", "", "BZJ", True, np.int16)
+            yield start, block
+
+
+    def _get_raw_msa(self):
+        """ Returns the raw bytes of the MSA as (num_seq, alignment_len) uint8 matrix or None if 
+            the sequences are not ASCII.
+        """
+        if self._seq_buffer is None:
+            try:
+                raw = "".join(str(self.get_record(i).seq) for i in range(self.num_seq)).encode("ascii")
+            except UnicodeEncodeError:
+                return None
+            raw = np.frombuffer(raw, dtype=np.uint8)
+        else:
+            raw = self._seq_buffer
+        return raw.reshape(self.num_seq, self.alignment_len)
 
 
     def validate_dataset(self):
         super().validate_dataset(single_seq_ok=self.single_seq_ok, empty_seq_id_ok=False, dublicate_seq_id_ok=False)
-        record_lens = np.array([len(self.get_record(i)) for i in range(self.num_seq)])
+        if self._seq_buffer is None:
+            record_lens = np.array([len(self.get_record(i)) for i in range(self.num_seq)])
+        else:
+            record_lens = np.diff(self._seq_offsets)
         if np.any(record_lens != record_lens[0]):
             raise ValueError(f"File {self.filename} contains sequences of different lengths.")
 
@@ -189,26 +483,432 @@ class AlignedDataset(SequenceDataset):
 
 
     def SP_score(self, ref_data : "AlignedDataset", batch=512):
-        total_len = sum(self.seq_lens)
-        n = 0
-        true_positives = 0
-        self_positives = 0
-        ref_positives = 0
-        while n < self.column_map.shape[0]:
-            self_homologs = np.expand_dims(self.column_map,0)==np.expand_dims(self.column_map[n:n+batch],1)
-            ref_homologs = np.expand_dims(ref_data.column_map,0)==np.expand_dims(ref_data.column_map[n:n+batch],1)
-            true_positives += np.sum(np.logical_and(self_homologs, ref_homologs)) 
-            self_positives += np.sum(self_homologs)
-            ref_positives += np.sum(ref_homologs)
-            n+=batch
-        true_positives -= total_len
-        sp = true_positives / max(1, ref_positives - total_len)
-        return sp
+        """ Sum-of-pairs score, i.e. the fraction of homologous residue pairs in the reference that are also aligned in this MSA.
+        Args:
+            ref_data: Reference MSA of the same sequences in the same order.
+            batch: Unused, kept for compatibility.
+        """
+        return self.compare(ref_data)["SP"]
+
+
+    def TC_score(self, ref_data : "AlignedDataset"):
+        """ Total column score, i.e. the fraction of reference columns with at least two residues that occur identically in this MSA.
+        Args:
+            ref_data: Reference MSA of the same sequences in the same order.
+        """
+        return self.compare(ref_data)["TC"]
+
+
+    def compare(self, ref_data : "AlignedDataset"):
+        """ Compares this MSA to a reference by counting homologous residue pairs per pair of columns. 
+            Runs in O(N log N) for N residues.
+        Args:
+            ref_data: Reference MSA of the same sequences in the same order.
+        Returns:
+            A dictionary with the SP score, the TC score, the modeler score (fraction of aligned residue pairs in this MSA 
+            that are homologous in the reference) and the column scores (fraction of homologous residue pairs per 
+            reference column that are aligned in this MSA, nan for columns with less than two residues).
+        """
+        if self.column_map.size != ref_data.column_map.size or np.any(self.seq_lens != ref_data.seq_lens):
+            raise ValueError("The MSAs to compare must contain the same sequences in the same order.")
+        total_len = self.column_map.size
+        self_counts = np.bincount(self.column_map, minlength=self.alignment_len)
+        ref_counts = np.bincount(ref_data.column_map, minlength=ref_data.alignment_len)
+        # residues that share both their column in this MSA and their reference column
+        pair_keys = self.column_map.astype(np.int64) * ref_data.alignment_len + ref_data.column_map
+        keys, joint_counts = np.unique(pair_keys, return_counts=True)
+        self_cols, ref_cols = np.divmod(keys, ref_data.alignment_len)
+        # number of ordered residue pairs (including pairs of a residue with itself)
+        true_positives = np.sum(joint_counts.astype(np.int64)**2) - total_len
+        self_positives = np.sum(self_counts.astype(np.int64)**2) - total_len
+        ref_positives = np.sum(ref_counts.astype(np.int64)**2) - total_len
+        # a reference column is reproduced if all its residues form a column of this MSA that contains nothing else
+        reproduced = (joint_counts == ref_counts[ref_cols]) & (joint_counts == self_counts[self_cols]) & (joint_counts > 1)
+        ref_pairs = ref_counts.astype(np.int64) * (ref_counts - 1)
+        recovered_pairs = np.bincount(ref_cols, weights=joint_counts * (joint_counts - 1.), minlength=ref_data.alignment_len)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            column_scores = np.where(ref_pairs > 0, recovered_pairs / ref_pairs, np.nan)
+        return {"SP" : true_positives / max(1, ref_positives),
+                "TC" : np.sum(reproduced) / max(1, np.sum(ref_counts > 1)),
+                "modeler" : true_positives / max(1, self_positives),
+                "column_scores" : column_scores}
 
 
     def write(self, filename, fmt="fasta"):
-        sequences = list(self.record_dict.values())
+        sequences = [self.get_record(i) for i in range(self.num_seq)]
         for s in sequences:
             s.seq = Seq.Seq(s.seq)
             s.description = ""
-        SeqIO.write(sequences, filename, fmt)
\ No newline at end of file
+        SeqIO.write(sequences, filename, fmt)
+
+
+def compare_alignments(msa_datasets, ref_data, threads=None):
+    """ Compares many MSAs to a reference in parallel (see AlignedDataset.compare).
+    Args:
+        msa_datasets: A list of AlignedDatasets.
+        ref_data: Reference MSA of the same sequences in the same order.
+        threads: Number of threads. None means the number of CPU cores.
+    Returns:
+        A list of dictionaries with the scores of each MSA.
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(lambda msa: msa.compare(ref_data), msa_datasets))
+
+
+def make_sequence_store(filename, store_dir, fmt="fasta", block_size=1<<26, threads=None, alphabet=SequenceDataset.alphabet):
+    """ Converts a sequence file into a store that SequenceDataset can open with memory-mapping (indexed=True).
+        The store consists of a single buffer with the residues of all sequences (whitespace removed), 
+        int64 arrays with sequence offsets and lengths and tables with IDs and descriptions. The file 
+        is processed block-wise, i.e. the memory consumption does not depend on the file size.
+    Args:
+        filename: Path to a sequence file.
+        store_dir: Directory where the store is created. 
+        fmt: Format of the file. Can be any format supported by Biopython's SeqIO.
+        block_size: Number of bytes read at once from fasta files. 
+        threads: Number of processes used to parse blocks of fasta files in parallel. None or 1 means no parallelism.
+        alphabet: The alphabet used to validate the sequences.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    written = False
+    if fmt == "fasta":
+        written = _write_store(store_dir, _iter_fasta_chunks(filename, alphabet, block_size, threads), alphabet)
+    if not written:
+        written = _write_store(store_dir, _iter_seqio_chunks(filename, fmt, alphabet), alphabet)
+    assert written
+    
+    
+def _iter_seqio_chunks(filename, fmt, alphabet, records_per_chunk=10000):
+    """ Yields chunks of records parsed by Biopython in the same format as _parse_fasta_chunk.
+    """
+    def _chunk(records):
+        seqs = [str(r.seq).encode() for r in records]
+        seq_offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+        np.cumsum([len(s) for s in seqs], out=seq_offsets[1:])
+        seq_buffer = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        seq_lens = np.array([sum([1 for x in str(r.seq) if x.isalpha()]) for r in records], dtype=np.int64)
+        return ([r.id for r in records], 
+                [r.description for r in records],
+                seq_buffer, seq_offsets, seq_lens,
+                _find_first_invalid_seq(seq_buffer, seq_offsets, alphabet))
+    records = []
+    for record in SeqIO.parse(filename, fmt):
+        records.append(record)
+        if len(records) == records_per_chunk:
+            yield _chunk(records)
+            records = []
+    yield _chunk(records)
+
+
+def _write_store(store_dir, chunks, alphabet):
+    """ Writes parsed chunks of records to a store. Returns False if a chunk is None.
+    """
+    seq_ids = []
+    raw_lens, seq_lens = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    first_invalid_seq = -1
+    with open(os.path.join(store_dir, _STORE_RESIDUES), "wb") as residue_file, \
+            open(os.path.join(store_dir, _STORE_TITLES), "w", encoding="utf-8") as title_file:
+        for chunk in chunks:
+            if chunk is None:
+                return False
+            chunk_ids, chunk_titles, chunk_buffer, chunk_offsets, chunk_seq_lens, chunk_first_invalid = chunk
+            residue_file.write(chunk_buffer.tobytes())
+            for title in chunk_titles:
+                title_file.write(title + "\n")
+            if first_invalid_seq == -1 and chunk_first_invalid != -1:
+                first_invalid_seq = len(seq_ids) + chunk_first_invalid
+            seq_ids.extend(chunk_ids)
+            raw_lens.append(np.diff(chunk_offsets))
+            seq_lens.append(chunk_seq_lens)
+    duplicate = _find_duplicate(seq_ids)
+    if duplicate is not None:
+        #same error as SeqIO.to_dict and SeqIO.index
+        raise ValueError(f"Duplicate key '{duplicate}'")
+    with open(os.path.join(store_dir, _STORE_IDS), "w", encoding="utf-8") as id_file:
+        for sid in seq_ids:
+            id_file.write(sid + "\n")
+    offsets = np.zeros(len(seq_ids)+1, dtype=np.int64)
+    np.cumsum(np.concatenate(raw_lens), out=offsets[1:])
+    np.save(os.path.join(store_dir, _STORE_OFFSETS), offsets)
+    np.save(os.path.join(store_dir, _STORE_LENS), np.concatenate(seq_lens).astype(np.int64))
+    meta = {"version" : _STORE_VERSION, 
+            "num_seq" : len(seq_ids), 
+            "alphabet" : alphabet, 
+            "first_invalid_seq" : int(first_invalid_seq)}
+    with open(os.path.join(store_dir, _STORE_META), "w") as meta_file:
+        meta_file.write(json.dumps(meta, indent=4))
+    return True
+
+
+def _read_fasta_chunks(filename, alphabet, threads=None):
+    """ Parses a fasta file in memory. Large files are split into chunks that are parsed in parallel if threads > 1.
+    Returns:
+        A list of parsed chunks (see _parse_fasta_chunk) or None if the file can not be handled by the byte-level parser.
+    """
+    file_size = os.path.getsize(filename)
+    num_chunks = min(threads or 1, file_size // _MIN_CHUNK_SIZE)
+    if num_chunks > 1:
+        chunks = list(_map_fasta_chunks(filename, _find_chunk_boundaries(filename, num_chunks), alphabet, num_chunks))
+    else:
+        chunks = [_parse_fasta_chunk(filename, 0, file_size, alphabet)]
+    if any(chunk is None for chunk in chunks):
+        return None
+    return chunks
+
+
+def _iter_fasta_chunks(filename, alphabet, block_size, threads=None):
+    """ Yields parsed chunks of roughly block_size bytes of a fasta file. 
+        Stops with None if a chunk can not be handled by the byte-level parser.
+    """
+    if threads is not None and threads > 1:
+        num_chunks = max(1, os.path.getsize(filename) // block_size)
+        for chunk in _map_fasta_chunks(filename, _find_chunk_boundaries(filename, num_chunks), alphabet, threads):
+            yield chunk
+            if chunk is None:
+                return
+    else:
+        with open(filename, "rb") as file:
+            for block in _read_record_blocks(file, block_size):
+                chunk = _parse_fasta_bytes_chunk(block, alphabet)
+                yield chunk
+                if chunk is None:
+                    return
+
+
+def _map_fasta_chunks(filename, boundaries, alphabet, threads):
+    """ Parses the chunks of a fasta file defined by consecutive boundaries on a process pool.
+        Yields the chunks in order and keeps only a limited number of parsed chunks in memory.
+    """
+    # use spawn, forking a process that has already initialized tensorflow is unsafe
+    with ProcessPoolExecutor(threads, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = []
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            futures.append(pool.submit(_parse_fasta_chunk, filename, start, end, alphabet))
+            if len(futures) == 2*threads:
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+
+def _find_chunk_boundaries(filename, num_chunks):
+    """ Splits a fasta file into num_chunks parts of roughly equal size. 
+        Returns num_chunks+1 byte offsets where each but the last one is at the start of a record.
+    """
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as file:
+        for i in range(1, num_chunks):
+            pos = max(boundaries[-1], i * file_size // num_chunks)
+            file.seek(pos)
+            # search the next record start
+            window = b""
+            while True:
+                block = file.read(1<<16)
+                window += block
+                cut = window.find(b"\n>")
+                if cut != -1 or not block:
+                    break
+            if cut == -1:
+                break
+            boundaries.append(pos + cut + 1)
+    boundaries.append(file_size)
+    return sorted(set(boundaries))
+
+
+def _parse_fasta_chunk(filename, start, end, alphabet):
+    """ Reads the bytes start to end of a fasta file and parses them. Runs in worker processes. 
+    """
+    with open(filename, "rb") as file:
+        file.seek(start)
+        raw = file.read(end-start)
+    return _parse_fasta_bytes_chunk(raw, alphabet)
+
+
+def _parse_fasta_bytes_chunk(raw, alphabet):
+    """ Parses raw fasta bytes and computes metadata.
+    Returns:
+        A tuple (seq_ids, titles, seq_buffer, seq_offsets, seq_lens, first_invalid_seq) or None if 
+        the content can not be handled by the byte-level parser.
+    """
+    parsed = _parse_fasta_bytes(raw)
+    if parsed is None:
+        return None
+    seq_ids, titles, seq_buffer, seq_offsets = parsed
+    seq_lens = _segment_sum(_ALPHA_LUT[seq_buffer], seq_offsets)
+    return seq_ids, titles, seq_buffer, seq_offsets, seq_lens, _find_first_invalid_seq(seq_buffer, seq_offsets, alphabet)
+
+
+def _merge_chunks(chunks):
+    """ Concatenates parsed chunks. 
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    seq_ids = [sid for chunk in chunks for sid in chunk[0]]
+    titles = [title for chunk in chunks for title in chunk[1]]
+    seq_buffer = np.concatenate([chunk[2] for chunk in chunks])
+    buffer_starts = np.cumsum([0] + [chunk[2].size for chunk in chunks])
+    seq_offsets = np.concatenate([chunk[3][:-1] + s for chunk, s in zip(chunks, buffer_starts)] + [buffer_starts[-1:]])
+    seq_lens = np.concatenate([chunk[4] for chunk in chunks])
+    first_invalid_seq = -1
+    num_seq = 0
+    for chunk in chunks:
+        if chunk[5] != -1:
+            first_invalid_seq = num_seq + chunk[5]
+            break
+        num_seq += len(chunk[0])
+    return seq_ids, titles, seq_buffer, seq_offsets, seq_lens, first_invalid_seq
+
+
+def _find_first_invalid_seq(seq_buffer, seq_offsets, alphabet):
+    """ Returns the index of the first sequence with symbols that can not be encoded with the default 
+        arguments of SequenceDataset.get_encoded_seq or -1 if there is no such sequence.
+    """
+    lut = _get_encoding_lut(alphabet, True, "-.", "", "BZJ")
+    invalid = np.flatnonzero(lut[seq_buffer] == _INVALID)
+    if invalid.size == 0:
+        return -1
+    return int(np.searchsorted(seq_offsets, invalid[0], side="right") - 1)
+
+
+def _read_record_blocks(file, block_size):
+    """ Reads a fasta file opened in binary mode in blocks of roughly block_size bytes 
+        that start with a record. A single record is never split across blocks.
+    """
+    rest = b""
+    while True:
+        block = file.read(block_size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        block = rest + block
+        cut = block.rfind(b"\n>")
+        if cut == -1:
+            rest = block
+        else:
+            yield block[:cut+1]
+            rest = block[cut+1:]
+
+
+
+# fasta files are parsed in parallel only if each process gets at least this many bytes
+_MIN_CHUNK_SIZE = 1<<24
+
+# files of a sequence store
+_STORE_VERSION = 2
+_STORE_META = "meta.json"
+_STORE_RESIDUES = "residues.bin"
+_STORE_OFFSETS = "offsets.npy"
+_STORE_LENS = "seq_lens.npy"
+_STORE_IDS = "ids.txt"
+_STORE_TITLES = "titles.txt"
+
+# lookup table marking the bytes that count towards the sequence length (same as str.isalpha for ASCII)
+_ALPHA_LUT = np.array([chr(b).isalpha() for b in range(256)], dtype=bool)
+# Biopython removes line breaks, carriage returns and spaces everywhere, other whitespace only at the end of a line
+_WHITESPACE_LUT = np.isin(np.arange(256), list(b" \r\n"))
+_LINE_END_WHITESPACE_LUT = np.array([chr(b).isspace() for b in range(256)], dtype=bool) & ~_WHITESPACE_LUT
+# special values of the encoding lookup tables
+_REMOVED = -1
+_INVALID = -2
+
+
+@lru_cache(maxsize=None)
+def _get_encoding_lut(alphabet, remove_gaps, gap_symbols, ignore_symbols, replace_with_x):
+    """ Returns a 256-entry table that maps each byte to its index in the alphabet. Each byte is sent 
+        through the same string operations as in SequenceDataset.get_standardized_seq, so applying the table to 
+        a sequence yields exactly the same result. Removed bytes are mapped to _REMOVED and bytes that are 
+        not in the alphabet after standardization are mapped to _INVALID.
+    """
+    lut = np.zeros(256, dtype=np.int16)
+    for b in range(256):
+        c = chr(b).upper()
+        for aa in replace_with_x:
+            c = c.replace(aa, 'X')
+        if remove_gaps:
+            for s in gap_symbols:
+                c = c.replace(s, '')
+        else:
+            for s in gap_symbols:
+                c = c.replace(s, gap_symbols[0])
+        for s in ignore_symbols:
+            c = c.replace(s, '')
+        if c == "":
+            lut[b] = _REMOVED
+        elif len(c) == 1 and c in alphabet:
+            lut[b] = alphabet.index(c)
+        else:
+            lut[b] = _INVALID
+    return lut
+
+
+def _parse_fasta_bytes(raw):
+    """ Parses the raw bytes of a fasta file with the same rules as Biopython's fasta parser.
+    Args:
+        raw: The content of a fasta file as bytes.
+    Returns:
+        A tuple (seq_ids, titles, seq_buffer, seq_offsets) or None if the content can not be handled 
+        by this parser. seq_buffer is a uint8 array of all residues without line breaks, spaces and trailing 
+        whitespace and sequence i is seq_buffer[seq_offsets[i]:seq_offsets[i+1]]. Like in Biopython, other whitespace 
+        (e.g. tabs) within a line is kept and makes the sequence invalid.
+    """
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    if buf.size == 0:
+        return [], [], np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+    if buf[0] != ord(">") or np.any(buf > 127):
+        return None
+    if raw.count(b"\r") != raw.count(b"\r\n"):
+        return None #old mac line breaks, let Biopython handle them
+    newlines = np.flatnonzero(buf == ord("\n"))
+    line_starts = np.concatenate([[0], newlines+1])
+    line_starts = line_starts[line_starts < buf.size]
+    header_starts = line_starts[buf[line_starts] == ord(">")]
+    # each header ends at the next line break or the end of the file
+    header_ends = np.append(newlines, buf.size)[np.searchsorted(newlines, header_starts)]
+    titles = [raw[s+1:e].decode().rstrip() for s,e in zip(header_starts, header_ends)]
+    seq_ids = [(t.split(None, 1) or [""])[0] for t in titles]
+    # mask out headers and whitespace
+    header_delta = np.zeros(buf.size+1, dtype=np.int8)
+    header_delta[header_starts] = 1
+    header_delta[header_ends] -= 1
+    keep = np.cumsum(header_delta[:-1], dtype=np.int8) == 0
+    keep &= ~_WHITESPACE_LUT[buf]
+    # other whitespace is removed if only whitespace follows until the end of the line (rare, scanned run-wise)
+    other_whitespace = np.flatnonzero(_LINE_END_WHITESPACE_LUT[buf])
+    if other_whitespace.size > 0:
+        run_end = other_whitespace + 1
+        while True:
+            in_run = run_end < buf.size
+            in_run[in_run] = _LINE_END_WHITESPACE_LUT[buf[run_end[in_run]]] | (buf[run_end[in_run]] == ord(" ")) | (buf[run_end[in_run]] == ord("\r"))
+            if not np.any(in_run):
+                break
+            run_end[in_run] += 1
+        at_line_end = (run_end == buf.size) | (buf[np.minimum(run_end, buf.size-1)] == ord("\n"))
+        keep[other_whitespace[at_line_end]] = False
+    counts = _segment_sum(keep, np.append(header_starts, buf.size))
+    seq_offsets = np.zeros(len(titles)+1, dtype=np.int64)
+    np.cumsum(counts, out=seq_offsets[1:])
+    seq_buffer = buf[keep]
+    return seq_ids, titles, seq_buffer, seq_offsets
+
+
+def _segment_sum(x, offsets):
+    """ Sums x over the segments x[offsets[i]:offsets[i+1]], where offsets is non-decreasing. Empty segments are allowed.
+    """
+    starts = offsets[:-1]
+    non_empty = np.diff(offsets) > 0
+    sums = np.zeros(starts.size, dtype=np.int64)
+    if np.any(non_empty):
+        sums[non_empty] = np.add.reduceat(x[:offsets[-1]], starts[non_empty], dtype=np.int64)
+    return sums
+
+
+def _find_duplicate(seq_ids):
+    """ Returns the first sequence ID that occurs a second time or None if all IDs are unique. 
+    """
+    if len(set(seq_ids)) == len(seq_ids):
+        return None
+    seen = set()
+    for sid in seq_ids:
+        if sid in seen:
+            return sid
+        seen.add(sid)
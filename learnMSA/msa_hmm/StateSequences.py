@@ -0,0 +1,302 @@
+import numpy as np
+
+
+
+class StateSequences():
+    """ Ragged storage of the most likely state sequences of a number of profile HMMs for a number of sequences.
+        Each sequence occupies only its own length (plus the terminal position) in a flat buffer per model.
+        Optionally, the state sequences are run-length encoded. A run is either a repetition of a
+        flank, insertion, unannotated or terminal state or a chain of consecutive match states.
+        Viterbi paths of profile HMMs typically consist of only a few such runs.
+        Rows can be indexed like a dense array of shape (num_seq, max_len) per model (see ModelStateSequences),
+        positions after the end of a sequence contain the terminal state.
+    Args:
+        model_lengths: The number of match states per model.
+        lens: The number of states stored per sequence.
+        run_length_encoded: If true, sequences are stored as runs.
+    """
+    def __init__(self, model_lengths, lens, run_length_encoded=False):
+        self.model_lengths = list(model_lengths)
+        self.num_models = len(self.model_lengths)
+        self.terminal_states = np.array([2*length+2 for length in self.model_lengths])
+        self.lens = np.asarray(lens, dtype=np.int64)
+        self.run_length_encoded = run_length_encoded
+        self.dtype = np.uint16 if np.amax(self.terminal_states) <= np.iinfo(np.uint16).max else np.uint32
+        #maps rows to the stored sequences, rows can share storage (e.g. for duplicates)
+        self.slots = np.arange(self.lens.size)
+        self.offsets = np.zeros(self.lens.size+1, dtype=np.int64)
+        np.cumsum(self.lens, out=self.offsets[1:])
+        if run_length_encoded:
+            #first state and start position in the flat layout of each run, sorted by position 
+            self.run_states = [np.zeros(0, dtype=self.dtype) for _ in range(self.num_models)]
+            self.run_positions = [np.zeros(0, dtype=np.int64) for _ in range(self.num_models)]
+            self._pending = []
+        else:
+            self.buffer = np.zeros((self.num_models, self.offsets[-1]), dtype=self.dtype)
+            self.buffer += self.terminal_states[:, np.newaxis].astype(self.dtype)
+            self._shared_buffer = False
+
+
+    @classmethod
+    def from_dense(cls, state_seqs, model_lengths, lens=None, run_length_encoded=False):
+        """ Creates ragged state sequences from a dense array of shape (num_models, num_seq, L).
+        Args:
+            lens: The number of states stored per sequence. Defaults to L for all sequences.
+        """
+        state_seqs = np.asarray(state_seqs)
+        lens = np.full(state_seqs.shape[1], state_seqs.shape[2]) if lens is None else lens
+        ragged = cls(model_lengths, lens, run_length_encoded)
+        ragged.set_batch(np.arange(state_seqs.shape[1]), state_seqs)
+        return ragged
+
+
+    @property
+    def num_seq(self):
+        return self.slots.size
+
+
+    @property
+    def max_len(self):
+        return int(np.amax(self.lens[self.slots])) if self.num_seq > 0 else 0
+
+
+    def __len__(self):
+        return self.num_models
+
+
+    def __getitem__(self, model):
+        return ModelStateSequences(self, model)
+
+
+    def __iter__(self):
+        for i in range(self.num_models):
+            yield self[i]
+
+
+    def set_batch(self, rows, batch):
+        """ Stores the state sequences of a batch.
+        Args:
+            rows: Rows of the sequences in the batch. Shape (b)
+            batch: A dense batch of state sequences that are at least as long as the stored lengths. Shape (num_models, b, L)
+        """
+        slots = self.slots[rows]
+        lens = self.lens[slots]
+        valid = np.arange(batch.shape[-1])[np.newaxis] < lens[:,np.newaxis]
+        if self.run_length_encoded:
+            for i, length in enumerate(self.model_lengths):
+                states, starts, counts = _encode_runs(batch[i], valid, length)
+                self._pending.append((i, states, np.repeat(self.offsets[slots], counts) + starts))
+        else:
+            self._own_buffer()
+            positions = self.offsets[slots][:,np.newaxis] + np.arange(batch.shape[-1])[np.newaxis]
+            self.buffer[:, positions[valid]] = batch[:, valid]
+
+
+    def get_states(self, model, rows, positions):
+        """ Returns the states at the given positions of the given rows. Positions after the end of a sequence
+            contain the terminal state.
+        """
+        self._assemble()
+        slots = self.slots[rows]
+        positions = np.asarray(positions, dtype=np.int64)
+        positions, slots = np.broadcast_arrays(positions, slots)
+        lens = self.lens[slots]
+        inside = positions < lens
+        states = np.full(positions.shape, self.terminal_states[model], dtype=self.dtype)
+        global_positions = self.offsets[slots][inside] + positions[inside]
+        if self.run_length_encoded:
+            run = np.searchsorted(self.run_positions[model], global_positions, side="right") - 1
+            run_states = self.run_states[model][run].astype(np.int64)
+            is_match = (run_states > 0) & (run_states <= self.model_lengths[model])
+            states[inside] = run_states + is_match * (global_positions - self.run_positions[model][run])
+        else:
+            states[inside] = self.buffer[model, global_positions]
+        return states
+
+
+    def get_runs(self, model, return_lengths=False):
+        """ Returns the runs of all rows.
+        Args:
+            return_lengths: If true, the lengths of the runs are returned as well.
+        Returns:
+            run_states: The first state of each run.
+            run_starts: The start position of each run in its sequence.
+            run_rows: The row of each run. The runs are grouped by rows in increasing order.
+            run_lengths: (Optional) The number of positions of each run.
+        """
+        self._assemble()
+        if self.run_length_encoded:
+            states, positions = self.run_states[model], self.run_positions[model]
+        else:
+            #runs start at the beginning of each sequence and where a run can not be continued
+            flat = self.buffer[model]
+            seq_start = np.zeros(flat.size, dtype=bool)
+            seq_start[self.offsets[:-1][self.lens > 0]] = True
+            positions = np.flatnonzero(seq_start | ~_continues_run(flat, self.model_lengths[model]))
+            states = flat[positions]
+        run_offsets = np.searchsorted(positions, self.offsets)
+        slot_starts, counts = run_offsets[self.slots], np.diff(run_offsets)[self.slots]
+        runs = _concat_ranges(slot_starts, counts)
+        run_rows = np.repeat(np.arange(self.num_seq), counts)
+        run_starts = positions[runs] - self.offsets[self.slots][run_rows]
+        if return_lengths:
+            #a run ends where the next one starts, each sequence starts a new run
+            lengths = np.diff(np.append(positions, self.offsets[-1]))
+            return states[runs], run_starts, run_rows, lengths[runs]
+        return states[runs], run_starts, run_rows
+
+
+    def to_dense(self, rows=None, return_valid=False, models=None):
+        """ Converts (a subset of) the rows to a dense array padded with terminal states.
+        Returns:
+            An array of shape (num_models, len(rows), L) where L is the maximum length of the selected rows.
+        """
+        rows = np.arange(self.num_seq) if rows is None else np.asarray(rows)
+        models = range(self.num_models) if models is None else models
+        lens = self.lens[self.slots[rows]]
+        max_len = int(np.amax(lens)) if rows.size > 0 else 0
+        positions = np.arange(max_len)[np.newaxis]
+        dense = np.stack([self.get_states(i, rows[:,np.newaxis], positions) for i in models])
+        if return_valid:
+            return dense, positions < lens[:,np.newaxis]
+        return dense
+
+
+    def select(self, rows):
+        """ Returns the state sequences of the given rows. The storage is shared until the selection is modified,
+            modifications of the selection do not change this object.
+        """
+        self._assemble()
+        selection = StateSequences.__new__(StateSequences)
+        selection.__dict__.update(self.__dict__)
+        selection.slots = self.slots[rows]
+        if self.run_length_encoded:
+            selection.run_states, selection.run_positions = list(self.run_states), list(self.run_positions)
+            selection._pending = []
+        else:
+            selection._shared_buffer = True
+        return selection
+
+
+    def replace(self, rows, other):
+        """ Replaces the state sequences of the given rows by the sequences in another object
+            with the same models and with rows of the same lengths.
+        """
+        self._assemble()
+        rows = np.asarray(rows)
+        if rows.size == 0:
+            return
+        #rows that share a slot are written once
+        _, first = np.unique(self.slots[rows], return_index=True)
+        rows, other = rows[first], other.select(first)
+        if self.run_length_encoded:
+            replaced = np.zeros(self.lens.size, dtype=bool)
+            replaced[self.slots[rows]] = True
+            for i in range(self.num_models):
+                run_slots = np.searchsorted(self.offsets, self.run_positions[i], side="right") - 1
+                keep = ~replaced[run_slots]
+                states, starts, other_rows = other.get_runs(i)
+                positions = self.offsets[self.slots[rows]][other_rows] + starts
+                self._pending.append((i, states, positions))
+                self.run_states[i] = self.run_states[i][keep]
+                self.run_positions[i] = self.run_positions[i][keep]
+            self._assemble()
+        else:
+            self._own_buffer()
+            batch, valid = other.to_dense(return_valid=True)
+            slots = self.slots[rows]
+            positions = self.offsets[slots][:,np.newaxis] + np.arange(batch.shape[-1])[np.newaxis]
+            self.buffer[:, positions[valid]] = batch[:, valid]
+
+
+    def _own_buffer(self):
+        # a selection copies the shared buffer before its first modification
+        if self._shared_buffer:
+            self.buffer = np.copy(self.buffer)
+            self._shared_buffer = False
+
+
+    def _assemble(self):
+        # merges the runs of pending batches into the sorted runs
+        if not self.run_length_encoded or len(self._pending) == 0:
+            return
+        for i in range(self.num_models):
+            pending = [p for p in self._pending if p[0] == i]
+            states = np.concatenate([self.run_states[i]] + [states for _,states,_ in pending])
+            positions = np.concatenate([self.run_positions[i]] + [positions for _,_,positions in pending])
+            order = np.argsort(positions)
+            self.run_states[i] = states[order].astype(self.dtype)
+            self.run_positions[i] = positions[order]
+        self._pending = []
+
+
+
+class ModelStateSequences():
+    """ A view on the state sequences of a single model that can be indexed like a
+        dense array of shape (num_seq, max_len) with [rows, positions].
+    """
+    def __init__(self, state_seqs, model):
+        self.state_seqs = state_seqs
+        self.model = model
+
+
+    @property
+    def shape(self):
+        return (self.state_seqs.num_seq, self.state_seqs.max_len)
+
+
+    def __getitem__(self, key):
+        rows, positions = key
+        return self.state_seqs.get_states(self.model, rows, positions)
+
+
+    def to_dense(self, rows=None):
+        return self.state_seqs.to_dense(rows, models=[self.model])[0]
+
+
+    def get_runs(self, return_lengths=False):
+        return self.state_seqs.get_runs(self.model, return_lengths)
+
+
+
+def _continues_run(states, model_length):
+    """ Returns a boolean vector that is true for all but the first position where the state continues 
+        the run of the previous position.
+    """
+    states = states.astype(np.int64)
+    is_match = (states > 0) & (states <= model_length)
+    continues = np.zeros(states.shape, dtype=bool)
+    continues[...,1:] = (((states[...,1:] == states[...,:-1]) & ~is_match[...,1:])
+                        | ((states[...,1:] == states[...,:-1]+1) & is_match[...,1:] & is_match[...,:-1]))
+    return continues
+
+
+def get_dense_runs(state_seqs, model_length):
+    """ Returns the runs of a dense array of state sequences of shape (num_seq, L) in the same format as 
+        StateSequences.get_runs with return_lengths=True.
+    """
+    state_seqs = np.asarray(state_seqs)
+    rows, starts = np.nonzero(~_continues_run(state_seqs, model_length))
+    positions = rows * state_seqs.shape[1] + starts
+    lengths = np.diff(np.append(positions, state_seqs.size))
+    return state_seqs[rows, starts], starts, rows, lengths
+
+
+def _encode_runs(batch, valid, model_length):
+    """ Encodes a dense batch of state sequences of shape (b, L) as runs.
+    Args:
+        valid: Boolean mask of the positions that are stored. Shape (b, L)
+    Returns:
+        The first state and start position of each run ordered by rows and the number of runs per row.
+    """
+    rows, starts = np.nonzero(~_continues_run(batch, model_length) & valid)
+    return batch[rows, starts], starts.astype(np.int64), np.bincount(rows, minlength=batch.shape[0])
+
+
+def _concat_ranges(starts, counts):
+    # concatenation of the ranges [starts[i], starts[i]+counts[i])
+    total = np.sum(counts)
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.arange(total) + np.repeat(starts - (ends - counts), counts)
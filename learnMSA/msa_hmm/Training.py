@@ -1,10 +1,13 @@
 import tensorflow as tf
 import numpy as np
 import math
+import inspect
+import warnings
 from functools import partial
 from learnMSA.msa_hmm.MsaHmmCell import MsaHmmCell
 from learnMSA.msa_hmm.MsaHmmLayer import MsaHmmLayer
 from learnMSA.msa_hmm.AncProbsLayer import AncProbsLayer
+from learnMSA.msa_hmm.Emitter import ProfileHMMEmitter
 from learnMSA.msa_hmm.Configuration import assert_config
 from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
 from learnMSA.msa_hmm.Utility import deserialize
@@ -54,6 +57,12 @@ class LearnMSAModel(tf.keras.Model):
             loss = -self.loglik(y_pred)
         loss += sum(self.losses)
         self.loss_tracker.update_state(loss)
+        if sample_weight is not None:
+            #a single weight per batch (see make_dataset), the tracked loss remains unweighted
+            batch_weight = tf.reduce_mean(tf.cast(sample_weight, loss.dtype))
+            if hasattr(self.optimizer, "batch_weight"):
+                self.optimizer.batch_weight.assign(batch_weight)
+            loss *= batch_weight
         return loss
 
     def compute_metrics(self, x, y, y_pred, sample_weight):
@@ -75,6 +84,55 @@ class LearnMSAModel(tf.keras.Model):
         self.aux_loss_tracker.reset_state()
 
 
+class LazyAdam(tf.keras.optimizers.Adam):
+    """ Adam that updates only the rows of variables and moments touched by a sparse gradient (tf.IndexedSlices),
+        e.g. the per-sequence evolutionary times of which a batch gathers only a few rows.
+        The cost of a step is then independent of the number of rows. Dense gradients are handled as in Adam.
+        The sparse updates access the moments through private attributes of the Keras Adam optimizer.
+        If they are not available in the installed Keras version, all gradients are handled as in Adam.
+    """
+    def update_step(self, gradient, variable, learning_rate=None):
+        moments = self._get_moments(variable) if isinstance(gradient, tf.IndexedSlices) and not self.amsgrad else None
+        if moments is None:
+            if learning_rate is None:
+                return super(LazyAdam, self).update_step(gradient, variable)
+            return super(LazyAdam, self).update_step(gradient, variable, learning_rate)
+        m, v = moments
+        lr = tf.cast(self.learning_rate if learning_rate is None else learning_rate, variable.dtype)
+        local_step = tf.cast(self.iterations + 1, variable.dtype)
+        beta_1_power = tf.pow(tf.cast(self.beta_1, variable.dtype), local_step)
+        beta_2_power = tf.pow(tf.cast(self.beta_2, variable.dtype), local_step)
+        alpha = lr * tf.sqrt(1 - beta_2_power) / (1 - beta_1_power)
+        #sum the gradients of duplicate rows
+        rows, segments = tf.unique(gradient.indices)
+        values = tf.math.unsorted_segment_sum(tf.cast(gradient.values, variable.dtype), segments, tf.shape(rows)[0])
+        m_rows = tf.gather(m, rows) * self.beta_1 + values * (1 - self.beta_1)
+        v_rows = tf.gather(v, rows) * self.beta_2 + tf.square(values) * (1 - self.beta_2)
+        m.scatter_update(tf.IndexedSlices(m_rows, rows))
+        v.scatter_update(tf.IndexedSlices(v_rows, rows))
+        _unwrap_variable(variable).scatter_sub(tf.IndexedSlices(alpha * m_rows / (tf.sqrt(v_rows) + self.epsilon), rows))
+
+    def _get_moments(self, variable):
+        # returns None if the private attributes of the Keras version at hand differ from the expected ones
+        try:
+            index = self._get_variable_index(variable) if hasattr(self, "_get_variable_index") else self._index_dict[self._var_key(variable)]
+            moments = _unwrap_variable(self._momentums[index]), _unwrap_variable(self._velocities[index])
+            accessible = all(isinstance(x, tf.Variable) for x in moments + (_unwrap_variable(variable),))
+        except (AttributeError, KeyError, IndexError, TypeError):
+            accessible = False
+        if not accessible:
+            if not getattr(self, "_warned_dense_fallback", False):
+                warnings.warn("LazyAdam: The Adam moments are not accessible in this Keras version. Falling back to dense Adam updates.")
+                self._warned_dense_fallback = True
+            return None
+        return moments
+
+
+def _unwrap_variable(variable):
+    # Keras 3 wraps tf.Variables
+    return variable if isinstance(variable, tf.Variable) else variable.value
+
+
 
 def generic_model_generator(encoder_layers,
                             msa_hmm_layer):
@@ -130,11 +188,12 @@ def make_msa_hmm_layer(effective_num_seq,
                                 effective_num_seq,
                                 use_prior=config["use_prior"],
                                 sequence_weights=sequence_weights,
+                                analytic_gradient=config["analytic_gradient"],
                                 dtype=tf.float32)
     return msa_hmm_layer
 
 
-def make_anc_probs_layer(num_seq, config, clusters=None):
+def make_anc_probs_layer(num_seq, config, clusters=None, return_lookup_tables=False):
     assert_config(config)
     anc_probs_layer = AncProbsLayer(config["num_models"],
                                     num_seq,
@@ -150,7 +209,8 @@ def make_anc_probs_layer(num_seq, config, clusters=None):
                                      shared_matrix=config["shared_rate_matrix"],
                                      equilibrium_sample=config["equilibrium_sample"],
                                      transposed=config["transposed"],
-                                     clusters=clusters)
+                                     clusters=clusters,
+                                     return_lookup_tables=return_lookup_tables)
     return anc_probs_layer
 
 
@@ -180,7 +240,9 @@ def default_model_generator(num_seq,
         (f"The list of given model lengths ({len(model_lengths)}) should"
          + f" match the number of models specified in the configuration({num_models}).")
     msa_hmm_layer = make_msa_hmm_layer(effective_num_seq, model_lengths, config, sequence_weights, alphabet_size)
-    anc_probs_layer = make_anc_probs_layer(num_seq, config, clusters)
+    #the emitters look up emissions from per-sequence tables if they support it
+    fused = config["fused_emissions"] and all(type(em).call is ProfileHMMEmitter.call for em in msa_hmm_layer.cell.emitter)
+    anc_probs_layer = make_anc_probs_layer(num_seq, config, clusters, return_lookup_tables=fused)
     model = generic_gen([anc_probs_layer], msa_hmm_layer)
     return model
 
@@ -202,9 +264,24 @@ class DefaultBatchGenerator():
         self.config = config
         self.num_models = config["num_models"] if "num_models" in config else 1
         self.crop_long_seqs = config["crop_long_seqs"] if "crop_long_seqs" in config else math.inf
+        num_length_buckets = config["length_buckets"] if "length_buckets" in config else 0
         self.permutations = [np.arange(data.num_seq) for _ in range(self.num_models)]
+        #exact duplicates are represented by a single sequence during training (see collapse_duplicates)
+        unique_indices, _, _ = data.get_unique_indices(np.arange(data.num_seq))
+        if num_length_buckets > 1:
+            #permute only within length buckets, then all models see sequences of similar length in a batch
+            self.bucket_lengths, self.bucket_ids = get_length_buckets(np.minimum(data.seq_lens, self.crop_long_seqs).astype(data.seq_lens.dtype), 
+                                                                      unique_indices, num_length_buckets)
+            unique_indices = unique_indices[np.argsort(self.bucket_ids[unique_indices], kind="stable")]
+            bucket_splits = np.cumsum(np.bincount(self.bucket_ids[unique_indices]))[:-1]
+        else:
+            self.bucket_lengths, self.bucket_ids = None, None
+            bucket_splits = []
         for p in self.permutations:
-            np.random.shuffle(p)
+            for bucket in np.split(unique_indices, bucket_splits):
+                p[bucket] = np.random.permutation(bucket)
+        #all sequences encoded once in a flat buffer, batches are gathered from it
+        self.encoded_buffer, self.encoded_offsets = data.get_encoded_buffer()
         self.configured = True
         
     def __call__(self, indices, return_crop_boundaries=False):
@@ -215,20 +292,17 @@ class DefaultBatchGenerator():
             permutated_indices = np.stack([perm[indices] for perm in self.permutations], axis=1)
         else:
             permutated_indices = np.stack([indices]*self.num_models, axis=1)
-        max_len = np.max(self.data.seq_lens[permutated_indices])
-        max_len = min(max_len, self.crop_long_seqs)
-        batch = np.zeros((indices.shape[0], self.num_models, max_len+1), dtype=np.uint8) 
-        if return_crop_boundaries:
-            start = np.zeros((indices.shape[0], self.num_models), dtype=np.int32)
-            end = np.zeros((indices.shape[0], self.num_models), dtype=np.int32)
-        batch += self.alphabet_size #initialize with terminal symbols
-        for i,perm_ind in enumerate(permutated_indices):
-            for k,j in enumerate(perm_ind):
-                if return_crop_boundaries:
-                    seq, start[i, k], end[i, k] = self.data.get_encoded_seq(j, crop_to_length=self.crop_long_seqs, return_crop_boundaries=True)
-                else:
-                    seq = self.data.get_encoded_seq(j, crop_to_length=self.crop_long_seqs, return_crop_boundaries=False)
-                batch[i, k, :min(self.data.seq_lens[j], self.crop_long_seqs)] = seq
+        seq_lens = self.encoded_offsets[permutated_indices+1] - self.encoded_offsets[permutated_indices]
+        #crop randomly
+        cropped_lens = np.minimum(seq_lens, self.crop_long_seqs).astype(np.int64)
+        start = np.random.randint(0, seq_lens - cropped_lens + 1).astype(np.int32)
+        end = start + cropped_lens
+        max_len = np.max(cropped_lens)
+        #gather all residues at once, positions beyond a sequence end are terminal symbols
+        positions = np.arange(max_len+1)
+        in_seq = positions < cropped_lens[..., np.newaxis]
+        gather_ind = np.where(in_seq, (self.encoded_offsets[permutated_indices] + start)[..., np.newaxis] + positions, 0)
+        batch = np.where(in_seq, self.encoded_buffer[gather_ind], np.uint8(self.alphabet_size))
         if self.return_only_sequences:
             if return_crop_boundaries:
                 return batch, start, end
@@ -246,38 +320,150 @@ class DefaultBatchGenerator():
         else:
             return (tf.uint8, tf.int64) 
         
+
+
+def get_length_buckets(seq_lens, indices, num_buckets):
+    """ Groups sequences into buckets of similar length. The bucket boundaries are quantiles of the lengths, 
+        so that all buckets contain roughly the same number of sequences.
+    Args:
+        seq_lens: Lengths of all sequences in the dataset.
+        indices: Indices of the sequences that determine the quantiles.
+        num_buckets: Maximum number of buckets. Less buckets are used if quantiles coincide.
+    Returns:
+        The maximum length per bucket and a bucket index for each sequence in the dataset.
+    """
+    quantiles = np.quantile(seq_lens[indices], np.linspace(0, 1, num_buckets+1)[1:], method="higher")
+    bucket_lengths = np.unique(quantiles)
+    bucket_lengths[-1] = np.amax(seq_lens)
+    bucket_ids = np.searchsorted(bucket_lengths, seq_lens, side="left").astype(np.int32)
+    return bucket_lengths, bucket_ids
+
+
+def get_bucket_batch_sizes(bucket_lengths, batch_size, max_len):
+    """ Computes batch sizes per length bucket such that each batch contains about as many residues 
+        as a batch of size batch_size with sequences of length max_len.
+    """
+    residue_budget = batch_size * (max_len+1)
+    return [max(1, int(residue_budget // (L+1))) for L in bucket_lengths]
+
+
+class GraphBatchGenerator(DefaultBatchGenerator):
+    """ A batch generator that assembles batches with TensorFlow ops only. The encoded sequences are kept in a flat tensor 
+        with row splits and permutation, cropping and padding are part of the graph. make_dataset maps tf_call instead of 
+        wrapping the generator in tf.numpy_function, which allows tf.data to run the map in parallel and to fuse it. 
+        Calling the generator directly behaves like DefaultBatchGenerator.
+    """
+    def configure(self, data : SequenceDataset, config, verbose=False):
+        super().configure(data, config, verbose)
+        #one additional terminal symbol makes gathering from an empty buffer safe
+        self.tf_buffer = tf.constant(np.append(self.encoded_buffer, np.uint8(self.alphabet_size)))
+        self.tf_row_splits = tf.constant(self.encoded_offsets)
+        self.tf_permutations = tf.constant(np.stack(self.permutations, axis=1)) #(num_seq, num_models)
+
+    def tf_call(self, indices):
+        """ Graph-native counterpart of __call__.
+        Args:
+            indices: A 1D int64 tensor with sequence indices.
+        Returns:
+            A tuple of tensors with the types in get_out_types().
+        """
+        batch, permutated_indices, _, _ = self._tf_assemble(indices)
+        if self.return_only_sequences:
+            return (batch,)
+        else:
+            return batch, permutated_indices
+
+    def _tf_assemble(self, indices):
+        """ Permutes, crops and pads a batch of sequences.
+        Returns:
+            A (b, num_models, max_len+1) uint8 batch, the permutated indices and the crop boundaries.
+        """
+        indices = tf.cast(indices, tf.int64)
+        #use a different permutation of the sequences per trained model
+        if self.shuffle:
+            permutated_indices = tf.gather(self.tf_permutations, indices)
+        else:
+            permutated_indices = tf.tile(indices[:, tf.newaxis], [1, self.num_models])
+        seq_starts = tf.gather(self.tf_row_splits, permutated_indices)
+        seq_lens = tf.gather(self.tf_row_splits, permutated_indices+1) - seq_starts
+        if self.crop_long_seqs < math.inf:
+            cropped_lens = tf.minimum(seq_lens, int(self.crop_long_seqs))
+        else:
+            cropped_lens = seq_lens
+        #crop randomly, the start is uniform in [0, seq_len - cropped_len]
+        u = tf.random.uniform(tf.shape(seq_lens), dtype=tf.float64)
+        start = tf.cast(tf.floor(u * tf.cast(seq_lens - cropped_lens + 1, tf.float64)), tf.int64)
+        max_len = tf.reduce_max(cropped_lens)
+        positions = tf.range(max_len+1, dtype=tf.int64)
+        in_seq = positions < cropped_lens[..., tf.newaxis]
+        gather_ind = tf.where(in_seq, (seq_starts + start)[..., tf.newaxis] + positions, tf.size(self.tf_buffer, out_type=tf.int64)-1)
+        batch = tf.gather(self.tf_buffer, gather_ind)
+        return batch, permutated_indices, tf.cast(start, tf.int32), tf.cast(start + cropped_lens, tf.int32)
+        
+
+#number of length buckets used when decoding
+NUM_DECODE_BUCKETS = 8
     
 # batch_generator is a callable object that maps a vector of sequence indices to
 # inputs compatible with the model
-def make_dataset(indices, batch_generator, batch_size=512, shuffle=True, bucket_by_seq_length=False, model_lengths=[0]): 
+# if it has a tf_call method (see GraphBatchGenerator), batches are computed in graph mode
+def make_dataset(indices, batch_generator, batch_size=512, shuffle=True, bucket_by_seq_length=False, model_lengths=[0], parallel_factor=1): 
     shuffle = shuffle and not bucket_by_seq_length
     batch_generator.shuffle = shuffle
     ds = tf.data.Dataset.from_tensor_slices(indices)
     adaptive_batch = batch_generator.config["batch_size"]
+    length_buckets = False
     if bucket_by_seq_length and callable(adaptive_batch): #bucketing only usable if user has not set a fixed batch size
         ds_len = tf.data.Dataset.from_tensor_slices(batch_generator.data.seq_lens[indices].astype(np.int32))
         ds_ind =  tf.data.Dataset.from_tensor_slices(np.arange(indices.size))
         ds = tf.data.Dataset.zip((ds, ds_len, ds_ind))
-        bucket_boundaries = [200, 520, 700, 850, 1200, 2000, 4000, math.inf]
-        bucket_batch_sizes = [adaptive_batch(model_lengths, b) for b in bucket_boundaries]
+        #quantiles of the sequence lengths with batch sizes from the memory cost model
+        bucket_lengths, _ = get_length_buckets(batch_generator.data.seq_lens, indices, NUM_DECODE_BUCKETS)
+        #user defined callbacks take (model_lengths, max_seq_len), only the builtin ones account for parallel_factor
+        if "parallel_factor" in inspect.signature(adaptive_batch).parameters:
+            adaptive_batch = partial(adaptive_batch, parallel_factor=parallel_factor)
+        bucket_batch_sizes = [adaptive_batch(model_lengths, L) for L in bucket_lengths]
         ds = ds.bucket_by_sequence_length(
                                 element_length_func=lambda i,L,j: L,
-                                bucket_boundaries=bucket_boundaries[:-1],
+                                bucket_boundaries=[int(L)+1 for L in bucket_lengths[:-1]],
                                 bucket_batch_sizes=bucket_batch_sizes)
 
-        batch_func_out_types = batch_generator.get_out_types() + (tf.int64,)
-        func = (lambda i,j: (batch_generator(i), j)) if len(batch_func_out_types) == 2 else lambda i,j: (*batch_generator(i), j)
-        batch_func = lambda i,_,j: tf.numpy_function(func=func, inp=[i,j], Tout=batch_func_out_types)
+        if hasattr(batch_generator, "tf_call"):
+            batch_func = lambda i,_,j: (*batch_generator.tf_call(i), j)
+        else:
+            batch_func_out_types = batch_generator.get_out_types() + (tf.int64,)
+            func = (lambda i,j: (batch_generator(i), j)) if len(batch_func_out_types) == 2 else lambda i,j: (*batch_generator(i), j)
+            batch_func = lambda i,_,j: tf.numpy_function(func=func, inp=[i,j], Tout=batch_func_out_types)
     else:
         if bucket_by_seq_length:
             ds_arange = tf.data.Dataset.from_tensor_slices(np.arange(indices.size))
             ds = tf.data.Dataset.zip((ds, ds_arange))
+        length_buckets = shuffle and getattr(batch_generator, "bucket_lengths", None) is not None
+        if length_buckets:
+            bucket_ids = batch_generator.bucket_ids[indices]
+            ds = tf.data.Dataset.zip((ds, tf.data.Dataset.from_tensor_slices(bucket_ids)))
         if shuffle:
             ds = ds.shuffle(indices.size, reshuffle_each_iteration=True)
             ds = ds.repeat()
-        ds = ds.batch(batch_size)
+        if length_buckets:
+            #every sequence is still drawn once per pass over the shuffled data, 
+            #but a batch contains only sequences from the same length bucket
+            bucket_lengths = batch_generator.bucket_lengths
+            max_len = min(np.amax(batch_generator.data.seq_lens[indices]), batch_generator.crop_long_seqs)
+            bucket_batch_sizes = get_bucket_batch_sizes(bucket_lengths, batch_size, max_len)
+            ds = ds.bucket_by_sequence_length(
+                                    element_length_func=lambda i,b: b,
+                                    bucket_boundaries=list(range(1, len(bucket_lengths))),
+                                    bucket_batch_sizes=bucket_batch_sizes)
+            #short buckets have larger batches, the loss of a batch is scaled by its size relative to batch_size
+            #such that every sequence has the same expected weight in the objective
+            ds = ds.map(lambda i,b: (i, tf.reshape(tf.cast(tf.size(i), tf.float32) / batch_size, [1])))
+        else:
+            ds = ds.batch(batch_size)
         def _batch_func(i):
-            if len(batch_generator.get_out_types()) == 2:
+            if hasattr(batch_generator, "tf_call"):
+                return batch_generator.tf_call(i)
+            elif len(batch_generator.get_out_types()) == 2:
                 batch, ind = tf.numpy_function(batch_generator, [i], batch_generator.get_out_types())
                 #explicitly set output shapes or tf 2.17 will complain about unknown shapes
                 batch.set_shape(tf.TensorShape([None, batch_generator.num_models, None]))
@@ -293,16 +479,17 @@ def make_dataset(indices, batch_generator, batch_size=512, shuffle=True, bucket_
         if bucket_by_seq_length:
             def batch_func(i,j):
                 return *_batch_func(i), j
+        elif length_buckets:
+            def batch_func(i,w):
+                return _batch_func(i), w
         else:
             batch_func = _batch_func
             
 
     ds = ds.map(batch_func,
-                # no parallel processing if using an indexed dataset
-                num_parallel_calls=None if batch_generator.data.indexed else tf.data.AUTOTUNE,
+                num_parallel_calls=tf.data.AUTOTUNE,
                 deterministic=True)
-    if not batch_generator.data.indexed:
-        ds = ds.prefetch(2) #preprocessings and training steps in parallel
+    ds = ds.prefetch(2) #preprocessings and training steps in parallel
     # get rid of a warning, see https://github.com/tensorflow/tensorflow/issues/42146
     # in case of multi GPU, we want to split the data dimension accross GPUs
     options = tf.data.Options()
@@ -310,9 +497,44 @@ def make_dataset(indices, batch_generator, batch_size=512, shuffle=True, bucket_
     ds = ds.with_options(options)
     ds_y = tf.data.Dataset.from_tensor_slices(tf.zeros(1)).batch(batch_size).repeat()
     ds = tf.data.Dataset.zip((ds, ds_y))
+    if length_buckets:
+        #the batch weights are passed to the model as sample weights
+        ds = ds.map(lambda x, y: (x[0], y, x[1]))
     return ds
     
 
+def collapse_duplicates(data : SequenceDataset, indices, sequence_weights=None):
+    """ Replaces exact duplicates among the training sequences by a single representative 
+        whose likelihood weight is the total weight of its duplicates in indices.
+        Each group is represented by its first occurrence in the whole dataset (see SequenceDataset.get_unique_indices), 
+        even if indices contain only later duplicates. Decoding and scoring use the same representatives, i.e. 
+        the evolutionary time of a group is always the one of its representative. The default batch generator only permutes 
+        the first occurrences in the whole dataset and keeps all other sequences fixed, so all weight is put on the representatives.
+    Args:
+        data: The sequence dataset.
+        indices: Indices of the training sequences.
+        sequence_weights: Optional likelihood weights per sequence in the dataset.
+    Returns:
+        The sorted indices of the unique training sequences and sequence weights for the whole dataset 
+        (both unchanged if the training sequences have no duplicates). Sequences that are neither in indices 
+        nor representatives keep their weights.
+    """
+    unique_indices, _, inverse = data.get_unique_indices(indices)
+    if np.array_equal(unique_indices, np.sort(indices)):
+        return indices, sequence_weights
+    if sequence_weights is None:
+        #the weights sum up to the number of training sequences like in the unweighted case
+        weights = np.full(data.num_seq, indices.shape[0] / data.num_seq, dtype=np.float32)
+    else:
+        weights = np.asarray(sequence_weights, dtype=np.float32)
+    group_weights = np.zeros(unique_indices.size, dtype=np.float32)
+    np.add.at(group_weights, inverse, weights[indices])
+    collapsed_weights = np.copy(weights)
+    collapsed_weights[indices] = 0
+    collapsed_weights[unique_indices] = group_weights
+    return unique_indices, collapsed_weights
+
+
 def fit_model(model_generator,
               batch_generator,
               data : SequenceDataset,
@@ -329,7 +551,6 @@ def fit_model(model_generator,
     tf.keras.backend.clear_session() #frees occupied memory 
     tf.get_logger().setLevel('ERROR')
     batch_generator.configure(data, config, verbose)
-    optimizer = tf.keras.optimizers.Adam(config["learning_rate"])
     if verbose:
         print("Fitting models of lengths", model_lengths, "on", indices.shape[0], "sequences.")
         print("Batch size=", batch_size, "Learning rate=", config["learning_rate"])
@@ -342,19 +563,33 @@ def fit_model(model_generator,
             if num_cropped > 0:
                 print(f"""{num_cropped} sequences are longer than {batch_generator.crop_long_seqs} and will be cropped for training.""")
                 print("To disable cropping, use --crop disable. To change the cropping limit to X, use --crop X.")
+    num_train_seqs = indices.shape[0]
+    indices, sequence_weights = collapse_duplicates(data, indices, sequence_weights)
+    if verbose and indices.shape[0] < num_train_seqs:
+        print(f"Training on {indices.shape[0]} unique sequences, exact duplicates are accounted for by sequence weights.")
+    num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
+    if verbose:
+        print("Using", num_gpu, "GPUs.")
+    use_em = config["trainer"] == "em"
+    if use_em and num_gpu > 1:
+        print("Found multiple GPUs, but the EM trainer is currently not supported in multi-GPU mode. Using Adam.")
+        use_em = False
     def make_and_compile():
         model = model_generator(num_seq=data.num_seq,
-                                effective_num_seq=indices.shape[0],
+                                effective_num_seq=num_train_seqs,
                                 model_lengths=model_lengths,
                                 config=config,
                                 data=data,
                                 sequence_weights=sequence_weights,
                                 clusters=clusters)
+        if use_em:
+            from learnMSA.msa_hmm.ExpectationMaximization import StepwiseEM
+            msa_hmm_layer = [layer for layer in model.layers if isinstance(layer, MsaHmmLayer)][0]
+            optimizer = StepwiseEM(msa_hmm_layer, config["learning_rate"])
+        else:
+            optimizer = LazyAdam(config["learning_rate"])
         model.compile(optimizer=optimizer, jit_compile=False)
         return model
-    num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
-    if verbose:
-        print("Using", num_gpu, "GPUs.")
     if num_gpu > 1:   
         if config["use_language_model"]:
             print("Found multiple GPUs, but using a language model is currently not supported in multi-GPU mode. Using single GPU.")
@@ -370,7 +605,7 @@ def fit_model(model_generator,
     else:
         model = make_and_compile()
     
-    steps = min(max(10, int(100*np.sqrt(indices.shape[0])/batch_size)), 500)
+    steps = min(max(10, int(100*np.sqrt(num_train_seqs)/batch_size)), 500)
     dataset = make_dataset(indices, 
                            batch_generator, 
                            batch_size,
@@ -411,4 +646,5 @@ def fit_model(model_generator,
     
 tf.keras.utils.get_custom_objects()["PermuteSeqs"] = PermuteSeqs
 tf.keras.utils.get_custom_objects()["Identity"] = Identity
-tf.keras.utils.get_custom_objects()["LearnMSAModel"] = LearnMSAModel
\ No newline at end of file
+tf.keras.utils.get_custom_objects()["LearnMSAModel"] = LearnMSAModel
+tf.keras.utils.get_custom_objects()["LazyAdam"] = LazyAdam
\ No newline at end of file
@@ -3,7 +3,7 @@ import numpy as np
 import learnMSA.msa_hmm.Initializers as initializers
 import learnMSA.msa_hmm.Priors as priors
 import learnMSA.msa_hmm.Configuration as config
-from learnMSA.msa_hmm.Utility import get_num_states, get_num_states_implicit, deserialize
+from learnMSA.msa_hmm.Utility import get_num_states, get_num_states_implicit, deserialize, softmax
 from packaging import version
 if version.parse(tf.__version__) < version.parse("2.10.0"):
     from tensorflow.python.training.tracking.data_structures import NoDependency #see https://github.com/tensorflow/tensorflow/issues/36916
@@ -11,6 +11,11 @@ else:
     from tensorflow.python.trackable.data_structures import NoDependency 
 
 
+#models of at least this length use the structured transition operator per default
+STRUCTURED_MIN_LENGTH = 500
+#lower bound for inputs to the match_skip prefix sums to avoid log(0)
+_MIN_SKIP_INPUT = 1e-30
+
 
 class ProfileHMMTransitioner(tf.keras.layers.Layer):
     """ A transitioner defines which transitions between HMM states are allowed, how they are initialized
@@ -23,12 +28,16 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         prior: A compatible prior that regularizes each transition type.
         frozer_kernels: A dictionary that can be used to omit parameter updates for certain kernels 
                         by adding "kernel_id" : False
+        structured_min_length: If the longest model has at least this length, transitions are applied with a 
+                        structured operator in O(q) per position instead of a dense (q x q) matmul. 
+                        The dense matrix is still available via make_A.
     """
     def __init__(self, 
                 transition_init = initializers.make_default_transition_init(),
                 flank_init = initializers.make_default_flank_init(),
                 prior = None,
                 frozen_kernels={},
+                structured_min_length=STRUCTURED_MIN_LENGTH,
                 **kwargs):
         super(ProfileHMMTransitioner, self).__init__(**kwargs)
         transition_init = [transition_init] if isinstance(transition_init, dict) else transition_init 
@@ -36,8 +45,12 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         self.flank_init = [flank_init] if not hasattr(flank_init, '__iter__') else flank_init 
         self.prior = priors.ProfileHMMTransitionPrior(dtype=self.dtype) if prior is None else prior
         self.frozen_kernels = frozen_kernels
+        self.structured_min_length = structured_min_length
         self.approx_log_zero = -1000.
         self.reverse = False
+        #count mode: the gradients of the log-likelihood w.r.t. the kernels are the expected transition counts
+        #and the prior is not differentiated (see ExpectationMaximization.StepwiseEM)
+        self.count_gradients = False
 
 
     def set_lengths(self, lengths):
@@ -55,6 +68,11 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         self.implicit_transition_parts = [_make_implicit_transition_parts(length) for length in self.lengths]
         self.sparse_transition_indices_implicit = [_make_sparse_transition_indices_implicit(length) for length in self.lengths]
         self.sparse_transition_indices_explicit = [_make_sparse_transition_indices_explicit(length) for length in self.lengths]
+        self.canonical_state_order = _make_canonical_state_order(self.lengths)
+        self.structured = max(self.lengths) >= self.structured_min_length
+        if self.structured:
+            self.block_transition_parts, self.block_transition_indices, self.block_row_major_order = \
+                _make_block_transition_indices(self.implicit_transition_parts, self.sparse_transition_indices_implicit, self.max_num_states)
         # make sure the parameters are valid
         assert len(self.lengths) == len(self.transition_init), \
             f"The number of transition initializers ({len(self.transition_init)}) should match the number of models ({len(self.lengths)})."
@@ -101,9 +119,17 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         """ Automatically called before each recurrent run. Should be used for setups that
             are only required once per application of the recurrent layer.
         """
-        self.A_sparse, self.implicit_log_probs, self.log_probs, self.probs = self.make_A_sparse(return_probs = True)
-        self.A = tf.sparse.to_dense(self.A_sparse)
-        self.A_t = tf.transpose(self.A, (0,2,1))
+        if self.structured:
+            self.implicit_log_probs, self.log_probs, self.probs = self.make_implicit_log_probs(include_match_skip=False)
+            self.A_block_sparse = self.make_A_block_sparse(self.implicit_log_probs)
+            self.log_skip_out, self.log_skip_in = self.make_log_skip_factors(self.log_probs)
+            #prefix sums run over the skip sources in the forward and over the skip targets in the backward direction
+            self.log_skip_out_source = self._make_finite_skip_sources(self.log_skip_out)
+            self.log_skip_in_source = self._make_finite_skip_sources(self.log_skip_in)
+        else:
+            self.A_sparse, self.implicit_log_probs, self.log_probs, self.probs = self.make_A_sparse(return_probs = True)
+            self.A = tf.sparse.to_dense(self.A_sparse)
+            self.A_t = tf.transpose(self.A, (0,2,1))
         
 
     def make_flank_init_prob(self):
@@ -116,9 +142,14 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
             A probability distribution per model. Shape: (1, k, q)
         """
         #state order: LEFT_FLANK, MATCH x length, INSERT x length-1, UNANNOTATED_SEGMENT, RIGHT_FLANK, TERMINAL
-        init_flank_probs = self.make_flank_init_prob()
-        log_init_flank_probs = tf.math.log(init_flank_probs)
-        log_complement_init_flank_probs = tf.math.log(1-init_flank_probs)
+        if self.count_gradients:
+            kernel = tf.stack([tf.identity(k) for k in self.flank_init_kernel])
+            log_norm = tf.stop_gradient(tf.math.softplus(kernel))
+            log_init_flank_probs, log_complement_init_flank_probs = kernel - log_norm, -log_norm
+        else:
+            init_flank_probs = self.make_flank_init_prob()
+            log_init_flank_probs = tf.math.log(init_flank_probs)
+            log_complement_init_flank_probs = tf.math.log(1-init_flank_probs)
         log_init_dists = []
         for i in range(self.num_models):
             log_init_match = (self.implicit_log_probs[i]["left_flank_to_match"] 
@@ -176,7 +207,8 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
             probs_dict = {}
             indices_explicit = np.concatenate([indices_explicit[part_name] 
                                                     for part_name,_ in parts], axis=0)
-            dense_probs = make_transition_matrix_from_indices(indices_explicit, kernel, num_states)
+            dense_probs = make_transition_matrix_from_indices(indices_explicit, kernel, num_states, 
+                                                              count_gradients=self.count_gradients)
             probs_vec = tf.gather_nd(dense_probs, indices_explicit)
             lsum = 0
             for part_name, length in parts:
@@ -192,8 +224,10 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         return log_probs, probs
     
     
-    def make_implicit_log_probs(self):
+    def make_implicit_log_probs(self, include_match_skip=True):
         """Computes all logarithmic transition probabilities in the implicit model. 
+        Args:
+            include_match_skip: If false, the O(L^2) match_skip part is omitted.
         Returns:
             A dictionary that maps transition types to probabilies. 
         """
@@ -202,17 +236,17 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         for p, length in zip(log_probs, self.lengths):
             #compute match_skip(i,j) = P(Mj+2 | Mi)  , L x L
             #considers "begin" as M0 and "end" as ML
-            MD = tf.expand_dims(p["match_to_delete"], -1)
-            DD = tf.concat([[0], p["delete_to_delete"]], axis=0)
-            DD_cumsum = tf.math.cumsum(DD)
-            DD = tf.expand_dims(DD_cumsum, 0) - tf.expand_dims(DD_cumsum, 1)
-            DM = tf.expand_dims(p["delete_to_match"], 0)
-            M_skip = MD + DD + DM 
-            upper_triangle = tf.linalg.band_part(tf.ones([length-2]*2, dtype=self.dtype), 0, -1)
+            #M_skip[i,j] = MD[i] + DD_cumsum[j] - DD_cumsum[i] + DM[j] is only needed in full for the match_skip part
+            MD = p["match_to_delete"]
+            DD_cumsum = tf.math.cumsum(tf.concat([[0], p["delete_to_delete"]], axis=0))
+            DM = p["delete_to_match"]
+            M_skip_first_row = MD[0] + DD_cumsum + DM
+            M_skip_last_col = MD + (DD_cumsum[-1] - DD_cumsum) + DM[-1]
+            M_skip_begin_to_end = M_skip_first_row[-1]
             entry_add = _logsumexp(p["begin_to_match"], 
-                                   tf.concat([[self.approx_log_zero], M_skip[0, :-1]], axis=0))
+                                   tf.concat([[self.approx_log_zero], M_skip_first_row[:-1]], axis=0))
             exit_add = _logsumexp(p["match_to_end"], 
-                                  tf.concat([M_skip[1:,-1], [self.approx_log_zero]], axis=0))
+                                  tf.concat([M_skip_last_col[1:], [self.approx_log_zero]], axis=0))
             imp_probs = {}
             imp_probs["match_to_match"] = p["match_to_match"]
             imp_probs["match_to_insert"] = p["match_to_insert"]
@@ -221,14 +255,17 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
             imp_probs["left_flank_loop"] = p["left_flank_loop"]
             imp_probs["right_flank_loop"] = p["right_flank_loop"]
             imp_probs["right_flank_exit"] = p["right_flank_exit"]
-            imp_probs["match_skip"] = tf.boolean_mask(M_skip[1:-1, 1:-1], 
-                                     mask=tf.cast(upper_triangle, dtype=tf.bool)) 
+            if include_match_skip:
+                M_skip = tf.expand_dims(MD, -1) + (tf.expand_dims(DD_cumsum, 0) - tf.expand_dims(DD_cumsum, 1)) + tf.expand_dims(DM, 0)
+                upper_triangle = tf.linalg.band_part(tf.ones([length-2]*2, dtype=self.dtype), 0, -1)
+                imp_probs["match_skip"] = tf.boolean_mask(M_skip[1:-1, 1:-1], 
+                                        mask=tf.cast(upper_triangle, dtype=tf.bool)) 
             imp_probs["left_flank_to_match"] = p["left_flank_exit"] + entry_add
-            imp_probs["left_flank_to_right_flank"] = (p["left_flank_exit"] + M_skip[0, -1] 
+            imp_probs["left_flank_to_right_flank"] = (p["left_flank_exit"] + M_skip_begin_to_end 
                                                       + p["end_to_right_flank"])
-            imp_probs["left_flank_to_unannotated_segment"] = (p["left_flank_exit"] + M_skip[0, -1] 
+            imp_probs["left_flank_to_unannotated_segment"] = (p["left_flank_exit"] + M_skip_begin_to_end 
                                                               + p["end_to_unannotated_segment"])
-            imp_probs["left_flank_to_terminal"] = (p["left_flank_exit"] + M_skip[0, -1] 
+            imp_probs["left_flank_to_terminal"] = (p["left_flank_exit"] + M_skip_begin_to_end 
                                                    + p["end_to_terminal"])
             imp_probs["match_to_unannotated"] = exit_add + p["end_to_unannotated_segment"]
             imp_probs["match_to_right_flank"] = exit_add + p["end_to_right_flank"]
@@ -236,13 +273,13 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
             imp_probs["unannotated_segment_to_match"] = p["unannotated_segment_exit"] + entry_add
             imp_probs["unannotated_segment_loop"] = _logsumexp(p["unannotated_segment_loop"], 
                                                                (p["unannotated_segment_exit"] 
-                                                                    + M_skip[0, -1] 
+                                                                    + M_skip_begin_to_end 
                                                                     + p["end_to_unannotated_segment"]))
             imp_probs["unannotated_segment_to_right_flank"] = (p["unannotated_segment_exit"] 
-                                                               + M_skip[0, -1] 
+                                                               + M_skip_begin_to_end 
                                                                + p["end_to_right_flank"])
             imp_probs["unannotated_segment_to_terminal"] = (p["unannotated_segment_exit"] 
-                                                            + M_skip[0, -1] 
+                                                            + M_skip_begin_to_end 
                                                             + p["end_to_terminal"])
             imp_probs["terminal_self_loop"] = tf.zeros((1), dtype=self.dtype)
             implicit_log_probs.append(imp_probs)
@@ -325,6 +362,69 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         return A
         
 
+    def make_A_block_sparse(self, implicit_log_probs):
+        """
+        Returns:
+            A 2D sparse tensor of dense shape (k*q, k*q) with the transition matrices of all k models 
+            on the diagonal, excluding the match_skip transitions.
+        """
+        values = tf.concat([p[part_name] for p, parts in zip(implicit_log_probs, self.block_transition_parts) 
+                                for part_name in parts], axis=0)
+        values = tf.math.exp(tf.gather(values, self.block_row_major_order))
+        return tf.sparse.SparseTensor(indices=self.block_transition_indices, 
+                                      values=values, 
+                                      dense_shape=[self.num_models*self.max_num_states]*2)
+
+
+    def make_log_skip_factors(self, log_probs):
+        """ The match_skip transition Mi -> Mj (j >= i+2) has the log probability 
+            log_skip_out[i] + log_skip_in[j] = MD[i] - DD_cumsum[i] + DD_cumsum[j-2] + DM[j-2].
+        Returns:
+            Two tensors of shape (k, 1, max_length) for the match states 1..max_length. Entries of states 
+            that are no skip source (or target respectively) are -inf.
+        """
+        max_length = max(self.lengths)
+        log_skip_out, log_skip_in = [], []
+        for p, length in zip(log_probs, self.lengths):
+            DD_cumsum = tf.math.cumsum(tf.concat([[0], p["delete_to_delete"]], axis=0))
+            out = p["match_to_delete"][1:-1] - DD_cumsum[1:-1] #sources M1 ... ML-2
+            log_skip_out.append(tf.pad(out, [[0, max_length-length+2]], constant_values=-np.inf))
+            into = DD_cumsum[1:-1] + p["delete_to_match"][1:-1] #targets M3 ... ML
+            log_skip_in.append(tf.pad(into, [[2, max_length-length]], constant_values=-np.inf))
+        return tf.stack(log_skip_out)[:, tf.newaxis], tf.stack(log_skip_in)[:, tf.newaxis]
+
+
+    def make_viterbi_transitions(self):
+        """ Log transition probabilities for the structured Viterbi in a state layout shared by all models 
+            (see canonical_state_order): LF, M1 ... Mn, I1 ... In-1, U, R, T where n is the maximum length.
+            The values are the same as in make_log_A, transitions that do not exist are -inf.
+            The match_skip transition Mi -> Mj is skip_out[i] + skip_in[j] (see make_log_skip_factors), 
+            which is equal to the entry of the dense matrix up to rounding.
+        Returns:
+            A dictionary of tensors of shape (k, 1, m) with m = 1, n-1 or n.
+        """
+        n = max(self.lengths)
+        implicit_log_probs, log_probs, _ = self.make_implicit_log_probs(include_match_skip=False)
+        #the padded sizes of the parts are those of a model of length n
+        sizes = {part_name : size for part_name, size in _make_implicit_transition_parts(n) if part_name != "match_skip"}
+        transitions = {key : [] for key in sizes}
+        for imp in implicit_log_probs:
+            for key, size in sizes.items():
+                transitions[key].append(tf.pad(imp[key], [[0, size-imp[key].shape[0]]], constant_values=-np.inf))
+        transitions = {key : tf.stack(values)[:, tf.newaxis] for key, values in transitions.items()}
+        transitions["skip_out"], transitions["skip_in"] = self.make_log_skip_factors(log_probs)
+        return transitions
+
+
+    def _make_finite_skip_sources(self, log_skip):
+        """ Replaces -inf by a finite value small enough that the corresponding skip probabilities are still zero.
+            Prefix sums over the sources are then finite and have finite gradients.
+        """
+        both = tf.concat([self.log_skip_out, self.log_skip_in], axis=-1)
+        bound = tf.stop_gradient(tf.reduce_max(tf.abs(tf.where(tf.math.is_finite(both), both, 0.))))
+        return tf.where(tf.math.is_finite(log_skip), log_skip, self.approx_log_zero * 10 - 2 * bound)
+        
+
     def call(self, inputs):
         """ 
         Args: 
@@ -332,15 +432,48 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
         Returns:
                 Shape (k, b, q)
         """
+        if self.structured:
+            return self._structured_call(inputs)
         #batch matmul of k inputs with k matricies
         if self.reverse:
             return tf.matmul(inputs, self.A_t)
         else:
             return tf.matmul(inputs, self.A)
+
+
+    def _structured_call(self, inputs):
+        """ Applies the transition matrices in O(q) per row: All transitions except match_skip are a sparse matrix
+            with O(q) entries. The match_skip block is separable and applied with a prefix sum over the match states
+            in log space (the factors alone can exceed the float range).
+        """
+        k, q = self.num_models, self.max_num_states
+        max_length = max(self.lengths)
+        #block diagonal sparse matmul, computes (A^T x^T)^T for the forward and (A x^T)^T for the backward direction
+        inputs_t = tf.reshape(tf.transpose(inputs, (0,2,1)), (k*q, -1))
+        outputs_t = tf.sparse.sparse_dense_matmul(self.A_block_sparse, inputs_t, adjoint_a=not self.reverse)
+        outputs = tf.transpose(tf.reshape(outputs_t, (k, q, -1)), (0,2,1))
+        #the sparse matmul loses the static shape, but the recurrence requires it
+        outputs = tf.ensure_shape(outputs, inputs.shape)
+        if max_length < 3:
+            return outputs
+        log_match = tf.math.log(tf.maximum(inputs[..., 1:max_length+1], _MIN_SKIP_INPUT))
+        if self.reverse:
+            log_cum = tf.math.cumulative_logsumexp(log_match + self.log_skip_in_source, axis=-1, reverse=True)
+            log_cum = tf.pad(log_cum[..., 2:], [[0,0], [0,0], [0,2]], constant_values=-np.inf)
+            skip = tf.math.exp(log_cum + self.log_skip_out)
+        else:
+            log_cum = tf.math.cumulative_logsumexp(log_match + self.log_skip_out_source, axis=-1)
+            log_cum = tf.pad(log_cum[..., :-2], [[0,0], [0,0], [2,0]], constant_values=-np.inf)
+            skip = tf.math.exp(log_cum + self.log_skip_in)
+        return outputs + tf.pad(skip, [[0,0], [0,0], [1, q-max_length-1]])
     
 
     def get_prior_log_densities(self):
-        return self.prior(self.make_probs(), self.make_flank_init_prob())
+        priors = self.prior(self.make_probs(), self.make_flank_init_prob())
+        if self.count_gradients:
+            #in count mode, the prior is part of the M-step
+            priors = {key : tf.stop_gradient(p) for key, p in priors.items()}
+        return priors
     
 
     def duplicate(self, model_indices=None, share_kernels=False):
@@ -358,6 +491,7 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
                                         flank_init = sub_flank_init,
                                         prior = self.prior,
                                         frozen_kernels = self.frozen_kernels,
+                                        structured_min_length = self.structured_min_length,
                                         dtype = self.dtype) 
         if share_kernels:
             transitioner_copy.transition_kernel = self.transition_kernel
@@ -417,7 +551,8 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
             "lengths" : self.lengths.tolist() if isinstance(self.lengths, np.ndarray) else self.lengths,
             "num_models" : self.num_models,
             "prior" : self.prior,
-            "frozen_kernels" : self.frozen_kernels
+            "frozen_kernels" : self.frozen_kernels,
+            "structured_min_length" : self.structured_min_length
         })
         return config
     
@@ -443,12 +578,13 @@ class ProfileHMMTransitioner(tf.keras.layers.Layer):
     
 
 
-def make_transition_matrix_from_indices(indices, kernel, num_states, approx_log_zero = -1000.):
+def make_transition_matrix_from_indices(indices, kernel, num_states, approx_log_zero = -1000., count_gradients=False):
     """Constructs a dense probabilistic transition matrix from a sparse index list and a kernel.
     Args:
         indices: A 2D tensor of shape (num_transitions, 2) that specifies the indices of the kernel.
         kernel: A 1D tensor of shape (num_transitions) that contains the kernel values.
         num_states: The number of states in the model. 
+        count_gradients: If true, the row normalizers are not differentiated (see Utility.softmax).
     Returns:
         A dense probabilistic transition matrix of shape (num_states, num_states).
     """
@@ -465,12 +601,13 @@ def make_transition_matrix_from_indices(indices, kernel, num_states, approx_log_
                                 dense_shape=[num_states]*2)
     dense_kernel = tf.sparse.to_dense(sparse_kernel, default_value=approx_log_zero)
     #softmax that ignores non-existing transitions
-    dense_probs = tf.nn.softmax(dense_kernel, axis=-1)
+    dense_probs = softmax(dense_kernel, axis=-1, count_gradients=count_gradients)
     #mask out non-existing transitions and rescale for numerical stability
     mask = tf.cast(dense_kernel > approx_log_zero, dense_probs.dtype)
     dense_probs += 1e-16
     dense_probs = dense_probs * mask
-    dense_probs /= tf.reduce_sum(dense_probs, axis=-1, keepdims=True)
+    row_sums = tf.reduce_sum(dense_probs, axis=-1, keepdims=True)
+    dense_probs /= tf.stop_gradient(row_sums) if count_gradients else row_sums
     return dense_probs
 
 
@@ -594,6 +731,43 @@ def _make_sparse_transition_indices_explicit(length):
         "end_to_right_flank" : [[end, right_flank]],
         "end_to_terminal" : [[end, terminal]] }
     return indices_dict
+
+
+def _make_canonical_state_order(lengths):
+    """ Maps the states of all models to a shared layout LF, M1 ... Mn, I1 ... In-1, U, R, T where n is the 
+        maximum length. Slots without a counterpart in a shorter model are mapped to its padding states.
+    Returns:
+        A (k, q) array that contains the model state for each slot in the shared layout.
+    """
+    n = max(lengths)
+    q = 2*n+3
+    order = np.zeros((len(lengths), q), dtype=np.int32)
+    for i, length in enumerate(lengths):
+        slots = np.concatenate([np.arange(length+1), 
+                                -np.ones(n-length, dtype=np.int64),
+                                np.arange(length+1, 2*length), 
+                                -np.ones(n-length, dtype=np.int64),
+                                np.arange(2*length, 2*length+3)])
+        slots[slots == -1] = np.arange(2*length+3, q)
+        order[i] = slots
+    return order
+
+
+def _make_block_transition_indices(implicit_transition_parts, sparse_transition_indices_implicit, max_num_states):
+    """ Returns the part names (per model) and indices of a sparse block diagonal (k*q x k*q) matrix that contains 
+        all implicit transitions except match_skip as well as the permutation that orders the values row-major.
+    """
+    block_parts, block_indices = [], []
+    for i, (parts, indices) in enumerate(zip(implicit_transition_parts, sparse_transition_indices_implicit)):
+        part_names = [part_name for part_name, length in parts if part_name != "match_skip" and length > 0]
+        block_parts.append(part_names)
+        block_indices.append(np.concatenate([np.array(indices[part_name], dtype=np.int64).reshape(-1, 2) 
+                                                for part_name in part_names], axis=0) + i*max_num_states)
+    block_indices = np.concatenate(block_indices, axis=0)
+    num_rows = len(implicit_transition_parts) * max_num_states
+    row_major_order = np.argsort(block_indices[:,0]*num_rows + block_indices[:,1], kind="stable")
+    return block_parts, block_indices[row_major_order], row_major_order
+
             
 def _assert_transition_init_kernel(kernel_init, parts):
     for part_name,_ in parts:
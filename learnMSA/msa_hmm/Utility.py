@@ -188,6 +188,17 @@ def make_kernel(mean, scale, diag_bijector=DefaultDiagBijector(1.)):
         raise ValueError(f"Invalid scale shape: {scale.shape}")
 
 
+def softmax(logits, axis=-1, count_gradients=False):
+    """ Softmax that optionally treats the normalizer as a constant during differentiation. 
+        The values are unchanged, but the gradient of a log-likelihood w.r.t. the logits is then 
+        the expected number of times each category is used (i.e. the expected counts for EM).
+    """
+    if count_gradients:
+        log_norm = tf.stop_gradient(tf.math.reduce_logsumexp(logits, axis=axis, keepdims=True))
+        return tf.math.exp(logits - log_norm)
+    return tf.nn.softmax(logits, axis=axis)
+
+
 def deserialize(obj):
     if version.parse(tf.__version__) < version.parse("2.11.0"):
         return obj
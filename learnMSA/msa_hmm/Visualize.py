@@ -242,7 +242,10 @@ def plot_anc_probs(am,
                                     batch_size=n, 
                                     shuffle=False)
     for x,_ in ds:
-        ancs = am.encoder_model(x).numpy()[model_index]
+        ancs = am.encoder_model(x)
+        if isinstance(ancs, (tuple, list)):
+            ancs = msa_hmm.AncProbsLayer.lookup_anc_probs(*ancs)
+        ancs = ancs.numpy()[model_index]
     i = [l.name for l in am.encoder_model.layers].index("anc_probs_layer")
     anc_probs_layer = am.encoder_model.layers[i]
     indices = np.stack([am.indices]*am.msa_hmm_layer.cell.num_models)
@@ -2,11 +2,15 @@ import tensorflow as tf
 import numpy as np
 import learnMSA.msa_hmm.Training as train
 from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
+from learnMSA.msa_hmm.StateSequences import StateSequences
 import time
 import math
 from functools import partial
 
 
+#models of at least this length are decoded with the structured Viterbi if possible
+STRUCTURED_VITERBI_MIN_LENGTH = 64
+
 
 def safe_log(x, log_zero_val=-1e3):
     """ Computes element-wise logarithm with output_i=log_zero_val where x_i=0.
@@ -228,13 +232,164 @@ def viterbi_full_chunk_backtracking(viterbi_chunk_borders, local_gamma, transiti
     return state_seqs_max_lik
 
 
+def _prefix_max(x):
+    """ Running maximum along the last axis and the first index where it is attained. Runs in log2(n) vectorized steps.
+    """
+    n = x.shape[-1]
+    index = tf.broadcast_to(tf.range(n), tf.shape(x))
+    paddings = [[0,0]] * (len(x.shape)-1)
+    shift = 1
+    while shift < n:
+        x_shifted = tf.pad(x[..., :-shift], paddings + [[shift,0]], constant_values=-np.inf)
+        index_shifted = tf.pad(index[..., :-shift], paddings + [[shift,0]])
+        #prefer the earlier window on ties
+        take_shifted = x_shifted >= x
+        x = tf.where(take_shifted, x_shifted, x)
+        index = tf.where(take_shifted, index_shifted, index)
+        shift *= 2
+    return x, index
+
+
+def _select_max(candidates):
+    """ Element-wise maximum of (value, state) candidates that are given in increasing order of the states. 
+        Ties are resolved in favor of the smaller state like tf.math.argmax does.
+    """
+    value, states = candidates[0]
+    states = tf.broadcast_to(tf.cast(states, tf.int32), tf.shape(value))
+    for v, s in candidates[1:]:
+        better = v > value
+        value = tf.where(better, v, value)
+        states = tf.where(better, tf.cast(s, tf.int32), states)
+    return value, states
+
+
+@tf.function
+def viterbi_structured_step(gamma_prev, emission_probs_i, transitions):
+    """ Computes one Viterbi step for profile HMMs in O(q) per sequence using the topology of the model. 
+        States are in the shared layout of ProfileHMMTransitioner.make_viterbi_transitions. 
+        Each state has a constant number of predecessors except for the match_skip transitions, 
+        whose maximum is a running maximum over the match states.
+    Args:
+        gamma_prev: Viterbi values of the previous recursion. Shape (num_models, b, q)
+        emission_probs_i: Emission probabilities of the i-th vertical input slice. Shape (num_models, b, q)
+        transitions: A dictionary of logarithmic transition probabilities (see make_viterbi_transitions).
+    Returns:
+        Viterbi values of the current recursion (gamma_next) and the most likely predecessor of each state. Shapes (num_models, b, q)
+    """
+    t = transitions
+    n = t["left_flank_to_match"].shape[-1]
+    lf, u, r, term = 0, 2*n, 2*n+1, 2*n+2
+    g_lf, g_m, g_i, g_u, g_r, g_t = tf.split(gamma_prev, [1, n, n-1, 1, 1, 1], axis=-1)
+    match = tf.range(1, n+1)
+    #match_skip: the best source is found with a running maximum over the separable transition scores
+    #the value of the selected source is scored with the same expression, so ranking and scoring agree on near-ties
+    skip_max, skip_source = _prefix_max(g_m + t["skip_out"])
+    skip_source = tf.pad(skip_source[..., :-2], [[0,0], [0,0], [2,0]])
+    skip = tf.pad(skip_max[..., :-2], [[0,0], [0,0], [2,0]], constant_values=-np.inf) + t["skip_in"]
+    shift_right = lambda x: tf.pad(x, [[0,0], [0,0], [1,0]], constant_values=-np.inf)
+    #all other predecessors in increasing order
+    lf_next = _select_max([(g_lf + t["left_flank_loop"], lf)])
+    m_next = _select_max([(g_lf + t["left_flank_to_match"], lf),
+                          (skip, skip_source+1),
+                          (shift_right(g_m[..., :-1] + t["match_to_match"]), match-1),
+                          (shift_right(g_i + t["insert_to_match"]), match+n-1),
+                          (g_u + t["unannotated_segment_to_match"], u)])
+    i_next = _select_max([(g_m[..., :-1] + t["match_to_insert"], match[:-1]),
+                          (g_i + t["insert_to_insert"], match[:-1]+n)])
+    def match_to(key):
+        g = g_m + t[key]
+        return tf.reduce_max(g, axis=-1, keepdims=True), tf.math.argmax(g, axis=-1, output_type=tf.int32)[..., tf.newaxis]+1
+    u_next = _select_max([(g_lf + t["left_flank_to_unannotated_segment"], lf),
+                          match_to("match_to_unannotated"),
+                          (g_u + t["unannotated_segment_loop"], u)])
+    r_next = _select_max([(g_lf + t["left_flank_to_right_flank"], lf),
+                          match_to("match_to_right_flank"),
+                          (g_u + t["unannotated_segment_to_right_flank"], u),
+                          (g_r + t["right_flank_loop"], r)])
+    t_next = _select_max([(g_lf + t["left_flank_to_terminal"], lf),
+                          match_to("match_to_terminal"),
+                          (g_u + t["unannotated_segment_to_terminal"], u),
+                          (g_r + t["right_flank_exit"], r),
+                          (g_t + t["terminal_self_loop"], term)])
+    gamma_next, predecessors = (tf.concat(x, axis=-1) for x in zip(lf_next, m_next, i_next, u_next, r_next, t_next))
+    gamma_next += safe_log(emission_probs_i)
+    return gamma_next, predecessors
+
+
+def viterbi_structured_dyn_prog(emission_probs, init, transitions, pointer_dtype=tf.int32):
+    """ Structured Viterbi for profile HMMs that stores the most likely predecessor of each state instead of 
+        the Viterbi values. States are in the shared layout of ProfileHMMTransitioner.make_viterbi_transitions.
+    Args:
+        emission_probs: Tensor. Shape (num_models, b, L, q).
+        init: Initial state distribution. Shape (num_models, 1, q).
+        transitions: A dictionary of logarithmic transition probabilities (see make_viterbi_transitions).
+        pointer_dtype: Integer type used to store the predecessors.
+    Returns:
+        Viterbi values of the last position. Shape (num_models, b, q)
+        A TensorArray of size L with the predecessors of all states at each position. Shape of elements (num_models, b, q)
+    """
+    gamma_val = safe_log(init) + safe_log(emission_probs[:,:,0])
+    L = tf.shape(emission_probs)[2]
+    pointers = tf.TensorArray(pointer_dtype, size=L)
+    pointers = pointers.write(0, tf.zeros_like(gamma_val, dtype=pointer_dtype))
+    for i in tf.range(1, L):
+        gamma_val, predecessors = viterbi_structured_step(gamma_val, emission_probs[:,:,i], transitions)
+        pointers = pointers.write(i, tf.cast(predecessors, pointer_dtype))
+    return gamma_val, pointers
+
+
+def viterbi_pointer_backtracking(gamma_last, pointers, output_type=tf.int32):
+    """ Follows the predecessor pointers from the most likely last state.
+    Args:
+        gamma_last: Viterbi values of the last position. Shape (num_models, b, q)
+        pointers: TensorArray of predecessors as returned by viterbi_structured_dyn_prog.
+        output_type: Output type of the state sequences.
+    Returns:
+        State sequences. Shape (num_model, b, L).
+    """
+    cur_states = tf.math.argmax(gamma_last, axis=-1, output_type=output_type)
+    L = pointers.size()
+    state_seqs_max_lik = tf.TensorArray(output_type, size=L)
+    state_seqs_max_lik = state_seqs_max_lik.write(L-1, cur_states)
+    for i in tf.range(L-1, 0, -1):
+        cur_states = tf.gather(pointers.read(i), cur_states[..., tf.newaxis], batch_dims=2)[..., 0]
+        cur_states = tf.cast(cur_states, output_type)
+        state_seqs_max_lik = state_seqs_max_lik.write(i-1, cur_states)
+    return tf.transpose(state_seqs_max_lik.stack(), [1,2,0])
+
+
+def viterbi_structured(emission_probs, hmm_cell):
+    """ Decodes with the structured Viterbi of the profile HMM transitioner. The result is the same as 
+        that of the dense Viterbi, but each step requires O(q) instead of O(q^2) time and memory per sequence.
+        Match_skip transitions are scored in separable form, which differs from the dense transition matrix 
+        only by floating point rounding. Paths can therefore differ only where their scores tie up to rounding.
+    Args:
+        emission_probs: Emission probabilities. Shape (num_models, b, L, q).
+        hmm_cell: A HMM cell with a ProfileHMMTransitioner.
+    Returns:
+        State sequences. Shape (num_models, b, L)
+    """
+    transitioner = hmm_cell.transitioner
+    state_order = transitioner.canonical_state_order
+    pointer_dtype = tf.int16 if hmm_cell.max_num_states <= np.iinfo(np.int16).max else tf.int32
+    #work in the layout shared by all models
+    emission_probs = tf.gather(emission_probs, state_order, axis=-1, batch_dims=1)
+    init = tf.gather(tf.transpose(hmm_cell.init_dist, (1,0,2)), state_order, axis=-1, batch_dims=1)
+    gamma_last, pointers = viterbi_structured_dyn_prog(emission_probs, init, transitioner.make_viterbi_transitions(), pointer_dtype)
+    viterbi_paths = viterbi_pointer_backtracking(gamma_last, pointers)
+    return tf.gather(state_order, viterbi_paths, batch_dims=1)
+
+
 def viterbi(sequences, hmm_cell, end_hints=None, parallel_factor=1, return_variables=False, non_homogeneous_mask_func=None):
     """ Computes the most likely sequence of hidden states given unaligned sequences and a number of models.
         The implementation is logarithmic (underflow safe) and capable of decoding many sequences in parallel 
         on the GPU. Optionally the function can also parallelize over the sequence length at the cost of memory usage.
         (recommended for long sequences and HMMs with few states)
+        Profile HMMs of at least STRUCTURED_VITERBI_MIN_LENGTH match states are decoded with the structured Viterbi
+        in O(q) per step if parallel_factor is 1, no mask function is given and the variables are not requested.
     Args:
-        sequences: Input sequences. Shape (num_models, b, L, s) or (num_models, b, L)
+        sequences: Input sequences. Shape (num_models, b, L, s) or (num_models, b, L) or a pair of sequences
+                    of shape (num_models, b, L) and lookup tables of shape (num_models, b, s, d) (see AncProbsLayer).
         hmm_cell: A HMM cell representing k models used for decoding.
         end_hints: A optional tensor of shape (..., 2, num_states) that contains the correct state for the left and right ends of each chunk. (experimental)
         parallel_factor: Increasing this number allows computing likelihoods and posteriors chunk-wise in parallel at the cost of memory usage.
@@ -246,13 +401,23 @@ def viterbi(sequences, hmm_cell, end_hints=None, parallel_factor=1, return_varia
     Returns:
         State sequences. Shape (num_models, b, L)
     """
-    if len(sequences.shape) == 3:
-        sequences = tf.one_hot(sequences, hmm_cell.dim, dtype=hmm_cell.dtype)
+    if isinstance(sequences, (tuple, list)):
+        #the last symbol of the lookup tables is the terminal symbol
+        sequences = (sequences[0], tf.cast(sequences[1], hmm_cell.dtype))
+        terminal = tf.shape(sequences[1])[-2]-1
+        seq_lens = tf.reduce_sum(tf.cast(tf.cast(sequences[0], tf.int32) != terminal, tf.int32), axis=-1)
     else:
-        sequences = tf.cast(sequences, hmm_cell.dtype)
-    seq_lens = tf.reduce_sum(tf.cast(sequences[..., -1]==0, tf.int32), axis=-1)
+        if len(sequences.shape) == 3:
+            sequences = tf.one_hot(sequences, hmm_cell.dim, dtype=hmm_cell.dtype)
+        else:
+            sequences = tf.cast(sequences, hmm_cell.dtype)
+        seq_lens = tf.reduce_sum(tf.cast(sequences[..., -1]==0, tf.int32), axis=-1)
     #compute all emission probabilities in parallel
     emission_probs = hmm_cell.emission_probs(sequences, end_hints=end_hints, training=False)
+    if (parallel_factor == 1 and non_homogeneous_mask_func is None and not return_variables 
+            and hasattr(hmm_cell.transitioner, "make_viterbi_transitions")
+            and max(hmm_cell.transitioner.lengths) >= STRUCTURED_VITERBI_MIN_LENGTH):
+        return viterbi_structured(emission_probs, hmm_cell)
     num_model, b, seq_len, q = tf.unstack(tf.shape(emission_probs))
     tf.debugging.assert_equal(seq_len % parallel_factor, 0, 
         f"The sequence length ({seq_len}) has to be divisible by the parallel factor ({parallel_factor}).")
@@ -262,8 +427,12 @@ def viterbi(sequences, hmm_cell, end_hints=None, parallel_factor=1, return_varia
     init_dist = tf.transpose(hmm_cell.init_dist, (1,0,2)) #(num_models, 1, q)
     init = init_dist if parallel_factor == 1 else tf.eye(q, dtype=hmm_cell.dtype)[tf.newaxis] 
     z = tf.shape(init)[1] #1 if parallel_factor == 1, q otherwise
-    A = hmm_cell.log_A_dense
-    At = hmm_cell.log_A_dense_t
+    if hmm_cell.log_A_dense is None:
+        A = hmm_cell.transitioner.make_log_A()
+        At = tf.transpose(A, [0,2,1])
+    else:
+        A = hmm_cell.log_A_dense
+        At = hmm_cell.log_A_dense_t
     if non_homogeneous_mask_func is not None:
         non_homogeneous_mask_func = partial(non_homogeneous_mask_func, seq_lens=seq_lens, hmm_cell=hmm_cell)
     gamma = viterbi_dyn_prog(emission_probs, init, A, 
@@ -300,7 +469,8 @@ def get_state_seqs_max_lik(data : SequenceDataset,
                            model_ids,
                            encoder=None,
                            non_homogeneous_mask_func=None,
-                           parallel_factor=1):
+                           parallel_factor=1,
+                           run_length_encoded=False):
     """ Runs batch-wise viterbi on all sequences in the dataset as specified by indices.
     Args:
         data: The sequence dataset.
@@ -312,8 +482,39 @@ def get_state_seqs_max_lik(data : SequenceDataset,
         non_homogeneous_mask_func: Optional function that maps a sequence index i to a num_model x batch x q x q mask that specifies which transitions are allowed.
         parallel_factor: Increasing this number allows computing likelihoods and posteriors chunk-wise in parallel at the cost of memory usage.
                         The parallel factor has to be a divisor of the sequence length.
+        run_length_encoded: If true, the state sequences are stored as runs.
     Returns:
-        A dense integer representation of the most likely state sequences. Shape: (num_model, num_seq, L)
+        The most likely state sequences of all models as a StateSequences object 
+        that stores each sequence with its own length plus a terminal position.
+    """
+    #decode each distinct sequence only once
+    unique_indices, _, inverse = data.get_unique_indices(indices)
+    if unique_indices.size < indices.size:
+        state_seqs_max_lik = get_state_seqs_max_lik(data, batch_generator, unique_indices, batch_size, hmm_cell, model_ids, 
+                                                    encoder, non_homogeneous_mask_func, parallel_factor, run_length_encoded)
+        return state_seqs_max_lik.select(inverse)
+    state_seqs_max_lik = StateSequences(hmm_cell.length, data.seq_lens[indices]+1, run_length_encoded)
+    for batch_rows, state_seqs_max_lik_batch in iter_state_seqs_max_lik(data, batch_generator, indices, batch_size, hmm_cell, model_ids,
+                                                                          encoder, non_homogeneous_mask_func, parallel_factor):
+        state_seqs_max_lik.set_batch(batch_rows, state_seqs_max_lik_batch)
+    return state_seqs_max_lik
+
+
+def iter_state_seqs_max_lik(data : SequenceDataset,
+                            batch_generator,
+                            indices,
+                            batch_size,
+                            hmm_cell, 
+                            model_ids,
+                            encoder=None,
+                            non_homogeneous_mask_func=None,
+                            parallel_factor=1):
+    """ Runs batch-wise viterbi on the sequences specified by indices and yields the state sequences of one batch at a time.
+        Batches are bucketed by sequence length and do not follow the order of indices.
+        Args are the same as for get_state_seqs_max_lik. Duplicates are not collapsed.
+    Yields:
+        batch_rows: Positions of the sequences of the batch in indices. Shape (b)
+        state_seqs_max_lik: Dense most likely state sequences of the batch. Shape (num_models, b, L)
     """
     #does currently not support multi-GPU, scale the batch size to account for that and prevent overflow
     num_gpu = len([x.name for x in tf.config.list_logical_devices() if x.device_type == 'GPU']) 
@@ -327,17 +528,14 @@ def get_state_seqs_max_lik(data : SequenceDataset,
                             batch_size,
                             shuffle=False,
                             bucket_by_seq_length=True,
-                            model_lengths=hmm_cell.length)
-    seq_len = np.amax(data.seq_lens[indices]+1)
-    #initialize with terminal states
-    state_seqs_max_lik = np.zeros((hmm_cell.num_models, indices.size, seq_len), 
-                                  dtype=np.uint32) 
+                            model_lengths=hmm_cell.length,
+                            parallel_factor=parallel_factor)
     if encoder:
         @tf.function(input_signature=[[tf.TensorSpec(x.shape, dtype=x.dtype) for x in encoder.inputs]])
         def call_viterbi(inputs):
             encoded_seq = encoder(inputs)
             #todo: this can be improved by encoding only for required models, not all
-            encoded_seq = tf.gather(encoded_seq, model_ids, axis=0)
+            encoded_seq = tf.nest.map_structure(lambda x: tf.gather(x, model_ids, axis=0), encoded_seq)
             viterbi_seq = viterbi(encoded_seq, hmm_cell, parallel_factor=parallel_factor, non_homogeneous_mask_func=non_homogeneous_mask_func)
             return viterbi_seq
     
@@ -348,20 +546,16 @@ def get_state_seqs_max_lik(data : SequenceDataset,
         else:
             seq = encoder(inputs) 
         #todo: this can be improved by encoding only for required models, not all
-        seq = tf.gather(seq, model_ids, axis=0)
+        seq = tf.nest.map_structure(lambda x: tf.gather(x, model_ids, axis=0), seq)
         return viterbi(seq, hmm_cell, parallel_factor=parallel_factor, non_homogeneous_mask_func=non_homogeneous_mask_func)
     
-    for i,q in enumerate(hmm_cell.num_states):
-        state_seqs_max_lik[i] = q-1 #terminal state
-    for (*inputs, batch_indices), _ in ds:
-        if hasattr(batch_generator, "return_only_sequences") and batch_generator.return_only_sequences:
-            state_seqs_max_lik_batch = call_viterbi_single(inputs[0]).numpy()
-        else:
-            state_seqs_max_lik_batch = call_viterbi(inputs).numpy()
-        _,b,l = state_seqs_max_lik_batch.shape
-        state_seqs_max_lik[:, batch_indices, :l] = state_seqs_max_lik_batch
-
-    # revert batch generator state
-    batch_generator.crop_long_seqs = old_crop_long_seqs
-
-    return state_seqs_max_lik
\ No newline at end of file
+    try:
+        for (*inputs, batch_indices), _ in ds:
+            if hasattr(batch_generator, "return_only_sequences") and batch_generator.return_only_sequences:
+                state_seqs_max_lik_batch = call_viterbi_single(inputs[0]).numpy()
+            else:
+                state_seqs_max_lik_batch = call_viterbi(inputs).numpy()
+            yield batch_indices.numpy(), state_seqs_max_lik_batch
+    finally:
+        # revert batch generator state
+        batch_generator.crop_long_seqs = old_crop_long_seqs
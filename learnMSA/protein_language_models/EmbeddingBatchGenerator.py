@@ -3,7 +3,7 @@ import os
 import gc
 import numpy as np
 import tensorflow as tf
-from learnMSA.msa_hmm.Training import DefaultBatchGenerator, default_model_generator, PermuteSeqs, Identity, LearnMSAModel
+from learnMSA.msa_hmm.Training import DefaultBatchGenerator, GraphBatchGenerator, default_model_generator, PermuteSeqs, Identity, LearnMSAModel
 from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
 from learnMSA.protein_language_models.BilinearSymmetric import make_scoring_model
 import learnMSA.protein_language_models.Common as Common
@@ -121,6 +121,39 @@ class EmbeddingBatchGenerator(DefaultBatchGenerator):
             raise NotImplementedError("Sampling embedding variance is not supported when embeddings are not cached.")
 
 
+class GraphEmbeddingBatchGenerator(GraphBatchGenerator, EmbeddingBatchGenerator):
+    """ Graph-native version of EmbeddingBatchGenerator. Crops and pads the cached embeddings with TensorFlow ops.
+        Requires cache_embeddings=True. The cache is moved into a constant tensor once when configuring the generator 
+        and the cache array is replaced by a view of the tensor, i.e. the embeddings are held in memory only once.
+    """
+    def configure(self, data : SequenceDataset, config, verbose=False):
+        if not self.cache_embeddings:
+            raise ValueError("GraphEmbeddingBatchGenerator requires cache_embeddings=True.")
+        super().configure(data, config, verbose)
+        if getattr(self, "tf_cache", None) is None or self.cache.cache is not self._cache_view:
+            #the input pipeline runs on the CPU, where the tensor and the numpy view share their buffer
+            with tf.device("/CPU:0"):
+                self.tf_cache = tf.constant(self.cache.cache)
+            self.cache.cache = self._cache_view = self.tf_cache.numpy()
+        self.tf_cache_offsets = tf.constant(self.cache.cum_lens.astype(np.int64))
+
+    def tf_call(self, indices):
+        batch, batch_indices, start, end = self._tf_assemble(indices)
+        if self.return_only_sequences:
+            return (batch,)
+        start = tf.cast(start, tf.int64)
+        lens = tf.cast(end, tf.int64) - start
+        emb_starts = tf.gather(self.tf_cache_offsets, batch_indices) + start
+        positions = tf.range(tf.reduce_max(lens)+1, dtype=tf.int64)
+        in_seq = positions < lens[..., tf.newaxis]
+        gather_ind = tf.where(in_seq, emb_starts[..., tf.newaxis] + positions, 0)
+        mask = tf.cast(in_seq, tf.float32)[..., tf.newaxis]
+        embeddings = tf.cast(tf.gather(self.tf_cache, gather_ind), tf.float32) * mask
+        #zero padding for all embedding dimensions and one in the terminal dimension
+        padded_embeddings = tf.concat([embeddings, 1-mask], axis=-1)
+        return batch, batch_indices, padded_embeddings
+
+
 def make_generic_embedding_model_generator(dim):
     def generic_embedding_model_generator(encoder_layers,
                                         msa_hmm_layer):
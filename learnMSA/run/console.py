@@ -29,10 +29,10 @@ def run_main():
                         help="Number of models trained in parallel. (default: %(default)s)")
     parser.add_argument("-s", "--silent", dest="silent", action='store_true', help="Prevents output to stdout.")
     parser.add_argument("-b", "--batch", dest="batch_size", type=int, default=-1,
-                        help="Should be lowered if memory issues with the default settings occur. Default: Adaptive, depending on model length (64-512).")
+                        help="Should be lowered if memory issues with the default settings occur. Default: Adaptive, depending on sequence and model length and the memory of the device (at most 512 per device). The memory usage is measured once per machine.")
     parser.add_argument("-d", "--cuda_visible_devices", dest="cuda_visible_devices", type=str, default="default",
                         help="Controls the GPU devices visible to learnMSA as a comma-separated list of device IDs. The value -1 forces learnMSA to run on CPU. Per default, learnMSA attempts to use all available GPUs.")
-    parser.add_argument("-f", "--format", dest="format", type=str, default="fasta", help="Output file format (see Biopython's SeqIO formats suitable for aligned data).")
+    parser.add_argument("-f", "--format", dest="format", type=str, default="fasta", help="Output file format (a2m, a3m or see Biopython's SeqIO formats suitable for aligned data).")
     parser.add_argument("--save_model", dest="save_model", type=str, default="", help="Optional filepath to store the trained model.")
     parser.add_argument("--load_model", dest="load_model", type=str, default="", help="A pretrained model can be loaded from a file, skipping the training process.")
 
@@ -48,6 +48,8 @@ def run_main():
                         help="Multiplicative constant for the quantile used to define the initial model length (see --length_init_quantile). (default: %(default)s)")
     parser.add_argument("--learning_rate", dest="learning_rate", type=float, default=0.1, 
                         help="The learning rate used during gradient descent. (default: %(default)s)")
+    parser.add_argument("--trainer", dest="trainer", type=str, default="adam", choices=["adam", "em"],
+                        help="Trains the profile HMMs with Adam or with stepwise online EM (Baum-Welch). With em, only the encoder is trained with Adam. (default: %(default)s)")
     parser.add_argument("--epochs", dest="epochs", type=int, nargs=3, default=[10, 2, 10],
                        help="Scheme for the number of training epochs during the first, an intermediate and the last iteration (expects 3 integers in this order). (default: %(default)s)")
     parser.add_argument("--surgery_del", dest="surgery_del", type=float, default=0.5,
@@ -56,12 +58,16 @@ def run_main():
                        help="Will expand insertions that are expected more often than this fraction. (default: %(default)s)")
     parser.add_argument("--model_criterion", dest="model_criterion", type=str, default="AIC",
                        help="Criterion for model selection. (default: %(default)s)")
-    parser.add_argument("--indexed_data", dest="indexed_data", action='store_true', help="Don't load all data into memory at once at the cost of training time.")
+    parser.add_argument("--indexed_data", dest="indexed_data", action='store_true', help="Don't load all data into memory at once. The input is converted to a memory-mapped store on disk. The input file can also be a store directory created with SequenceDataset.make_sequence_store.")
+    parser.add_argument("--threads", dest="threads", type=int, default=0, help="Number of processes used to parse large input files. Default: Number of available CPU cores.")
     
     parser.add_argument("--unaligned_insertions", dest="unaligned_insertions", action='store_true', help="Insertions will be left unaligned.")
     parser.add_argument("--crop", dest="crop", type=str,  default="auto", help="""During training, sequences longer than the given value will be cropped randomly. 
     Reduces training runtime and memory usage, but might produce inaccurate results if too much of the sequences is cropped. The output alignment will not be cropped. 
     Can be set to auto in which case sequences longer than 3 times the average length are cropped. Can be set to disable. (default: %(default)s)""")
+    parser.add_argument("--length_buckets", dest="length_buckets", type=int, default=0, help="""Groups the training sequences into this many buckets of similar length. 
+    Each training batch is drawn from a single bucket and its size is chosen such that all batches contain about the same number of residues. 
+    Reduces padding and training runtime if the sequence lengths vary a lot. 0 disables bucketing. (default: %(default)s)""")
     parser.add_argument("--frozen_insertions", dest="frozen_insertions", action='store_true', help="Insertions will be frozen during training.")
     
     parser.add_argument("--sequence_weights", dest="sequence_weights", action='store_true', help="Uses mmseqs2 to rapidly cluster the sequences and compute sequence weights before the MSA. (default: %(default)s)")
@@ -95,6 +101,9 @@ def run_main():
     parser.add_argument("--embedding_prior_components", dest="embedding_prior_components", type=int, default=32, help="Number of components of the multivariate normal prior distribution over the embedding weights. (default: %(default)s)")
     parser.add_argument("--temperature", dest="temperature", type=float, default=3., help="Temperature of the softmax function. (default: %(default)s)")
     
+    parser.add_argument("--no_memory_calibration", dest="no_memory_calibration", action='store_true', 
+                        help="Skips measuring the peak memory of a few short training steps on the first run on a machine. The measurement is used to derive adaptive batch sizes and cached per machine. Without it, hand-tuned batch sizes are used.")
+    
     parser.add_argument("--logo", dest="logo", action='store_true', help="Produces a gif that animates the learned sequence logo over training time.")
     parser.add_argument("--logo_gif", dest="logo_gif", action='store_true', help="Produces a gif that animates the learned sequence logo over training time. Slows down training significantly.")
     parser.add_argument("--logo_path", dest="logo_path", type=str, default="./logo/", help="Filepath used to store created logos and logo gifs. Directories are created. (default: %(default)s)")
@@ -115,6 +124,11 @@ def run_main():
     import tensorflow as tf
     from tensorflow.python.client import device_lib
     
+    if not args.no_memory_calibration:
+        #the probe runs once per machine in a separate process and has to run before a GPU is initialized here
+        from ..msa_hmm.MemoryCostModel import calibrate_default_cost_model
+        calibrate_default_cost_model(verbose=not args.silent)
+    
     if not args.silent:
         GPUS = [x.physical_device_desc for x in device_lib.list_local_devices() if x.device_type == 'GPU']
         if len(GPUS) == 0:
@@ -154,9 +168,11 @@ def run_main():
     config["surgery_quantile"] = args.surgery_quantile
     config["min_surgery_seqs"] = args.min_surgery_seqs
     config["len_mul"] = args.len_mul
+    config["length_buckets"] = args.length_buckets
     if not args.use_language_model:
         config["learning_rate"] = args.learning_rate
         config["epochs"] = args.epochs
+    config["trainer"] = args.trainer
     config["surgery_del"] = args.surgery_del
     config["surgery_ins"] = args.surgery_ins
     config["model_criterion"] = args.model_criterion
@@ -197,7 +213,7 @@ def run_main():
         if args.logo_gif:
             os.makedirs(args.logo_path+"/frames/", exist_ok = True)
     try:
-        with SequenceDataset(args.input_file, "fasta", indexed=args.indexed_data) as data:
+        with SequenceDataset(args.input_file, "fasta", indexed=args.indexed_data, threads=args.threads if args.threads > 0 else get_num_available_cpus()) as data:
             data.validate_dataset()
             if args.crop == "disable":
                 config["crop_long_seqs"] = math.inf
@@ -233,20 +249,29 @@ def run_main():
                 i = [l.name for l in alignment_model.encoder_model.layers].index("anc_probs_layer")
                 anc_probs_layer = alignment_model.encoder_model.layers[i]
                 tau_all = []
-                for (seq, indices),_ in Training.make_dataset(alignment_model.indices, alignment_model.batch_generator, alignment_model.batch_size, shuffle=False):
+                #exact duplicates share the evolutionary time of their representative
+                unique_indices, _, inverse = alignment_model.data.get_unique_indices(alignment_model.indices)
+                for (seq, indices),_ in Training.make_dataset(unique_indices, alignment_model.batch_generator, alignment_model.batch_size, shuffle=False):
                     seq = tf.transpose(seq, [1,0,2])
                     indices = tf.transpose(indices)
                     indices.set_shape([alignment_model.num_models,None]) #resolves tf 2.12 issues
                     indices = tf.expand_dims(indices, axis=-1)
                     tau = anc_probs_layer.make_tau(seq, indices)[alignment_model.best_model]
                     tau_all.append(tau.numpy())
-                tau = np.concatenate(tau_all)
+                tau = np.concatenate(tau_all)[inverse]
                 with open(args.dist_out, "w") as file:
                     for i,t in zip(alignment_model.data.seq_ids, tau):
                         file.write(f"{i}\t{t}\n")
     except ValueError as e:
         raise SystemExit(e) 
  
+
+def get_num_available_cpus():
+    #respects the CPU affinity of the process, e.g. on cluster or container jobs
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+ 
             
 if __name__ == '__main__':
     run_main()
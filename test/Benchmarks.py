@@ -0,0 +1,138 @@
+""" Runtime benchmarks for performance critical parts of learnMSA.
+    Run from the repository root, e.g.: python -m test.Benchmarks parsing --file test/data/PF00008_uniprot.fasta
+"""
+import sys
+import re
+import argparse
+import numpy as np
+from time import perf_counter
+from Bio import SeqIO
+from learnMSA.msa_hmm.SequenceDataset import SequenceDataset
+
+
+
+def _time(func, reps):
+    times = []
+    for _ in range(reps):
+        t = perf_counter()
+        func()
+        times.append(perf_counter()-t)
+    return np.amin(times)
+
+
+def benchmark_parsing(filename, reps=3):
+    """ Compares the byte-level fasta parser and lookup table encoding of SequenceDataset with 
+        the Biopython path and per-residue encoding.
+    """
+    alphabet = SequenceDataset.alphabet
+    def biopython_parse():
+        record_dict = SeqIO.to_dict(SeqIO.parse(filename, "fasta"))
+        seq_lens = np.array([sum([1 for x in str(record_dict[sid].seq) if x.isalpha()]) for sid in record_dict])
+        return record_dict
+    def biopython_encode(record_dict):
+        # the per-residue encoding of SequenceDataset before the lookup table was introduced
+        for record in record_dict.values():
+            seq_str = str(record.upper().seq)
+            for aa in "BZJ":
+                seq_str = seq_str.replace(aa, "X")
+            for s in "-.":
+                seq_str = seq_str.replace(s, "")
+            if bool(re.compile(rf"[^{alphabet}]").search(seq_str)):
+                raise ValueError("Found unknown character(s).")
+            np.array([alphabet.index(aa) for aa in seq_str], dtype=np.int16)
+    def byte_level_parse():
+        return SequenceDataset(filename, "fasta")
+    def byte_level_encode(data):
+        for i in range(data.num_seq):
+            data.get_encoded_seq(i)
+    record_dict = biopython_parse()
+    data = byte_level_parse()
+    results = [("parsing", _time(biopython_parse, reps), _time(byte_level_parse, reps)),
+               ("encoding", _time(lambda: biopython_encode(record_dict), reps), _time(lambda: byte_level_encode(data), reps))]
+    print(f"{filename} ({data.num_seq} sequences):")
+    for name, t_bio, t_raw in results:
+        print(f"{name:>10}: Biopython {t_bio:.3f}s  byte-level {t_raw:.3f}s  speedup {t_bio/t_raw:.1f}x")
+
+
+def benchmark_batch_generator(filename, reps=3, batch_size=512, num_models=5, steps=50):
+    """ Compares the vectorized DefaultBatchGenerator with the per-sequence encoding it replaced.
+        Reports steps/sec of the batch generator alone and of the input pipeline created by make_dataset on CPU.
+        Also reports the pipeline with the graph-native GraphBatchGenerator.
+    """
+    import math
+    from learnMSA.msa_hmm import Training
+    data = SequenceDataset(filename, "fasta")
+    config = {"num_models" : num_models, "crop_long_seqs" : math.inf, "batch_size" : batch_size}
+    class PerSequenceBatchGenerator(Training.DefaultBatchGenerator):
+        # the batch assembly of DefaultBatchGenerator before vectorization
+        def __call__(self, indices):
+            permutated_indices = np.stack([perm[indices] for perm in self.permutations], axis=1)
+            max_len = min(np.max(self.data.seq_lens[permutated_indices]), self.crop_long_seqs)
+            batch = np.zeros((indices.shape[0], self.num_models, max_len+1), dtype=np.uint8) + self.alphabet_size
+            for i,perm_ind in enumerate(permutated_indices):
+                for k,j in enumerate(perm_ind):
+                    seq = self.data.get_encoded_seq(j, crop_to_length=self.crop_long_seqs)
+                    batch[i, k, :min(self.data.seq_lens[j], self.crop_long_seqs)] = seq
+            return batch, permutated_indices
+    indices = np.arange(data.num_seq)
+    def generator_steps(batch_gen):
+        for _ in range(steps):
+            batch_gen(np.random.choice(indices, batch_size))
+    def pipeline_steps(batch_gen):
+        #time the steady state, i.e. without filling the shuffle buffer and tracing
+        it = iter(Training.make_dataset(indices, batch_gen, batch_size, shuffle=True))
+        next(it)
+        return _time(lambda: [next(it) for _ in range(steps)], reps)
+    print(f"{filename} ({data.num_seq} sequences, batch size {batch_size}, {num_models} models):")
+    for name, benchmark in [("generator", lambda batch_gen: _time(lambda: generator_steps(batch_gen), reps)), ("pipeline", pipeline_steps)]:
+        times = []
+        for batch_gen in [PerSequenceBatchGenerator(), Training.DefaultBatchGenerator()]:
+            batch_gen.configure(data, config)
+            times.append(benchmark(batch_gen))
+        print(f"{name:>10}: per-sequence {steps/times[0]:.1f} steps/s  vectorized {steps/times[1]:.1f} steps/s  speedup {times[0]/times[1]:.1f}x")
+    #graph-native pipeline without tf.numpy_function
+    batch_gen = Training.GraphBatchGenerator()
+    batch_gen.configure(data, config)
+    t = pipeline_steps(batch_gen)
+    print(f"{'graph':>10}: {steps/t:.1f} steps/s  speedup over vectorized pipeline {times[1]/t:.1f}x")
+
+
+def benchmark_anc_probs(reps=3, num_models=5, batch_size=512, seq_len=200, num_matrices=1, steps=10):
+    """ Compares the ancestral probabilities computed with one matrix exponential per sequence to the 
+        eigendecomposition of the time-reversible rate matrices. Reports forward and backward steps/sec.
+    """
+    import tensorflow as tf
+    from learnMSA.msa_hmm import Configuration, Training
+    config = Configuration.make_default(num_models)
+    config["num_rate_matrices"] = num_matrices
+    sequences = np.random.randint(0, 20, size=(num_models, batch_size, seq_len))
+    rate_indices = np.tile(np.arange(batch_size)[np.newaxis], (num_models, 1))
+    print(f"{num_models} models, batch size {batch_size}, length {seq_len}, {num_matrices} rate matrices:")
+    times = []
+    for use_eigendecomposition in [False, True]:
+        layer = Training.make_anc_probs_layer(batch_size, config)
+        layer.use_eigendecomposition = use_eigendecomposition
+        layer.build()
+        @tf.function
+        def step():
+            with tf.GradientTape() as tape:
+                anc_probs = layer(sequences, rate_indices)
+                loss = tf.reduce_sum(anc_probs[..., :20] * tf.range(20, dtype=anc_probs.dtype))
+            return tape.gradient(loss, layer.trainable_variables)
+        step() #tracing
+        times.append(_time(lambda: [step() for _ in range(steps)], reps))
+    print(f"{'anc probs':>10}: expm {steps/times[0]:.1f} steps/s  eigendecomposition {steps/times[1]:.1f} steps/s  speedup {times[0]/times[1]:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="learnMSA benchmarks")
+    parser.add_argument("benchmark", choices=["parsing", "batch_generator", "anc_probs"])
+    parser.add_argument("--file", default="test/data/PF00008_uniprot.fasta", help="Input fasta file.")
+    parser.add_argument("--reps", type=int, default=3, help="Number of repetitions (the minimum is reported).")
+    args = parser.parse_args()
+    if args.benchmark == "parsing":
+        benchmark_parsing(args.file, args.reps)
+    elif args.benchmark == "batch_generator":
+        benchmark_batch_generator(args.file, args.reps)
+    elif args.benchmark == "anc_probs":
+        benchmark_anc_probs(args.reps)
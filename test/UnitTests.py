@@ -10,12 +10,18 @@ import tensorflow as tf
 #globally omitting all warnings for the entire test suite should be avoided
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' 
 tf.get_logger().setLevel('WARNING')
-from learnMSA.msa_hmm import Align, Emitter, Transitioner, Initializers, MsaHmmCell, MsaHmmLayer, Training, Configuration, Viterbi, AncProbsLayer, Priors, DirichletMixture, Utility
-from learnMSA.msa_hmm.SequenceDataset import SequenceDataset, AlignedDataset
-from learnMSA.msa_hmm.AlignmentModel import AlignmentModel, non_homogeneous_mask_func, find_faulty_sequences
-from learnMSA.protein_language_models import Common, DataPipeline, TrainingUtil, MvnMixture, EmbeddingCache
+from learnMSA.msa_hmm import Align, AlignInsertions, Emitter, Transitioner, Initializers, MsaHmmCell, MsaHmmLayer, Training, Configuration, Viterbi, AncProbsLayer, Priors, DirichletMixture, Utility, MemoryCostModel, ExpectationMaximization
+from learnMSA.msa_hmm.SequenceDataset import SequenceDataset, AlignedDataset, make_sequence_store, compare_alignments
+from learnMSA.msa_hmm.SequenceDataset import _find_chunk_boundaries, _map_fasta_chunks, _merge_chunks
+from learnMSA.msa_hmm.AlignmentModel import AlignmentModel, AlignmentMetaData, _MetaDataBuilder, _write_phylip, _write_phylip_sequential, non_homogeneous_mask_func, find_faulty_sequences
+from learnMSA.msa_hmm.StateSequences import StateSequences
+from learnMSA.protein_language_models import Common, DataPipeline, TrainingUtil, MvnMixture, EmbeddingCache, EmbeddingBatchGenerator
 import itertools
+import io
 import shutil
+import json
+from Bio import SeqIO
+from concurrent.futures import ThreadPoolExecutor
 from test import RefModels as ref
 from test import TestSupervisedTraining
 
@@ -86,6 +92,104 @@ class TestDataset(unittest.TestCase):
                 self.assertTrue(invalid, test_file)
 
 
+    def test_byte_level_parsing(self):
+        # the byte-level parser must agree with Biopython's records and their encodings
+        whitespace_file = "test/data/whitespace_tmp.fasta"
+        tab_file = "test/data/tab_tmp.fasta"
+        with open(whitespace_file, "w") as f:
+            f.write(">s1 first sequence\nAC GT BZ \t\n  jk.-\t\n>s2\t second\nLLV AX\r\n-- ..\n")
+        with open(tab_file, "w") as f:
+            f.write(">t1\nAC\tGT\n>t2\nACGT\n")
+        def ref_encode(record, remove_gaps):
+            seq_str = str(record.seq).upper()
+            for aa in "BZJ":
+                seq_str = seq_str.replace(aa, "X")
+            for s in "-.":
+                seq_str = seq_str.replace(s, "" if remove_gaps else "-")
+            if any(aa not in SequenceDataset.alphabet for aa in seq_str):
+                return f"Found unknown character(s) in sequence {record.id}. Allowed alphabet: {SequenceDataset.alphabet}."
+            return [SequenceDataset.alphabet.index(aa) for aa in seq_str]
+        try:
+            for test_file in ["egf.fasta", "egf.ref", "ambiguous.fasta", "unknown_symbol.fasta", "empty_sequence.fasta", "empty_seqid.fasta", "whitespace_tmp.fasta"]:
+                records = list(SeqIO.parse(f"test/data/{test_file}", "fasta"))
+                with SequenceDataset(f"test/data/{test_file}", "fasta") as data:
+                    self.assertEqual(data.seq_ids, [r.id for r in records])
+                    np.testing.assert_equal(data.seq_lens, [sum(c.isalpha() for c in str(r.seq)) for r in records])
+                    for i, r in enumerate(records):
+                        self.assertEqual(str(data.get_record(i).seq), str(r.seq))
+                        self.assertEqual(data.get_record(i).description, r.description)
+                        for remove_gaps in [True, False]:
+                            try:
+                                encoded = data.get_encoded_seq(i, remove_gaps=remove_gaps).tolist()
+                            except ValueError as err:
+                                encoded = str(err)
+                            self.assertEqual(encoded, ref_encode(r, remove_gaps), f"{test_file} {i}")
+            # like Biopython before version 1.85, tabs within a line are kept and rejected
+            with SequenceDataset(tab_file, "fasta") as data:
+                self.assertEqual(str(data.get_record(0).seq), "AC\tGT")
+                with self.assertRaisesRegex(ValueError, "Found unknown character\\(s\\) in sequence t1"):
+                    data.get_encoded_seq(0)
+                with self.assertRaisesRegex(ValueError, "Found unknown character\\(s\\) in sequence t1"):
+                    data.validate_dataset()
+        finally:
+            os.remove(whitespace_file)
+            os.remove(tab_file)
+
+
+    def test_sequence_store(self):
+        store_dir = "test/data/egf_store"
+        # use a small block size to test that records are not split across blocks
+        make_sequence_store("test/data/egf.fasta", store_dir, block_size=1000)
+        with SequenceDataset("test/data/egf.fasta", "fasta") as ref:
+            with SequenceDataset(store_dir, "fasta", indexed=True) as data:
+                self.assertEqual(data.seq_ids, ref.seq_ids)
+                np.testing.assert_equal(data.seq_lens, ref.seq_lens)
+                for i in [0, 9, 27, -1]:
+                    self.assertEqual(str(data.get_record(i).seq), str(ref.get_record(i).seq))
+                    self.assertEqual(data.get_record(i).description, ref.get_record(i).description)
+                # random access from multiple threads
+                indices = np.random.randint(ref.num_seq, size=1000)
+                with ThreadPoolExecutor(8) as pool:
+                    encoded = list(pool.map(data.get_encoded_seq, indices))
+                for i, seq in zip(indices, encoded):
+                    np.testing.assert_equal(seq, ref.get_encoded_seq(i))
+        shutil.rmtree(store_dir)
+        # a temporary store is deleted on close
+        with SequenceDataset("test/data/egf.fasta", "fasta", indexed=True) as data:
+            temp_store = os.path.dirname(data._seq_buffer.filename)
+            self.assertTrue(os.path.isdir(temp_store))
+        self.assertFalse(os.path.isdir(temp_store))
+
+
+    def test_parallel_parsing(self):
+        filename = "test/data/egf.fasta"
+        ref = SequenceDataset(filename, "fasta")
+        # small chunks, the real minimum chunk size is too large for the test data
+        boundaries = _find_chunk_boundaries(filename, 7)
+        self.assertEqual(len(boundaries), 8)
+        chunks = list(_map_fasta_chunks(filename, boundaries, SequenceDataset.alphabet, 4))
+        seq_ids, titles, seq_buffer, seq_offsets, seq_lens, first_invalid = _merge_chunks(chunks)
+        self.assertEqual(seq_ids, ref.seq_ids)
+        self.assertEqual(titles, ref._titles)
+        np.testing.assert_equal(seq_buffer, ref._seq_buffer)
+        np.testing.assert_equal(seq_offsets, ref._seq_offsets)
+        np.testing.assert_equal(seq_lens, ref.seq_lens)
+        self.assertEqual(first_invalid, -1)
+        # the first invalid sequence is found across chunks
+        boundaries = _find_chunk_boundaries("test/data/unknown_symbol.fasta", 2)
+        chunks = list(_map_fasta_chunks("test/data/unknown_symbol.fasta", boundaries, SequenceDataset.alphabet, 2))
+        first_invalid = _merge_chunks(chunks)[5]
+        self.assertEqual(first_invalid, SequenceDataset("test/data/unknown_symbol.fasta")._get_first_invalid_seq())
+        # store creation on multiple processes
+        store_dir = "test/data/egf_store_parallel"
+        make_sequence_store(filename, store_dir, block_size=1000, threads=4)
+        with SequenceDataset(store_dir, "fasta", indexed=True) as data:
+            self.assertEqual(data.seq_ids, ref.seq_ids)
+            np.testing.assert_equal(data.seq_lens, ref.seq_lens)
+            np.testing.assert_equal(data._seq_offsets, ref._seq_offsets)
+        shutil.rmtree(store_dir)
+
+
     def test_aligned_dataset(self):
         for ind in [True, False]:
             with AlignedDataset("test/data/felix_msa.fa", "fasta", indexed=ind) as data:
@@ -95,6 +199,28 @@ class TestDataset(unittest.TestCase):
                 np.testing.assert_equal(data.get_column_map(0), [3,4,5,6,7])
                 np.testing.assert_equal(data.get_column_map(1), [0,1,2,3,4,5,6,7])
                 np.testing.assert_equal(data.get_column_map(2), [1,2,3,4,7])
+                for i in range(data.num_seq):
+                    np.testing.assert_equal(data.msa_matrix[i], data.get_encoded_seq(i, remove_gaps=False))
+
+
+    def test_alignment_scores(self):
+        ref = AlignedDataset(aligned_sequences=[("s1", "AB-C"), ("s2", "A-BC")])
+        for pred_seqs, sp, tc, modeler, column_scores in [([("s1", "ABC"), ("s2", "ABC")], 1., 1., 2/3, [1, np.nan, np.nan, 1]),
+                                                            ([("s1", "AB-C"), ("s2", "-ABC")], .5, .5, .5, [0, np.nan, np.nan, 1])]:
+            pred = AlignedDataset(aligned_sequences=pred_seqs)
+            scores = pred.compare(ref)
+            self.assertAlmostEqual(scores["SP"], sp)
+            self.assertAlmostEqual(pred.SP_score(ref), sp)
+            self.assertAlmostEqual(scores["TC"], tc)
+            self.assertAlmostEqual(pred.TC_score(ref), tc)
+            self.assertAlmostEqual(scores["modeler"], modeler)
+            np.testing.assert_equal(scores["column_scores"], column_scores)
+        for ref_file in ["test/data/egf.ref", "test/data/rhv.ref"]:
+            ref = AlignedDataset(ref_file)
+            for scores in compare_alignments([ref, ref], ref, threads=2):
+                self.assertEqual(scores["SP"], 1.)
+                self.assertEqual(scores["TC"], 1.)
+                self.assertEqual(scores["modeler"], 1.)
 
 
     def test_invalid_msa(self):
@@ -114,6 +240,25 @@ class TestDataset(unittest.TestCase):
             np.testing.assert_equal(data.get_encoded_seq(1), [13, 6, 9, 20])
 
 
+    def test_duplicate_index(self):
+        sequences = [("seq1", "FELIX"), ("seq2", "FEIX"), ("seq3", "FELIX"), ("seq4", "felix"), ("seq5", "FEIX"), ("seq6", "FELIX")]
+        with SequenceDataset(sequences=sequences) as data:
+            unique_indices, counts, inverse = data.get_unique_indices(np.arange(6))
+            np.testing.assert_equal(unique_indices, [0, 1, 3])
+            np.testing.assert_equal(counts, [3, 2, 1])
+            np.testing.assert_equal(inverse, [0, 1, 0, 2, 1, 0])
+            #representatives do not depend on the subset
+            unique_indices, counts, inverse = data.get_unique_indices(np.array([5, 4, 2]))
+            np.testing.assert_equal(unique_indices, [0, 1])
+            np.testing.assert_equal(counts, [2, 1])
+            np.testing.assert_equal(inverse, [0, 1, 0])
+            data.collapse_duplicates = False
+            unique_indices, counts, inverse = data.get_unique_indices(np.array([5, 4, 2]))
+            np.testing.assert_equal(unique_indices, [5, 4, 2])
+            np.testing.assert_equal(counts, [1, 1, 1])
+            np.testing.assert_equal(inverse, [0, 1, 2])
+
+
     def test_from_alignment(self):
         sequences = [("seq1", "FELIX"), ("seq2", "FE-IX")]
         with AlignedDataset(aligned_sequences=sequences) as data:
@@ -289,6 +434,52 @@ class TestMsaHmmCell(unittest.TestCase):
         for i in range(2):
             np.testing.assert_almost_equal(np.exp(loglik[i]), self.ref_lik[i])
             
+    def test_structured_transitioner(self):
+        #the structured operator computes the same transitions as the dense matrix in both directions
+        lengths = [4, 3, 12, 7]
+        np.random.seed(77)
+        transitioners = []
+        for structured_min_length in [1000, 0]:
+            transitioner = Transitioner.ProfileHMMTransitioner([Initializers.make_default_transition_init() for _ in lengths],
+                                                               [Initializers.make_default_flank_init() for _ in lengths],
+                                                               structured_min_length=structured_min_length)
+            transitioner.set_lengths(lengths)
+            transitioner.build()
+            transitioners.append(transitioner)
+        dense, structured = transitioners
+        self.assertFalse(dense.structured)
+        self.assertTrue(structured.structured)
+        for kernel_dense, kernel_structured in zip(dense.transition_kernel, structured.transition_kernel):
+            for key in kernel_dense:
+                kernel_structured[key].assign(np.random.normal(size=kernel_dense[key].shape))
+                kernel_dense[key].assign(kernel_structured[key])
+        x = tf.constant(np.random.rand(len(lengths), 5, dense.max_num_states), dtype=tf.float32)
+        for reverse in [False, True]:
+            dense.reverse = structured.reverse = reverse
+            dense.recurrent_init()
+            with tf.GradientTape() as tape:
+                structured.recurrent_init()
+                y = structured(x)
+                loss = tf.reduce_sum(tf.math.log(y + 1e-3))
+            np.testing.assert_allclose(y, dense(x), atol=1e-5)
+            grads = tape.gradient(loss, structured.trainable_variables)
+            self.assertTrue(all(np.all(np.isfinite(tf.convert_to_tensor(g))) for g in grads if g is not None))
+        #forward, backward and posteriors of the profile HMM layer
+        models = [0,1]
+        hmm_cell, length = self.make_test_cell(models)
+        hmm_cell.transitioner.structured_min_length = 0
+        hmm_cell.transitioner.set_lengths(length)
+        hmm_cell.recurrent_init()
+        hmm_layer = MsaHmmLayer.MsaHmmLayer(hmm_cell, use_prior=False)
+        seq = tf.one_hot([[0,1,0,2]], 3)
+        seq = np.repeat(seq[np.newaxis], len(models), axis=0)
+        loglik = hmm_layer(seq)[0]
+        state_posterior_log_probs = hmm_layer.state_posterior_log_probs(seq)
+        for i in range(2):
+            q = hmm_cell.num_states[i]
+            np.testing.assert_almost_equal(np.exp(loglik[i]), self.ref_lik[i])
+            np.testing.assert_almost_equal(np.exp(state_posterior_log_probs[i,0,:,:q]), self.ref_posterior_probs[i], decimal=6)
+
     def test_duplication(self):
         models = [0,1]
         hmm_cell, length = self.make_test_cell(models)
@@ -451,6 +642,24 @@ class TestMSAHMM(unittest.TestCase):
         self.assertTrue(np.all(x == y), str(x) + " not equal to " + str(y))
     
     
+    def make_random_cell(self, lengths, seed, scale, num_seq, max_len, min_len=1):
+        """ Returns a default cell with randomly perturbed parameters and random terminal-padded sequences 
+            of shape (num_models, num_seq, max_len+1) together with their lengths.
+        """
+        np.random.seed(seed)
+        config = Configuration.make_default(len(lengths))
+        hmm_cell = MsaHmmCell.MsaHmmCell(lengths, dim=len(SequenceDataset.alphabet), 
+                                         emitter=config["emitter"], transitioner=config["transitioner"])
+        hmm_cell.build((None, None, len(SequenceDataset.alphabet)))
+        for var in hmm_cell.trainable_variables:
+            var.assign(var + np.random.normal(scale=scale, size=var.shape))
+        hmm_cell.recurrent_init()
+        seq_lens = np.random.randint(min_len, max_len, size=num_seq)
+        sequences = np.random.randint(20, size=(num_seq, max_len+1))
+        sequences[np.arange(max_len+1)[np.newaxis] >= seq_lens[:,np.newaxis]] = len(SequenceDataset.alphabet)-1
+        return hmm_cell, np.stack([sequences]*len(lengths)), seq_lens
+    
+    
     def test_matrices(self):
         length=32
         hmm_cell = MsaHmmCell.MsaHmmCell(length=length)
@@ -584,6 +793,9 @@ class TestMSAHMM(unittest.TestCase):
             state_seqs_max_lik = Viterbi.viterbi(sequences, hmm_cell).numpy()
             # states : [LEFT_FLANK, MATCH x length, INSERT x length-1, UNANNOTATED_SEGMENT, RIGHT_FLANK, END]
             self.assert_vec(state_seqs_max_lik, ref_seqs)
+            #the structured Viterbi resolves the many ties of this model in the same way
+            emission_probs = hmm_cell.emission_probs(tf.one_hot(sequences, hmm_cell.dim))
+            self.assert_vec(Viterbi.viterbi_structured(emission_probs, hmm_cell).numpy(), ref_seqs)
             #this produces a result identical to above, but runs viterbi batch wise 
             #to avoid memory overflow  
             batch_generator = Training.DefaultBatchGenerator(return_only_sequences=True)
@@ -594,7 +806,7 @@ class TestMSAHMM(unittest.TestCase):
                                                                     batch_size=2,
                                                                     model_ids=[0,1],
                                                                     hmm_cell=hmm_cell)
-            self.assert_vec(state_seqs_max_lik2, ref_seqs)
+            self.assert_vec(state_seqs_max_lik2.to_dense(), ref_seqs)
             indices = np.array([0,4,5])
             state_seqs_max_lik3 = Viterbi.get_state_seqs_max_lik(data,
                                                                     batch_generator,
@@ -605,7 +817,7 @@ class TestMSAHMM(unittest.TestCase):
             max_len = np.amax(data.seq_lens[indices])+1
 
             for i,j in enumerate(indices):
-                self.assert_vec(state_seqs_max_lik3[:,i], ref_seqs[:,j, :max_len])
+                self.assert_vec(state_seqs_max_lik3.to_dense()[:,i], ref_seqs[:,j, :max_len])
                 
                 
             indices = np.array([[0,3,0,0,1,0,0,0], 
@@ -866,6 +1078,98 @@ class TestMSAHMM(unittest.TestCase):
                     self.assert_vec(alignment_block, ref)
 
 
+    def test_structured_viterbi(self):
+        lengths = [70, 45, 12]
+        hmm_cell, sequences, _ = self.make_random_cell(lengths, seed=13, scale=2., num_seq=10, max_len=119, min_len=20)
+        sequences = tf.one_hot(sequences, len(SequenceDataset.alphabet))
+        #requesting the variables forces the dense Viterbi
+        dense_paths, _ = Viterbi.viterbi(sequences, hmm_cell, return_variables=True)
+        structured_paths = Viterbi.viterbi(sequences, hmm_cell)
+        self.assert_vec(structured_paths.numpy(), dense_paths.numpy())
+        #long models do not have a dense transition matrix in the cell
+        hmm_cell.transitioner.structured_min_length = 0
+        hmm_cell.transitioner.set_lengths(lengths)
+        hmm_cell.recurrent_init()
+        self.assertIsNone(hmm_cell.log_A_dense)
+        self.assert_vec(Viterbi.viterbi(sequences, hmm_cell).numpy(), dense_paths.numpy())
+        dense_paths_2, _ = Viterbi.viterbi(sequences, hmm_cell, return_variables=True)
+        self.assert_vec(dense_paths_2.numpy(), dense_paths.numpy())
+        #tied match_skip sources: the first source is taken and scored with the expression used to rank the sources
+        hmm_cell = MsaHmmCell.MsaHmmCell([4], dim=len(SequenceDataset.alphabet),
+                                         emitter=Configuration.make_default(1)["emitter"],
+                                         transitioner=Configuration.make_default(1)["transitioner"])
+        hmm_cell.build((None, None, len(SequenceDataset.alphabet)))
+        hmm_cell.recurrent_init()
+        transitions = {key : tf.fill(value.shape, -np.inf) for key, value in hmm_cell.transitioner.make_viterbi_transitions().items()}
+        transitions["skip_out"] = tf.constant([[[-3., -2., -np.inf, -np.inf]]])
+        transitions["skip_in"] = tf.constant([[[-np.inf, -np.inf, -0.2, -0.3]]])
+        gamma_prev = tf.constant([[[-np.inf, -1., -2., -np.inf, -np.inf] + [-np.inf]*6]])
+        gamma_next, predecessors = Viterbi.viterbi_structured_step(gamma_prev, tf.ones_like(gamma_prev), transitions)
+        self.assert_vec(predecessors.numpy()[0,0,3:5], np.array([1, 1], dtype=np.int32))
+        np.testing.assert_equal(gamma_next.numpy()[0,0,3:5], np.float32(-4.) + np.float32([-0.2, -0.3]))
+
+        
+    def test_state_sequences(self):
+        lengths = [30, 12]
+        hmm_cell, sequences, seq_lens = self.make_random_cell(lengths, seed=21, scale=2., num_seq=25, max_len=80)
+        dense = Viterbi.viterbi(sequences, hmm_cell).numpy()
+        for run_length_encoded in [False, True]:
+            state_seqs = StateSequences.from_dense(dense, lengths, seq_lens+1, run_length_encoded)
+            np.testing.assert_equal(state_seqs.to_dense(), dense[:,:,:np.amax(seq_lens)+1])
+            for i,l in enumerate(lengths):
+                np.testing.assert_equal(AlignmentModel.decode(l, state_seqs[i]), AlignmentModel.decode(l, dense[i]))
+            np.testing.assert_equal(find_faulty_sequences(state_seqs, lengths[0], seq_lens), 
+                                    find_faulty_sequences(dense, lengths[0], seq_lens))
+            #runs are constant or chains of match states
+            run_states, run_starts, run_rows = state_seqs.get_runs(0)
+            self.assertLess(run_states.size, np.sum(seq_lens+1))
+            #selections can repeat rows
+            rows = np.array([3, 3, 0, 24])
+            np.testing.assert_equal(state_seqs.select(rows).to_dense(), dense[:, rows, :np.amax(seq_lens[rows])+1])
+            #replace rows with paths that use only the right flank
+            rows = np.array([0, 7, 24])
+            expected = np.copy(dense)
+            for i,l in enumerate(lengths):
+                expected[i, rows] = np.where(np.arange(81) < seq_lens[rows,np.newaxis], 2*l+1, 2*l+2)
+            state_seqs.replace(rows, StateSequences.from_dense(expected[:, rows], lengths, seq_lens[rows]+1))
+            np.testing.assert_equal(state_seqs.to_dense(), expected[:,:,:np.amax(seq_lens)+1])
+            #replacing rows of a selection leaves the original unchanged
+            selection = state_seqs.select(np.array([1, 2, 3]))
+            selected = np.copy(expected[:, [1, 2, 3]])
+            selected[:, 1] = np.where(np.arange(81) < seq_lens[2], 2*np.array(lengths)[:,np.newaxis]+1, 2*np.array(lengths)[:,np.newaxis]+2)
+            selection.replace([1], StateSequences.from_dense(selected[:, [1]], lengths, seq_lens[[2]]+1))
+            np.testing.assert_equal(selection.to_dense(), selected[:,:,:np.amax(seq_lens[[1, 2, 3]])+1])
+            np.testing.assert_equal(state_seqs.to_dense(), expected[:,:,:np.amax(seq_lens)+1])
+
+
+    def test_decode_runs(self):
+        #the run based decoding is equal to decoding position by position
+        def decode_stepwise(model_length, state_seqs_max_lik):
+            n = state_seqs_max_lik.shape[0]
+            indices = np.zeros(n, np.int16)
+            left_flank = AlignmentModel.decode_flank(state_seqs_max_lik, 0, indices)
+            core_blocks, unannotated_segments = [], []
+            while True:
+                core_blocks.append(AlignmentModel.decode_core(model_length, state_seqs_max_lik, indices))
+                if np.all(core_blocks[-1][3]):
+                    break
+                unannotated_segments.append(AlignmentModel.decode_flank(state_seqs_max_lik, 2*model_length, indices))
+            right_flank = AlignmentModel.decode_flank(state_seqs_max_lik, 2*model_length+1, indices)
+            return core_blocks, left_flank, right_flank, unannotated_segments
+        lengths = [25, 6]
+        hmm_cell, sequences, seq_lens = self.make_random_cell(lengths, seed=7, scale=3., num_seq=40, max_len=120)
+        dense = Viterbi.viterbi(sequences, hmm_cell).numpy()
+        num_blocks = []
+        for i,l in enumerate(lengths):
+            decoded = AlignmentModel.decode(l, dense[i])
+            np.testing.assert_equal(decoded, decode_stepwise(l, np.copy(dense[i])))
+            state_seqs = StateSequences.from_dense(dense, lengths, seq_lens+1, run_length_encoded=True)
+            np.testing.assert_equal(AlignmentModel.decode(l, state_seqs[i]), decoded)
+            num_blocks.append(len(decoded[0]))
+        #the test covers repeats
+        self.assertGreater(max(num_blocks), 1)
+
+        
     def test_parallel_viterbi(self):
         length = [5, 3]
         emission_init = [Initializers.ConstantInitializer(string_to_one_hot("FELIK").numpy()*20),
@@ -1009,7 +1313,93 @@ class TestMSAHMM(unittest.TestCase):
         indices = np.array([[0,1,2], [3,4,5]])
         weighted_loglik = hmm_layer.apply_sequence_weights(loglik, indices)
         np.testing.assert_equal(np.array([[0.1,0.4,1.5], [4.,10.,18.]]), weighted_loglik)
-                
+
+
+    def test_analytic_gradient(self):
+        #the backward recursion yields the same log-likelihoods and gradients as autodiff through the forward recursion
+        np.random.seed(0)
+        b, L = 4, 13
+        inputs = np.random.rand(2, b, L, len(SequenceDataset.alphabet)).astype(np.float32)
+        inputs[..., 20:] = 0
+        inputs[:, :, -3:] = np.eye(len(SequenceDataset.alphabet))[-1] #padding
+        inputs = tf.constant(inputs)
+        for structured_min_length, frozen_insertions in [(1000, True), (0, True), (1000, False)]:
+            config = Configuration.make_default(2, frozen_insertions=frozen_insertions)
+            config["transitioner"].structured_min_length = structured_min_length
+            hmm_layer = Training.make_msa_hmm_layer(10, [5, 8], config)
+            #layers built directly train like layers built from the default configuration
+            self.assertEqual(MsaHmmLayer.MsaHmmLayer(hmm_layer.cell).analytic_gradient, config["analytic_gradient"])
+            hmm_layer.build(inputs.shape)
+            results = []
+            for analytic_gradient in [False, True]:
+                hmm_layer.analytic_gradient = analytic_gradient
+                with tf.GradientTape() as tape:
+                    tape.watch(inputs)
+                    loglik, _, prior, _ = hmm_layer(inputs)
+                    loss = tf.reduce_sum(loglik * np.arange(1, b+1)) + tf.reduce_sum(prior)
+                grads = tape.gradient(loss, [inputs] + hmm_layer.trainable_variables)
+                results.append([loglik] + [tf.convert_to_tensor(g) for g in grads])
+            for x, y in zip(*results):
+                np.testing.assert_allclose(x.numpy(), y.numpy(), rtol=1e-3, atol=1e-4)
+
+
+    def test_stepwise_em(self):
+        np.random.seed(0)
+        b, L = 6, 15
+        alphabet_size = len(SequenceDataset.alphabet)
+        sequences = np.random.randint(0, 20, size=(2, b, L))
+        sequences[:, :, -3:] = alphabet_size-1 #padding
+        inputs = tf.constant(np.eye(alphabet_size, dtype=np.float32)[sequences])
+        for structured_min_length, frozen_insertions in [(1000, True), (0, True), (1000, False)]:
+            config = Configuration.make_default(2)
+            config["emitter"] = Emitter.ProfileHMMEmitter([Initializers.make_default_emission_init() for _ in range(2)],
+                                                          [Initializers.make_default_insertion_init() for _ in range(2)],
+                                                          frozen_insertions=frozen_insertions)
+            config["transitioner"].structured_min_length = structured_min_length
+            hmm_layer = Training.make_msa_hmm_layer(b, [5, 8], config)
+            hmm_layer.analytic_gradient = True
+            hmm_layer.build(inputs.shape)
+            optimizer = ExpectationMaximization.StepwiseEM(hmm_layer)
+            emitter, transitioner = hmm_layer.cell.emitter[0], hmm_layer.cell.transitioner
+            self.assertTrue(emitter.count_gradients and transitioner.count_gradients)
+            #in count mode, the gradients of the log-likelihood are the expected counts
+            with tf.GradientTape() as tape:
+                loglik, _, _, _ = hmm_layer(inputs)
+                loglik = tf.reduce_sum(loglik)
+            grads = tape.gradient(loglik, [emitter.emission_kernel[0], transitioner.flank_init_kernel[0]])
+            posterior = np.exp(hmm_layer.state_posterior_log_probs(inputs).numpy())
+            np.testing.assert_allclose(np.sum(grads[0], -1), np.sum(posterior[0, :, :, 1:6], (0,1)), rtol=1e-3)
+            np.testing.assert_allclose(grads[1], np.sum(posterior[0, :, 0, 0]), rtol=1e-3)
+            #trainable insertion kernels are in count mode as well and are therefore trained by EM, not by Adam
+            insertion_kernel = emitter.insertion_kernel[0]
+            self.assertEqual(id(insertion_kernel) in optimizer.em_variable_ids, not frozen_insertions)
+            if not frozen_insertions:
+                with tf.GradientTape() as tape:
+                    loglik = tf.reduce_sum(hmm_layer(inputs)[0])
+                grad_ins = tape.gradient(loglik, insertion_kernel)
+                #left flank, inserts, unannotated segment and right flank of the model of length 5
+                insertion_states = [0] + list(range(6, 12))
+                np.testing.assert_allclose(np.sum(grad_ins), np.sum(posterior[0][..., insertion_states]), rtol=1e-3)
+            #EM steps on the full data increase the objective and keep the kernels valid
+            objectives = []
+            for _ in range(4):
+                with tf.GradientTape() as tape:
+                    _, aggregated_loglik, prior, _ = hmm_layer(inputs)
+                    loss = -aggregated_loglik - tf.reduce_mean(prior)
+                grads = tape.gradient(loss, hmm_layer.trainable_variables)
+                optimizer.apply_gradients(zip(grads, hmm_layer.trainable_variables))
+                objectives.append(-loss.numpy())
+            self.assertGreater(objectives[-1], objectives[0])
+            self.assertEqual(optimizer.em_iterations.numpy(), 4)
+            if not frozen_insertions:
+                #the amino acid distribution of the insertions is the maximum likelihood estimate
+                ins_probs = tf.nn.softmax(insertion_kernel).numpy()[:20]
+                ins_counts = optimizer.get_statistics(insertion_kernel).numpy()[:20]
+                np.testing.assert_allclose(ins_probs / np.sum(ins_probs), ins_counts / np.sum(ins_counts), rtol=1e-4, atol=1e-6)
+            for v in hmm_layer.trainable_variables:
+                self.assertTrue(np.all(np.isfinite(v.numpy())))
+
+
                 
                             
 class TestAncProbs(unittest.TestCase):
@@ -1196,7 +1586,10 @@ class TestAncProbs(unittest.TestCase):
                                     model=model)
                 self.assert_anc_probs_layer(am.encoder_model.layers[-1], case["config"])
                 for x,_ in ds:
-                    anc_prob_seqs = am.encoder_model(x).numpy()[:,:,:-1]
+                    anc_prob_seqs = am.encoder_model(x)
+                    if isinstance(anc_prob_seqs, list): #sequences and lookup tables
+                        anc_prob_seqs = AncProbsLayer.lookup_anc_probs(*anc_prob_seqs)
+                    anc_prob_seqs = anc_prob_seqs.numpy()[:,:,:-1]
                     shape = (case["config"]["num_models"], n, sequences.shape[2], case["config"]["num_rate_matrices"], len(SequenceDataset.alphabet))
                     anc_prob_seqs = np.reshape(anc_prob_seqs, shape)
                 if "expected_anc_probs" in case:
@@ -1227,7 +1620,127 @@ class TestAncProbs(unittest.TestCase):
         oh_seqs = tf.expand_dims(oh_seqs, -2)
         prob2 = tf.linalg.matvec(anc_prob_B, oh_seqs)
         np.testing.assert_almost_equal(prob1.numpy(), prob2.numpy())
-        
+
+    def test_fused_emissions(self):
+        #looking up emissions from per-sequence tables is equivalent to emitting ancestral probabilities per residue
+        filename = os.path.dirname(__file__)+"/data/egf.fasta"
+        with SequenceDataset(filename) as data:
+            n = 32
+            indices = np.tile(np.arange(n)[:,np.newaxis], (1, 2))
+            results = []
+            for fused in [False, True]:
+                np.random.seed(0)
+                tf.random.set_seed(0)
+                config = Configuration.make_default(2)
+                config["fused_emissions"] = fused
+                config["num_rate_matrices"] = 2
+                config["encoder_initializer"] = (config["encoder_initializer"][:1] + 
+                                                [Initializers.ConstantInitializer(np.concatenate([config["encoder_initializer"][1]((2,1,20,20))]*2, axis=1)),
+                                                 Initializers.ConstantInitializer(np.concatenate([config["encoder_initializer"][2]((2,1,20))]*2, axis=1))])
+                config["emitter"] = Emitter.ProfileHMMEmitter(emission_init = [Initializers.ConstantInitializer(np.linspace(-1, 1, 47))]*2, 
+                                                              insertion_init = [Initializers.ConstantInitializer(0.)]*2)
+                model = Training.default_model_generator(num_seq=data.num_seq, effective_num_seq=data.num_seq, 
+                                                         model_lengths=[12, 15], config=config, data=data)
+                batch_gen = Training.DefaultBatchGenerator(shuffle=False)
+                batch_gen.configure(data, config)
+                sequences, _ = batch_gen(np.arange(n))
+                with tf.GradientTape() as tape:
+                    loglik = model((sequences, indices))[0]
+                    loss = -tf.reduce_sum(loglik)
+                grads = [tf.convert_to_tensor(g) for g in tape.gradient(loss, model.trainable_variables)]
+                am = AlignmentModel(data, batch_gen, np.arange(n), batch_size=n, model=model)
+                results.append((loglik, grads, am.to_string(0), am.to_string(1)))
+            (loglik_1, grads_1, *msa_1), (loglik_2, grads_2, *msa_2) = results
+            np.testing.assert_allclose(loglik_1.numpy(), loglik_2.numpy(), rtol=1e-5)
+            for g1, g2 in zip(grads_1, grads_2):
+                np.testing.assert_allclose(g1.numpy(), g2.numpy(), rtol=1e-3, atol=1e-5)
+            self.assertEqual(msa_1, msa_2)
+
+    def test_eigendecomposition(self):
+        #the eigendecomposition path and its gradients match matrix exponentials, also for degenerate eigenvalues
+        np.random.seed(0)
+        num_models, b, L = 2, 5, 7
+        sequences = np.random.randint(0, 20, size=(num_models, b, L))
+        R_lg4x = np.stack([Utility.parse_paml(paml, self.A)[0] for paml in Utility.LG4X_paml])
+        p_lg4x = np.stack([Utility.parse_paml(paml, self.A)[1] for paml in Utility.LG4X_paml])
+        uniform = (np.ones((1, 4, 20, 20)) - np.eye(20)).astype(np.float32)
+        for R, p, transposed in [(np.stack([R_lg4x]*num_models), np.stack([p_lg4x]*num_models), False),
+                                 (np.stack([R_lg4x]*num_models), np.stack([p_lg4x]*num_models), True),
+                                 (np.concatenate([uniform]*num_models), np.full((num_models, 4, 20), 0.05, dtype=np.float32), False)]:
+            R, p = tf.constant(R, dtype=tf.float32), tf.constant(p, dtype=tf.float32)
+            tau = tf.constant(np.random.uniform(0.01, 3., size=(num_models, b, 4)), dtype=tf.float32)
+            results = []
+            for reversible in [False, True]:
+                with tf.GradientTape() as tape:
+                    tape.watch([R, p, tau])
+                    anc_probs = AncProbsLayer.make_anc_probs(sequences, R, p, tau, transposed=transposed, reversible=reversible)
+                    loss = tf.reduce_sum(anc_probs * tf.range(20, dtype=tf.float32))
+                grad_R, grad_p, grad_tau = tape.gradient(loss, [R, p, tau])
+                #only the symmetric part of the exchangeability gradient is defined for reversible rate matrices
+                grad_R += tf.linalg.matrix_transpose(grad_R)
+                results.append([anc_probs, grad_R, grad_p, grad_tau])
+            for x, y in zip(*results):
+                np.testing.assert_allclose(x.numpy(), y.numpy(), rtol=1e-3, atol=1e-4)
+
+    def test_sparse_tau_updates(self):
+        #a batch touches only its rows of the evolutionary times, including the regularizer and the optimizer state
+        np.random.seed(0)
+        num_models, num_seq, b, L = 3, 100, 8, 10
+        config = Configuration.make_default(num_models)
+        config["matrix_rate_l2"] = 0.1
+        anc_probs_layer = Training.make_anc_probs_layer(num_seq, config)
+        anc_probs_layer.build()
+        sequences = np.random.randint(0, 20, size=(num_models, b, L))
+        rate_indices = np.stack([np.random.permutation(num_seq)[:b] for _ in range(num_models)])
+        rate_indices[1,0] = rate_indices[0,0] #duplicate row
+        np.testing.assert_allclose(anc_probs_layer.make_tau(subset=rate_indices[..., np.newaxis]).numpy(),
+                                np.take_along_axis(anc_probs_layer.make_tau().numpy(), rate_indices, axis=1))
+        with tf.GradientTape() as tape:
+            anc_probs = anc_probs_layer(sequences, rate_indices)
+            loss = tf.reduce_sum(anc_probs * np.random.rand(*anc_probs.shape)) + sum(anc_probs_layer.losses)
+        grad = tape.gradient(loss, anc_probs_layer.tau_kernel)
+        self.assertIsInstance(grad, tf.IndexedSlices)
+        #the first lazy step matches Adam, untouched rows keep their values
+        kernel = anc_probs_layer.tau_kernel.numpy()
+        lazy_var, dense_var = tf.Variable(kernel), tf.Variable(kernel)
+        Training.LazyAdam(0.1).apply_gradients([(grad, lazy_var)])
+        tf.keras.optimizers.Adam(0.1).apply_gradients([(tf.convert_to_tensor(grad), dense_var)])
+        np.testing.assert_allclose(lazy_var.numpy(), dense_var.numpy(), rtol=1e-6)
+        changed = np.flatnonzero(np.any(lazy_var.numpy() != kernel, axis=1))
+        np.testing.assert_equal(changed, np.unique(rate_indices))
+        #without access to the Adam moments (simulated by a Keras version that wraps variables differently), 
+        #sparse gradients fall back to Adam
+        unwrap_variable = Training._unwrap_variable
+        Training._unwrap_variable = lambda variable: variable.unknown_wrapper
+        try:
+            fallback_var = tf.Variable(kernel)
+            with self.assertWarns(UserWarning):
+                Training.LazyAdam(0.1).apply_gradients([(grad, fallback_var)])
+        finally:
+            Training._unwrap_variable = unwrap_variable
+        np.testing.assert_allclose(fallback_var.numpy(), dense_var.numpy(), rtol=1e-6)
+
+    def test_legacy_tau_layout(self):
+        #models saved with the evolutionary times in the layout (num_models, num_clusters) can still be loaded
+        for num_models, num_seq in [(3, 10), (3, 3)]:
+            anc_probs_layer = Training.make_anc_probs_layer(num_seq, Configuration.make_default(num_models))
+            anc_probs_layer.build()
+            anc_probs_layer.tau_kernel.assign(np.random.rand(num_seq, num_models))
+            if not hasattr(anc_probs_layer, "save_own_variables"):
+                return #older versions of keras do not store variables per layer
+            store = {}
+            anc_probs_layer.save_own_variables(store)
+            config = anc_probs_layer.get_config()
+            self.assertEqual(config.pop("tau_kernel_layout"), "clusters_first")
+            tau_key = [k for k in store.keys() if np.array_equal(store[k], anc_probs_layer.tau_kernel.numpy())][0]
+            legacy_store = {k : (np.transpose(store[k]) if k == tau_key else store[k]) for k in store.keys()}
+            for layer_config, layer_store in [(anc_probs_layer.get_config(), store), (config, legacy_store)]:
+                loaded_layer = AncProbsLayer.AncProbsLayer.from_config(layer_config)
+                loaded_layer.build()
+                loaded_layer.load_own_variables(layer_store)
+                np.testing.assert_equal(loaded_layer.tau_kernel.numpy(), anc_probs_layer.tau_kernel.numpy())
+
+
             
         
 class TestData(unittest.TestCase):
@@ -1250,7 +1763,212 @@ class TestData(unittest.TestCase):
                 self.assert_vec(i[:,0], ind)
                 for i,(r,j) in enumerate(zip(ref, ind)):
                     self.assertEqual("".join(alphabet[s[i,0,:data.seq_lens[j]]]), r)
-        
+
+
+    def test_batch_gen_cropping(self):
+        filename = os.path.dirname(__file__)+"/data/egf.fasta"
+        with SequenceDataset(filename) as data:
+            config = Configuration.make_default(3)
+            config["crop_long_seqs"] = 20
+            batch_gen = Training.DefaultBatchGenerator()
+            batch_gen.configure(data, config)
+            ind = np.arange(data.num_seq)
+            s, i, start, end = batch_gen(ind, return_crop_boundaries=True)
+            self.assertEqual(s.shape, (data.num_seq, 3, 21))
+            for b in range(data.num_seq):
+                for k in range(3):
+                    seq = data.get_encoded_seq(i[b,k])
+                    self.assertEqual(end[b,k]-start[b,k], min(20, seq.size))
+                    self.assert_vec(s[b,k,:end[b,k]-start[b,k]], seq[start[b,k]:end[b,k]].astype(np.uint8))
+                    self.assertTrue(np.all(s[b,k,end[b,k]-start[b,k]:] == len(SequenceDataset.alphabet)-1))
+
+    def test_graph_batch_gen(self):
+        filename = os.path.dirname(__file__)+"/data/egf.fasta"
+        with SequenceDataset(filename) as data:
+            config = Configuration.make_default(3)
+            ind = np.arange(data.num_seq)
+            for shuffle in [False, True]:
+                batch_gen = Training.DefaultBatchGenerator(shuffle=shuffle)
+                batch_gen.configure(data, config)
+                graph_batch_gen = Training.GraphBatchGenerator(shuffle=shuffle)
+                graph_batch_gen.configure(data, config)
+                graph_batch_gen.permutations = batch_gen.permutations
+                graph_batch_gen.tf_permutations = tf.constant(np.stack(batch_gen.permutations, axis=1))
+                s, i = batch_gen(ind)
+                graph_s, graph_i = graph_batch_gen.tf_call(tf.constant(ind))
+                self.assert_vec(graph_s.numpy(), s)
+                self.assert_vec(graph_i.numpy(), i)
+            #cropping in graph mode
+            graph_batch_gen.crop_long_seqs = 20
+            s, i, start, end = [x.numpy() for x in graph_batch_gen._tf_assemble(tf.constant(ind))]
+            self.assertEqual(s.shape, (data.num_seq, 3, 21))
+            for b in range(data.num_seq):
+                for k in range(3):
+                    seq = data.get_encoded_seq(i[b,k])
+                    self.assertEqual(end[b,k]-start[b,k], min(20, seq.size))
+                    self.assert_vec(s[b,k,:end[b,k]-start[b,k]], seq[start[b,k]:end[b,k]].astype(np.uint8))
+            #make_dataset maps the graph-native generator directly
+            ds = Training.make_dataset(ind, graph_batch_gen, batch_size=8, shuffle=False)
+            for (graph_s, graph_i), _ in ds.take(1):
+                self.assertEqual(graph_s.dtype, tf.uint8)
+                self.assertEqual(graph_i.dtype, tf.int64)
+                self.assertEqual(graph_i.shape, (8, 3))
+
+    def test_length_buckets(self):
+        filename = os.path.dirname(__file__)+"/data/egf.fasta"
+        with SequenceDataset(filename) as data:
+            config = Configuration.make_default(3)
+            config["length_buckets"] = 3
+            batch_gen = Training.DefaultBatchGenerator()
+            batch_gen.configure(data, config)
+            self.assertEqual(batch_gen.bucket_lengths[-1], data.max_len)
+            self.assertTrue(np.all(data.seq_lens <= batch_gen.bucket_lengths[batch_gen.bucket_ids]))
+            #each model has its own permutation, but sequences stay in their bucket
+            for perm in batch_gen.permutations:
+                self.assert_vec(np.sort(perm), np.arange(data.num_seq))
+                self.assert_vec(batch_gen.bucket_ids[perm], batch_gen.bucket_ids)
+            self.assertFalse(np.all(batch_gen.permutations[0] == batch_gen.permutations[1]))
+            batch_sizes = Training.get_bucket_batch_sizes(batch_gen.bucket_lengths, 4, data.max_len)
+            self.assertEqual(batch_sizes[-1], 4)
+            ds = Training.make_dataset(np.arange(data.num_seq), batch_gen, batch_size=4, shuffle=True)
+            for (s, i), _, w in ds.take(20):
+                bucket_ids = batch_gen.bucket_ids[i.numpy()]
+                self.assertTrue(np.all(bucket_ids == bucket_ids[0,0]))
+                self.assertTrue(s.shape[0] <= batch_sizes[bucket_ids[0,0]])
+                self.assertTrue(s.shape[2] <= batch_gen.bucket_lengths[bucket_ids[0,0]]+1)
+                self.assertAlmostEqual(w.numpy()[0], s.shape[0] / 4, places=5)
+            #the batch weights give every sequence the same expected weight in the objective independent of its bucket
+            batch_size = 64
+            ds = Training.make_dataset(np.arange(data.num_seq), batch_gen, batch_size=batch_size, shuffle=True)
+            seq_weights = np.zeros(data.num_seq)
+            num_drawn = 0
+            for (s, i), _, w in ds:
+                seq_weights[i.numpy()[:,0]] += w.numpy()[0] / s.shape[0]
+                num_drawn += s.shape[0]
+                if num_drawn >= 2 * data.num_seq:
+                    break
+            bucket_means = [np.mean(seq_weights[batch_gen.bucket_ids == k]) for k in range(len(batch_gen.bucket_lengths))]
+            np.testing.assert_allclose(bucket_means, 2 / batch_size, rtol=0.1)
+
+    def test_memory_cost_model(self):
+        #the fit recovers the coefficients of noise free measurements
+        coefficients = np.array([1e6, 40., 10.])
+        shapes = [(1, 16, 64, 67), (1, 32, 128, 67), (2, 16, 64, 195), (2, 32, 256, 195)]
+        features = [MemoryCostModel.MemoryCostModel.get_features(*shape) for shape in shapes]
+        cost_model = MemoryCostModel.MemoryCostModel.fit(features, np.dot(features, coefficients), memory=2**32)
+        np.testing.assert_allclose(cost_model.coefficients, coefficients, rtol=1e-6)
+        #batch sizes fit into the memory budget and decrease with sequence and model length
+        batch_sizes = [cost_model.get_max_batch_size(4, L, 2*L//3+3) for L in [100, 300, 1000, 3000]]
+        self.assertTrue(all(1 <= b <= MemoryCostModel.MAX_BATCH_SIZE for b in batch_sizes))
+        self.assertTrue(all(b1 >= b2 for b1, b2 in zip(batch_sizes, batch_sizes[1:])))
+        self.assertLess(batch_sizes[-1], batch_sizes[0])
+        for L, b in zip([100, 300, 1000, 3000], batch_sizes):
+            if b > 1:
+                self.assertLessEqual(cost_model.get_peak_bytes(4, b, L, 2*L//3+3), 2**31)
+        #the cached coefficients of this machine are loaded without a probe
+        cache_dir = os.path.dirname(__file__)+"/data/memory_cache"
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_dir+"/memory_cost_model.json", "w") as f:
+            json.dump({MemoryCostModel._get_machine_key() : [0., 1., 2.]}, f)
+        cost_model = MemoryCostModel.MemoryCostModel.load(cache_dir, memory=2**32)
+        self.assert_vec(cost_model.coefficients, np.array([0., 1., 2.]))
+        shutil.rmtree(cache_dir)
+        #without cache, nothing is measured or written unless calibration is requested
+        self.assertIsNone(MemoryCostModel.MemoryCostModel.load(cache_dir, memory=2**32))
+        self.assertFalse(os.path.exists(cache_dir))
+        #a failed calibration is not cached
+        class FailingCostModel(MemoryCostModel.MemoryCostModel):
+            @classmethod
+            def calibrate(cls, verbose=False, **kwargs):
+                return None
+        self.assertIsNone(FailingCostModel.load(cache_dir, calibrate=True, memory=2**32))
+        self.assertFalse(os.path.exists(cache_dir+"/memory_cost_model.json"))
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        default_cost_model = MemoryCostModel._default_cost_model, MemoryCostModel._default_cost_model_loaded
+        try:
+            for default in [None, cost_model]:
+                #machines that are not calibrated use the hand-tuned table
+                MemoryCostModel._default_cost_model, MemoryCostModel._default_cost_model_loaded = default, True
+                num_gpu = len(tf.config.list_logical_devices("GPU"))
+                if default is None and not Configuration.is_small_gpu():
+                    self.assertEqual(Configuration.get_adaptive_batch_size([600, 650], 1100), 32*max(1, num_gpu))
+                #chunk-wise recursions (parallel_factor > 1) require smaller batches
+                self.assertLess(Configuration.get_adaptive_batch_size([100, 120], 1000, parallel_factor=4),
+                                Configuration.get_adaptive_batch_size([100, 120], 1000))
+        finally:
+            MemoryCostModel._default_cost_model, MemoryCostModel._default_cost_model_loaded = default_cost_model
+        #user defined batch size callbacks only take model lengths and sequence length
+        with SequenceDataset(os.path.dirname(__file__)+"/data/egf.fasta") as data:
+            config = Configuration.make_default(1)
+            config["batch_size"] = lambda model_lengths, max_seq_len: 3
+            batch_gen = Training.DefaultBatchGenerator()
+            batch_gen.configure(data, config)
+            ds = Training.make_dataset(np.arange(data.num_seq), batch_gen, shuffle=False, bucket_by_seq_length=True,
+                                       model_lengths=[10], parallel_factor=2)
+            num_decoded = 0
+            for (s, i, j), _ in ds:
+                self.assertLessEqual(s.shape[0], 3)
+                num_decoded += s.shape[0]
+            self.assertEqual(num_decoded, data.num_seq)
+
+    def test_collapse_duplicates(self):
+        sequences = [("seq1", "FELIX"), ("seq2", "FEIX"), ("seq3", "FELIX"), ("seq4", "AAA"), ("seq5", "FELIX")]
+        with SequenceDataset(sequences=sequences) as data:
+            indices, weights = Training.collapse_duplicates(data, np.arange(5))
+            self.assert_vec(indices, np.array([0, 1, 3]))
+            self.assert_vec(weights, np.array([3, 1, 0, 1, 0], dtype=np.float32))
+            indices, weights = Training.collapse_duplicates(data, np.arange(5), np.array([.5, 1, .5, 2, 1], dtype=np.float32))
+            self.assert_vec(weights, np.array([2, 1, 0, 2, 0], dtype=np.float32))
+            #a subset that splits a group of duplicates, the representative is the first occurrence in the dataset 
+            #like in decoding, i.e. the group is decoded with the evolutionary time that was trained
+            indices, weights = Training.collapse_duplicates(data, np.array([4, 3, 2]), np.array([.5, 1, .5, 2, 1], dtype=np.float32))
+            self.assert_vec(indices, np.array([0, 3]))
+            self.assert_vec(weights, np.array([1.5, 1, 0, 2, 0], dtype=np.float32))
+            unique_indices, _, _ = data.get_unique_indices(np.array([4, 3, 2]))
+            self.assert_vec(unique_indices, indices)
+            #a single later duplicate is replaced by its representative
+            indices, weights = Training.collapse_duplicates(data, np.array([2, 3]))
+            self.assert_vec(indices, np.array([0, 3]))
+            indices, weights = Training.collapse_duplicates(data, np.array([1, 3, 0]))
+            self.assert_vec(indices, np.array([1, 3, 0]))
+            self.assertIsNone(weights)
+            #the training permutations map representatives to representatives
+            batch_gen = Training.DefaultBatchGenerator()
+            batch_gen.configure(data, Configuration.make_default(3))
+            for perm in batch_gen.permutations:
+                self.assert_vec(np.sort(perm[[0, 1, 3]]), np.array([0, 1, 3]))
+                self.assert_vec(perm[[2, 4]], np.array([2, 4]))
+
+    def test_state_expectations_with_duplicates(self):
+        #duplicates of different lengths, decoding sorts the distinct sequences by length
+        sequences = [("seq1", "FELIKFELIK"), ("seq2", "FE"), ("seq3", "FELIKFELIK"),
+                     ("seq4", "AHCF"), ("seq5", "FE"), ("seq6", "FE")]
+        with SequenceDataset(sequences=sequences) as data:
+            config = Configuration.make_default(2)
+            model = Training.default_model_generator(num_seq=data.num_seq,
+                                                     effective_num_seq=data.num_seq,
+                                                     model_lengths=[4, 6],
+                                                     config=config,
+                                                     data=data)
+            batch_gen = Training.DefaultBatchGenerator()
+            batch_gen.configure(data, config)
+            indices = np.array([5, 0, 1, 3, 2, 4])
+            am = AlignmentModel(data, batch_gen, indices, 32, model)
+            for reduce in [True, False]:
+                results = []
+                for collapse in [True, False]:
+                    data.collapse_duplicates = collapse
+                    results.append(Align.get_state_expectations(data, batch_gen, indices, 2,
+                                                                am.msa_hmm_layer, am.encoder_model, reduce=reduce))
+                #the expected visits of the terminal states count the padding of the batches, which depends on the batch composition
+                for i, l in enumerate([4, 6]):
+                    np.testing.assert_allclose(np.array(results[0])[i, ..., :2*l+2], np.array(results[1])[i, ..., :2*l+2], rtol=1e-5, atol=1e-6)
+            #per sequence posteriors are returned in the order of indices
+            self.assertTrue(np.allclose(results[0][:,1], results[0][:,4]))
+            self.assertTrue(np.allclose(results[0][:,0], results[0][:,5]))
+            self.assertFalse(np.allclose(results[0][:,0], results[0][:,1]))
+
         
 class TestModelSurgery(unittest.TestCase):
     
@@ -1343,8 +2061,43 @@ class TestModelSurgery(unittest.TestCase):
             self.assert_vec(pos_expand, [0,3,5])
             self.assert_vec(expansion_lens, [2,2,3])
             self.assert_vec(pos_discard, [1])
-        
-        
+
+
+    def test_streaming_decode(self):
+        filename = os.path.dirname(__file__)+"/data/felix_insert_delete.fa"
+        with SequenceDataset(filename) as data:
+            am = self.make_test_alignment(data)
+            ref_strings = am.to_string(model_index=0, add_block_sep=False)
+            #single sequence batches decode different numbers of repeats
+            am.batch_generator.config["batch_size"] = 1
+            for batch_size in [1, 32]:
+                am.batch_size = batch_size
+                metadata = []
+                for streaming in [False, True]:
+                    am.streaming_decode = streaming
+                    am.metadata = {}
+                    self.assertEqual(am.to_string(model_index=0, add_block_sep=False), ref_strings)
+                    metadata.append(am.metadata[0])
+                for attr in ["consensus", "insertion_lens", "insertion_start", "finished", "left_flank_len", "left_flank_start",
+                             "right_flank_len", "right_flank_start", "unannotated_segments_len", "unannotated_segments_start"]:
+                    self.assert_vec(getattr(metadata[0], attr), getattr(metadata[1], attr))
+        #the rerun of a faulty sequence removes the only second repeat, 
+        #model length 3: left flank 0, match 1-3, insert 4-5, unannotated 6, right flank 7, terminal 8
+        first_pass = np.array([[1,2,3,7,8,8,8,8,8,8],
+                               [0,1,4,2,3,6,1,2,3,8]])
+        rerun = np.array([[0,1,4,2,3,7,7,7,7,8]])
+        builder = _MetaDataBuilder(2, 3)
+        builder.add(np.arange(2), *AlignmentModel.decode(3, first_pass))
+        builder.add(np.array([1]), *AlignmentModel.decode(3, rerun))
+        streamed = builder.build()
+        ref_metadata = AlignmentMetaData(*AlignmentModel.decode(3, np.concatenate([first_pass[:1], rerun])))
+        self.assertEqual(streamed.num_repeats, 1)
+        self.assertEqual(streamed.alignment_len, ref_metadata.alignment_len)
+        for attr in ["consensus", "insertion_lens", "insertion_start", "finished", "left_flank_len", "left_flank_start",
+                     "right_flank_len", "right_flank_start"]:
+            self.assert_vec(getattr(streamed, attr), getattr(ref_metadata, attr))
+
+
     def test_extend_mods(self):
         pos_expand = np.array([2,3,5])
         expansion_lens = np.array([9,1,3])
@@ -1573,6 +2326,67 @@ class TestAlignment(unittest.TestCase):
         ref_subalignment = ["FE...LIK...", "FE...LIKhac", "FEahcLIK..."]
         for s,r in zip(subalignment_strings, ref_subalignment):
             self.assertEqual(s,r)
+        #streamed output formats are identical to Biopython's output
+        seq_ids = [fasta_file.seq_ids[i] for i in subset]
+        ref_msa = AlignedDataset(aligned_sequences=list(zip(seq_ids, subalignment_strings)))
+        out_filename = os.path.dirname(__file__)+"/data/subalignment.out"
+        ref_filename = os.path.dirname(__file__)+"/data/subalignment.ref.out"
+        for fmt in ["stockholm", "clustal"]:
+            ref_msa.write(ref_filename, fmt)
+            for batch_size in [1, 2, 32]:
+                sub_am.to_file(out_filename, 0, batch_size=batch_size, format=fmt)
+                with open(out_filename) as out_file, open(ref_filename) as ref_file:
+                    self.assertEqual(out_file.read(), ref_file.read())
+        #phylip does not allow dots, the egf alignment spans multiple interleaved blocks
+        with SequenceDataset(os.path.dirname(__file__)+"/data/egf.fasta") as egf_file:
+            egf_config = Configuration.make_default(1)
+            egf_model = Training.default_model_generator(num_seq=egf_file.num_seq,
+                                                         effective_num_seq=egf_file.num_seq,
+                                                         model_lengths=[60],
+                                                         config=egf_config,
+                                                         data=egf_file)
+            egf_batch_gen = Training.DefaultBatchGenerator()
+            egf_batch_gen.configure(egf_file, egf_config)
+            for data, gen, indices, phylip_model in [(fasta_file, batch_gen, subset, model),
+                                                     (egf_file, egf_batch_gen, np.argsort(-egf_file.seq_lens, kind="stable")[:5], egf_model)]:
+                phylip_am = AlignmentModel(data, gen, indices, 32, phylip_model, gap_symbol_insertions="-")
+                phylip_strings = phylip_am.to_string(0, add_block_sep=False)
+                ref_msa = AlignedDataset(aligned_sequences=list(zip([data.seq_ids[i] for i in indices], phylip_strings)))
+                for fmt in ["phylip", "phylip-relaxed", "phylip-sequential"]:
+                    ref_msa.write(ref_filename, fmt)
+                    for batch_size in [1, 2, 32]:
+                        phylip_am.to_file(out_filename, 0, batch_size=batch_size, format=fmt)
+                        with open(out_filename) as out_file, open(ref_filename) as ref_file:
+                            self.assertEqual(out_file.read(), ref_file.read(), f"{fmt} {batch_size}")
+            self.assertGreater(len(phylip_strings[0]), 50)
+        #empty alignments are rejected by the interleaved and the sequential writer alike
+        for write in [_write_phylip, _write_phylip_sequential]:
+            with self.assertRaisesRegex(ValueError, "Non-empty sequences are required"):
+                write(io.StringIO(), [], iter([]))
+        #fasta output with line wrapping, batches are formatted in parallel
+        for line_width, threads in [(None, 1), (4, 2), (11, 3)]:
+            sub_am.to_file(out_filename, 0, batch_size=1, line_width=line_width, threads=threads)
+            with open(out_filename) as out_file:
+                lines = out_file.read().splitlines()
+            width = line_width if line_width else 11
+            expected_lines = []
+            for seq_id, s in zip(seq_ids, subalignment_strings):
+                expected_lines += [">"+seq_id] + [s[i:i+width] for i in range(0, len(s), width)]
+            self.assertEqual(lines, expected_lines)
+        #a2m equals the fasta output with the default gap symbols, a3m omits the insertion gaps
+        ref_a3m = ["FELIK", "FELIKhac", "FEahcLIK"]
+        for fmt, ref, line_width in [("a2m", ref_subalignment, None), ("a3m", ref_a3m, None), ("a3m", ref_a3m, 3)]:
+            for batch_size in [1, 2, 32]:
+                sub_am.to_file(out_filename, 0, batch_size=batch_size, format=fmt, line_width=line_width, threads=2)
+                with open(out_filename) as out_file:
+                    lines = out_file.read().splitlines()
+                width = line_width if line_width else 11
+                expected_lines = []
+                for seq_id, s in zip(seq_ids, ref):
+                    expected_lines += [">"+seq_id] + [s[i:i+width] for i in range(0, len(s), width)]
+                self.assertEqual(lines, expected_lines)
+        os.remove(out_filename)
+        os.remove(ref_filename)
        
     #this test aims to test the high level alignment function by feeding real world data to it
     #and checking if the resulting alignment meets some friendly thresholds 
@@ -1648,6 +2462,51 @@ class TestAlignment(unittest.TestCase):
         np.testing.assert_equal(faulty_sequences, [0, 1, 4, 5, 6, 7, 8])
         
         
+    def test_insertion_slices(self):
+        filename = os.path.dirname(__file__)+"/data/egf.fasta"
+        with SequenceDataset(filename) as data:
+            np.random.seed(3)
+            indices = np.random.permutation(data.num_seq)[:50]
+            lens = np.random.randint(0, 40, size=50)
+            starts = np.random.randint(0, 5, size=50)
+            lens = np.minimum(lens, data.seq_lens[indices] - starts)
+            which, pairs = AlignInsertions.find_long_insertions_and_get_sequences(data, lens, starts, indices=indices)
+            np.testing.assert_equal(which, np.flatnonzero(lens >= 20))
+            for j, (sid, fragment) in zip(which, pairs):
+                i = indices[j]
+                self.assertEqual(sid, data.seq_ids[i]+"\n")
+                self.assertEqual(fragment, str(data.get_record(i).seq).upper()[starts[j]:starts[j]+lens[j]])
+        #fragments keep B, Z and J, only X, U and O make a fragment non-standard
+        sequences = [("bzj", "bzj"*8+"ACDEFG"), ("x", "X"*25+"ACDEF"), 
+                     ("s1", "ACDEFGHIKL"*3), ("s2", "LKIHGFEDCA"*3), ("s3", "ACDEFGHIKL"*3)]
+        with SequenceDataset(sequences=sequences) as data:
+            which, pairs = AlignInsertions.find_long_insertions_and_get_sequences(data, np.array([30]*5), np.array([0]*5))
+            np.testing.assert_equal(which, [0,2,3,4])
+            self.assertEqual(pairs[0], ("bzj\n", "BZJ"*8+"ACDEFG"))
+        #large slices are aligned alone, small ones in batches 
+        costs = {"a" : 9e6, "b" : 2e5, "c" : 1e6, "d" : 5e5, "e" : 6e5, "f" : 1e4}
+        large, batches = AlignInsertions.schedule_slices(costs, 2)
+        self.assertEqual(large, ["a"])
+        self.assertEqual(batches, [["c"], ["e", "d"], ["b", "f"]])
+        large, batches = AlignInsertions.schedule_slices(costs, 1)
+        self.assertEqual(large, [])
+        self.assertEqual(batches, [["a"], ["c", "e", "d", "b", "f"]])
+        #the slice cache evicts the least recently used msas beyond its size
+        cache = AlignInsertions.SliceMsaCache(max_size=12)
+        cache.put("a", [("s1", "AC-D"), ("s2", "ACE-")])
+        cache.put("b", [("s1", "AC")])
+        self.assertEqual(cache.get("a"), [("s1", "AC-D"), ("s2", "ACE-")])
+        cache.put("c", [("s3", "ACD")])
+        self.assertTrue("a" in cache and "c" in cache)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.size, 11)
+        #msas larger than the cache are not kept and do not evict the cached ones
+        cache.put("d", [("s4", "A"*20)])
+        self.assertFalse("d" in cache)
+        self.assertTrue("a" in cache and "c" in cache)
+        self.assertEqual(cache.size, 11)
+
+
 class ConsoleTest(unittest.TestCase):
         
     def test_error_handling(self):
@@ -1964,6 +2823,45 @@ class TestLanguageModelExtension(unittest.TestCase):
         self.assertEqual(num_calls, [2, 2])
         self.assertEqual(np.sum(cache.cache), np.dot(seq_lens, np.arange(1,len(seq_lens)+1)*dim))
 
+
+    def test_graph_embedding_batch_gen(self):
+        filename = os.path.dirname(__file__)+"/data/egf.fasta"
+        with SequenceDataset(filename) as data:
+            config = Configuration.make_default(3)
+            scoring_model_config = Common.ScoringModelConfig(dim=8)
+            np.random.seed(5)
+            def compute_emb_func(indices):
+                return np.random.normal(size=(indices.size, np.amax(data.seq_lens[indices]), 8)).astype(np.float16)
+            ind = np.arange(data.num_seq)
+            for shuffle in [False, True]:
+                #a filled cache skips loading the language model
+                cache = EmbeddingCache.EmbeddingCache(data.seq_lens, scoring_model_config.dim)
+                cache.fill_cache(compute_emb_func, lambda L: 64, verbose=False)
+                batch_gen = EmbeddingBatchGenerator.EmbeddingBatchGenerator(scoring_model_config, shuffle=shuffle)
+                batch_gen.cache = cache
+                batch_gen.configure(data, config)
+                graph_batch_gen = EmbeddingBatchGenerator.GraphEmbeddingBatchGenerator(scoring_model_config, shuffle=shuffle)
+                graph_batch_gen.cache = cache
+                graph_batch_gen.configure(data, config)
+                #the cache is held only once, as a view of the tensor
+                self.assertIs(cache.cache, graph_batch_gen._cache_view)
+                graph_batch_gen.permutations = batch_gen.permutations
+                graph_batch_gen.tf_permutations = tf.constant(np.stack(batch_gen.permutations, axis=1))
+                s, i, emb = batch_gen(ind)
+                graph_s, graph_i, graph_emb = graph_batch_gen.tf_call(tf.constant(ind))
+                np.testing.assert_equal(graph_s.numpy(), s)
+                np.testing.assert_equal(graph_i.numpy(), i)
+                np.testing.assert_equal(graph_emb.numpy(), emb)
+            #make_dataset maps the graph-native generator directly
+            for gen in [batch_gen, graph_batch_gen]:
+                gen.shuffle = False
+            ds = Training.make_dataset(ind, batch_gen, batch_size=8, shuffle=False)
+            graph_ds = Training.make_dataset(ind, graph_batch_gen, batch_size=8, shuffle=False)
+            for ((s, i, emb), _), ((graph_s, graph_i, graph_emb), _) in zip(ds, graph_ds):
+                np.testing.assert_equal(graph_s.numpy(), s.numpy())
+                np.testing.assert_equal(graph_i.numpy(), i.numpy())
+                np.testing.assert_equal(graph_emb.numpy(), emb.numpy())
+
     
     def test_regularizer(self):
         # test the regularizer